@@ -0,0 +1,141 @@
+import math
+import time
+import uuid
+from collections import namedtuple
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .constants import BENCHMARK_ARTICOLI_CARRELLO, GENERATORE_ID_BASE
+
+# Scenario: utente è il nome di un attributo di Contesto (None = anonimo)
+Scenario = namedtuple('Scenario', ['nome', 'metodo', 'url', 'dati', 'utente'])
+Contesto = namedtuple('Contesto', ['acquirente', 'venditore', 'staff', 'annuncio', 'tag', 'prodotti', 'ordine'])
+
+ORDINAMENTI_RICERCA = ['data-desc', 'data-asc', 'prezzo-asc', 'prezzo-desc', 'best-star', 'worst-star', 'rilevanza']
+
+def percentile(valori, p):
+    # Nearest-rank: il valore più piccolo che copre il p% dei campioni
+    ordinati = sorted(valori)
+    return ordinati[max(math.ceil(p / 100 * len(ordinati)) - 1, 0)]
+
+def prepara_contesto():
+    # Sul dataset di genera_dati: il primo utente generato compra, l'inserzionista
+    # con più ordini ricevuti vende, l'annuncio più commentato è quello di dettaglio
+    from purchase.models import Cart, Invoice
+    from sylvelius.models import Annuncio, Ordine, Tag
+
+    acquirente = User.objects.get(id=GENERATORE_ID_BASE)
+    venditore = User.objects.filter(id__gte=GENERATORE_ID_BASE).annotate(
+        n=Count('annunci__prodotto__ordini')).order_by('-n', 'id').first()
+    annuncio = Annuncio.objects.filter(id__gte=GENERATORE_ID_BASE, is_published=True).select_related('prodotto').order_by(
+        '-rating_numero', 'id').first()
+    tag = Tag.objects.annotate(n=Count('prodotti')).order_by('-n', 'nome').values_list('nome', flat=True).first()
+    staff = User.objects.filter(is_staff=True, is_active=True).order_by('id').first()
+    ordine = Ordine.objects.filter(prodotto__annuncio__inserzionista=venditore, stato_consegna='da spedire',
+                                   utente__is_active=True).order_by('id').values_list('id', flat=True).first()
+
+    # Carrello con articoli acquistabili, così carrello e checkout fanno tutto il lavoro
+    disponibili = list(Annuncio.objects.filter(
+        is_published=True, qta_magazzino__gt=0, inserzionista__is_active=True
+    ).exclude(inserzionista=acquirente).order_by('id').values_list('prodotto_id', flat=True)[:BENCHMARK_ARTICOLI_CARRELLO])
+    cart, _ = Cart.objects.get_or_create(utente=acquirente, defaults={'uuid': str(uuid.uuid4())})
+    Invoice.objects.filter(cart=cart).delete()
+    Invoice.objects.bulk_create([
+        Invoice(uuid=str(uuid.uuid4()), utente=acquirente, quantita=1, prodotto_id=prodotto_id, cart=cart)
+        for prodotto_id in disponibili
+    ])
+    return Contesto(acquirente, venditore, staff, annuncio, tag, disponibili, ordine)
+
+def scenari(contesto):
+    q = contesto.annuncio.prodotto.nome.split()[0]
+    ricerca = reverse('sylvelius:ricerca_annunci')
+    elenco = [
+        Scenario('home', 'get', reverse('sylvelius:home'), None, None),
+        Scenario('home_autenticato', 'get', reverse('sylvelius:home'), None, 'acquirente'),
+    ]
+    elenco += [
+        Scenario(f'ricerca_{ordine}', 'get', ricerca, {'q': q, 'sort': ordine}, None)
+        for ordine in ORDINAMENTI_RICERCA
+    ]
+    elenco += [
+        Scenario('ricerca_vuota', 'get', ricerca, {}, None),
+        Scenario('ricerca_categoria', 'get', ricerca, {'categoria': contesto.tag or ''}, None),
+        Scenario('ricerca_inserzionista', 'get', ricerca, {'inserzionista': contesto.venditore.username}, None),
+        Scenario('ricerca_condizione', 'get', ricerca, {'condition': 'nuovo'}, None),
+        Scenario('ricerca_prezzo', 'get', ricerca, {'prezzo_min': '10', 'prezzo_max': '100'}, None),
+        Scenario('ricerca_rating', 'get', ricerca, {'search_by_rating': '4'}, None),
+        Scenario('ricerca_disponibili', 'get', ricerca, {'qta_mag': 'qta-pres', 'sort': 'prezzo-asc'}, None),
+        Scenario('annuncio', 'get', reverse('sylvelius:dettagli_annuncio', args=[contesto.annuncio.uuid]), None, 'acquirente'),
+        Scenario('profilo', 'get', reverse('sylvelius:profile'), None, 'acquirente'),
+        Scenario('profilo_dettagli', 'get',
+                 reverse('sylvelius:dettagli_profilo', args=[contesto.venditore.username]), None, 'acquirente'),
+        Scenario('profilo_ordini', 'get', reverse('sylvelius:profile_ordini'), None, 'acquirente'),
+        Scenario('profilo_annunci', 'get', reverse('sylvelius:profile_annunci'), None, 'venditore'),
+        Scenario('clienti', 'get', reverse('sylvelius:profile_clienti'), None, 'venditore'),
+        Scenario('carrello', 'get', reverse('purchase:carrello'), None, 'acquirente'),
+        Scenario('checkout', 'post', reverse('purchase:checkout'), None, 'acquirente'),
+        Scenario('api_immagine', 'get', f'/api/immagine/{contesto.annuncio.prodotto_id}/', None, None),
+        Scenario('api_immagini', 'get', f'/api/immagini/{contesto.annuncio.prodotto_id}/', None, None),
+        Scenario('api_immagini_prodotti', 'get', reverse('sylvelius:immagini_prodotti'),
+                 {'prodotti': ','.join(map(str, contesto.prodotti))}, None),
+        Scenario('api_notifiche', 'get', reverse('sylvelius:notifications_api'), None, 'acquirente'),
+        Scenario('api_carrello', 'get', reverse('sylvelius:cart_check'), None, 'acquirente'),
+    ]
+    if contesto.ordine is not None:
+        elenco.append(Scenario('spedizione', 'get', reverse('shipping:ship'), {'ordine': contesto.ordine}, 'venditore'))
+    if contesto.staff is not None:
+        elenco.append(Scenario('api_statistiche', 'get', reverse('sylvelius:statistiche_suggerimenti'), None, 'staff'))
+    return elenco
+
+def misura(client, scenario, ripetizioni, riscaldamento=1):
+    # Le prime richieste riempiono sessione, cache e indici di processo e non si contano
+    richiesta = getattr(client, scenario.metodo)
+    for _ in range(riscaldamento):
+        richiesta(scenario.url, scenario.dati)
+    tempi, query = [], []
+    for _ in range(ripetizioni):
+        with CaptureQueriesContext(connection) as queries:
+            inizio = time.perf_counter()
+            response = richiesta(scenario.url, scenario.dati)
+            tempi.append((time.perf_counter() - inizio) * 1000)
+        query.append(len(queries.captured_queries))
+    return {
+        'status': response.status_code,
+        'p50_ms': round(percentile(tempi, 50), 3),
+        'p95_ms': round(percentile(tempi, 95), 3),
+        'max_ms': round(max(tempi), 3),
+        'query': max(query),
+    }
+
+def esegui(ripetizioni, riscaldamento=1, filtro=None):
+    contesto = prepara_contesto()
+    clienti = {}
+    risultati = {}
+    for scenario in scenari(contesto):
+        if filtro and filtro not in scenario.nome:
+            continue
+        client = clienti.get(scenario.utente)
+        if client is None:
+            client = clienti[scenario.utente] = Client()
+            if scenario.utente:
+                client.force_login(getattr(contesto, scenario.utente))
+        risultati[scenario.nome] = misura(client, scenario, ripetizioni, riscaldamento)
+    return risultati
+
+def confronta(prima, dopo, soglia):
+    # Regressioni fra due esecuzioni: p95 peggiorato oltre soglia (in %) o più query
+    regressioni = []
+    for nome, attuale in dopo.items():
+        precedente = prima.get(nome)
+        if precedente is None:
+            continue
+        if attuale['query'] > precedente['query']:
+            regressioni.append(f"{nome}: query {precedente['query']} -> {attuale['query']}")
+        if attuale['p95_ms'] > precedente['p95_ms'] * (1 + soglia / 100):
+            regressioni.append(f"{nome}: p95 {precedente['p95_ms']:.1f} -> {attuale['p95_ms']:.1f} ms")
+    return regressioni
@@ -62,9 +62,17 @@ MAX_PAGINATOR_BANNED_USERS_VALUE = 10
 MAX_PAGINATOR_COMMENTI_DETTAGLI_VALUE = 10
 MAX_PAGINATOR_COMMENTI_ANNUNCIO_VALUE = 20
 
+# Numero massimo di query per pagina (utente autenticato), indipendente dal numero di card
+MAX_QUERIES_HOME_VALUE = 7
+MAX_QUERIES_RICERCA_VALUE = 7
+
 MIN_CREA_ANNUNCIO_QTA_VALUE = 0
 
 MAX_WS_QUERIES = 10
+WS_DEBOUNCE_SECONDI = 0.05 # attesa lato server prima di eseguire l'ultima query ricevuta
+SUGGERIMENTI_MAX_ETA_SECONDI = 300 # ricostruzione periodica per le modifiche fatte da altri processi
+SUGGERIMENTI_CACHE_DIMENSIONE = 2048 # query memorizzate per indice (prodotti, tag)
+SUGGERIMENTI_CACHE_TTL_SECONDI = 60
 
 ALIQUOTA_IVA_ORD = 22
 ALIQUOTA_IVA_RID = 10
@@ -92,12 +100,53 @@ MAX_SLICE_TAGS_PER_CARD = 3
 MAX_MESSAGE_TITLE_VALUE = 30
 MAX_MESSAGE_MESSAGE_VALUE = 255
 MAX_MESSAGES_PER_PAGE = 20
+MAX_NOTIFICHE_PER_MESSAGGIO = 50 # notifiche raggruppate in un solo group_send
+NOTIFICHE_BATCH = 500 # notifiche prelevate dalla outbox per ogni giro del dispatcher
+NOTIFICHE_INTERVALLO_SECONDI = 5 # controllo periodico della outbox anche senza risvegli
 
 IBAN_LENGTH = 34
+MAX_WEBHOOK_EVENTO_ID_CHARS = 255
+MAX_WEBHOOK_TIPO_CHARS = 100
+WEBHOOK_BATCH = 100 # eventi PayPal prelevati dal registro per ogni giro del worker
+WEBHOOK_INTERVALLO_SECONDI = 1 # attesa del worker (elabora_webhook --continuo) con la coda vuota
+WEBHOOK_MAX_TENTATIVI = 5 # dopo tanti errori l'evento resta nel registro senza essere ritentato (elabora_webhook --ritenta-falliti)
+WEBHOOK_BACKOFF_SECONDI = 60 # attesa dopo il primo errore, raddoppia a ogni tentativo fallito
+PAYPAL_TIMEOUT_SECONDI = 10 # per ogni chiamata alle API PayPal (token e verifica della firma)
+PAYPAL_TOKEN_MARGINE_SECONDI = 60 # il token OAuth in cache si rinnova prima della scadenza indicata da PayPal
 
 MAX_IMG_SIZE = 5 * 1024 * 1024 #5MiB
 MAX_IMG_SIZE_HUMAN = "5MiB"
 MIN_IMG_ASPECT_RATIO = 0.5
 MAX_IMG_ASPECT_RATIO = 2.0
-
-MAX_ANNUNCI_PER_DETTAGLI_VALUE = 3
\ No newline at end of file
+IMG_VARIANTI_DIMENSIONI = [ # lato massimo in pixel
+    ("card", 400),
+    ("carosello", 1000),
+    ("full", 1920),
+]
+IMG_VARIANTI_FORMATI = [
+    ("webp", "WEBP"),
+    ("jpg", "JPEG"),
+]
+IMG_VARIANTI_QUALITA = 80
+
+MAX_ANNUNCI_PER_DETTAGLI_VALUE = 3
+
+MAX_IMG_BATCH_VALUE = 100
+FTS_TABELLA = "sylvelius_prodotto_fts"
+FTS_MIN_QUERY_CHARS = 3 # sotto i 3 caratteri il tokenizer trigram non trova nulla
+CARICAMENTO_BATCH = 1000 # record per bulk_create nel comando carica_dati
+CARICAMENTO_BLOCCO_CARATTERI = 64 * 1024 # letti dal file JSON per volta
+
+# Dati sintetici per i benchmark (comando genera_dati). Gli id partono da
+# GENERATORE_ID_BASE per non toccare quelli di dati.json
+GENERATORE_ID_BASE = 1000000
+GENERATORE_PROFILI = {
+    "piccolo": {"utenti": 100, "prodotti": 1000, "tag": 50, "ordini": 2000, "commenti": 2000, "notifiche": 2000},
+    "medio": {"utenti": 1000, "prodotti": 10000, "tag": 300, "ordini": 20000, "commenti": 20000, "notifiche": 20000},
+    "grande": {"utenti": 10000, "prodotti": 100000, "tag": 2000, "ordini": 200000, "commenti": 200000, "notifiche": 200000},
+}
+GENERATORE_ZIPF_ESPONENTE = 1.1 # popolarità di tag e prodotti
+GENERATORE_PASSWORD = "Benchmark01" # uguale per tutti gli utenti generati
+BENCHMARK_ARTICOLI_CARRELLO = 10 # articoli nel carrello dell'utente del benchmark
+BENCHMARK_RIPETIZIONI = 20
+STRUMENTAZIONE_SOGLIA_DUPLICATE = 5 # oltre, la richiesta si logga come warning con le query più ripetute
@@ -1,69 +1,76 @@
+import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from sylvelius.models import Annuncio, Tag
-from django.db.models import Q
-from progetto_tw.constants import MAX_WS_QUERIES
+from purchase.carrello import conteggio_carrello
+from sylvelius.notifiche import dispatcher
+from sylvelius.suggerimenti import indice_suggerimenti, indice_tag
+from progetto_tw.constants import MAX_WS_QUERIES, WS_DEBOUNCE_SECONDI
 
-class SearchConsumer(AsyncWebsocketConsumer):
+statistiche_ws = {'ricevute': 0, 'eseguite': 0, 'scartate': 0}
+
+class UltimaQueryConsumer(AsyncWebsocketConsumer):
+    # Per connessione si esegue solo l'ultima query ricevuta: i frame che arrivano
+    # durante l'attesa (WS_DEBOUNCE_SECONDI) o durante un'elaborazione sostituiscono
+    # quella in sospeso, e i risultati ormai superati non vengono inviati.
+    # Ogni risposta riporta la query a cui si riferisce.
     async def connect(self):
+        self.query_in_attesa = None
+        self.elaborazione = None
         await self.accept()
 
     async def disconnect(self, close_code):
-        pass
+        if self.elaborazione is not None:
+            self.elaborazione.cancel()
 
     async def receive(self, text_data):
         try:
-            data = json.loads(text_data)
-            query = data.get('query', '').strip()
-            
-            if query:
-                suggestions = await self.get_suggestions(query)
-            else:
-                suggestions = []
-
-            await self.send(text_data=json.dumps({
-                'suggestions': suggestions
-            }))
-        except Exception as e:
+            query = str(json.loads(text_data).get('query', '')).strip()
+        except (ValueError, AttributeError) as e:
             await self.send(text_data=json.dumps({
                 'error': str(e)
             }))
+            return
 
-    @database_sync_to_async
-    def get_suggestions(self, query):
-        regex = r'\b' + query  
-        annunci = Annuncio.objects.filter(
-            Q(prodotto__nome__iregex=regex),
-            is_published=True
-        ).order_by('prodotto__nome').select_related('prodotto')[:MAX_WS_QUERIES]
-        
-        return [annuncio.prodotto.nome for annuncio in annunci]
-
-class SearchTags(AsyncWebsocketConsumer):
-    async def connect(self):
-        await self.accept()
-
-    async def disconnect(self, close_code):
-        pass
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        query = data.get('query', '').strip()
-        suggestions = []
+        statistiche_ws['ricevute'] += 1
+        if self.query_in_attesa is not None:
+            statistiche_ws['scartate'] += 1
+        self.query_in_attesa = query
+        if self.elaborazione is None or self.elaborazione.done():
+            self.elaborazione = asyncio.create_task(self.elabora())
 
-        if query:
-            suggestions = await self.get_tags_by_query(query)
+    async def elabora(self):
+        while self.query_in_attesa is not None:
+            await asyncio.sleep(WS_DEBOUNCE_SECONDI)
+            query, self.query_in_attesa = self.query_in_attesa, None
+            statistiche_ws['eseguite'] += 1
+            try:
+                suggestions = await self.cerca(query) if query else []
+            except Exception as e:
+                await self.send(text_data=json.dumps({
+                    'query': query,
+                    'error': str(e)
+                }))
+                continue
+            if self.query_in_attesa is not None:
+                statistiche_ws['scartate'] += 1
+                continue
+            await self.send(text_data=json.dumps({
+                'query': query,
+                'suggestions': suggestions
+            }))
 
-        await self.send(text_data=json.dumps({
-            'suggestions': suggestions
-        }))
+class SearchConsumer(UltimaQueryConsumer):
+    async def cerca(self, query):
+        if indice_suggerimenti.da_costruire():
+            await database_sync_to_async(indice_suggerimenti.assicura_costruito)()
+        return indice_suggerimenti.cerca(query, MAX_WS_QUERIES)
 
-    @database_sync_to_async
-    def get_tags_by_query(self, query):
-        return list(
-            Tag.objects.filter(nome__icontains=query).values_list('nome', flat=True).order_by('nome')[:MAX_WS_QUERIES]
-        )
+class SearchTags(UltimaQueryConsumer):
+    async def cerca(self, query):
+        if indice_tag.da_costruire():
+            await database_sync_to_async(indice_tag.assicura_costruito)()
+        return indice_tag.cerca(query, MAX_WS_QUERIES)
     
 class GetNotifications(AsyncWebsocketConsumer):
     async def connect(self):
@@ -78,7 +85,11 @@ class GetNotifications(AsyncWebsocketConsumer):
             await self.channel_layer.group_add(self.personal_group, self.channel_name)#type: ignore
             await self.channel_layer.group_add(self.global_group, self.channel_name)#type: ignore
 
+            # Il dispatcher della outbox gira sul loop del processo che ha le connessioni
+            dispatcher.avvia()
             await self.accept()
+            # Stato iniziale del badge del carrello, poi solo gli aggiornamenti
+            await self.send_cart_count({'count': await database_sync_to_async(conteggio_carrello)(self.user.id)})
 
     async def disconnect(self, close_code):
         self.user = self.scope["user"]
@@ -94,3 +105,15 @@ class GetNotifications(AsyncWebsocketConsumer):
             'title': event['title'],
             'message': event['message']
         }))
+
+    async def send_notifications(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'notifications',
+            'notifiche': event['notifiche']
+        }))
+
+    async def send_cart_count(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'cart_count',
+            'count': event['count']
+        }))
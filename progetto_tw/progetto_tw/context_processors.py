@@ -1,7 +1,19 @@
+from types import MappingProxyType
+
 from . import constants
+from .permessi import is_moderatore
 
-def global_constants(request):
+def _costanti(modulo):
     return {
-        k: v for k, v in vars(constants).items()
+        k: v for k, v in vars(modulo).items()
         if k.isupper() and not k.startswith("_")
     }
+
+# Le costanti non cambiano a runtime: calcolate una volta, in sola lettura
+COSTANTI_GLOBALI = MappingProxyType(_costanti(constants))
+
+def global_constants(request):
+    return COSTANTI_GLOBALI
+
+def moderatore(request):
+    return {'is_moderator': is_moderatore(request)}
@@ -0,0 +1,124 @@
+import random
+import uuid
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+
+from .constants import (
+    GENERATORE_ID_BASE,
+    GENERATORE_PASSWORD,
+    GENERATORE_ZIPF_ESPONENTE,
+    ORDN_STATO_CONSEGNA_CHOICES,
+    PROD_CONDIZIONE_CHOICES_ID,
+)
+
+# Stesso formato di static/json/dati.json: i record si passano a CaricatoreDati
+# (o si scrivono su file) senza tenere in memoria l'intero dataset
+
+_OGGETTI = [
+    "pallone", "racchetta", "borraccia", "zaino", "tenda", "casco", "guanti", "scarpe",
+    "pinne", "maschera", "bicicletta", "tappetino", "manubri", "corda", "borsa", "giacca",
+]
+_AGGETTIVI = [
+    "leggero", "impermeabile", "professionale", "compatto", "termico", "regolabile",
+    "pieghevole", "resistente", "traspirante", "ergonomico",
+]
+_SPORT = [
+    "calcio", "tennis", "nuoto", "trekking", "ciclismo", "yoga", "palestra", "sci",
+    "surf", "corsa", "pesca", "campeggio", "boxe", "golf", "basket", "pallavolo",
+]
+_STATI_ORDINE = [stato for stato, _ in ORDN_STATO_CONSEGNA_CHOICES]
+
+def pesi_zipf(n, esponente=GENERATORE_ZIPF_ESPONENTE):
+    # Pesi cumulativi per random.choices: l'elemento di rango k ha peso 1/k^esponente
+    return list(accumulate(1 / k ** esponente for k in range(1, n + 1)))
+
+def _nome_tag(k):
+    giro, resto = divmod(k, len(_SPORT))
+    return _SPORT[resto] + (str(giro) if giro else "")
+
+def _coppie(rng, numero, sinistra, destra, pesi_destra):
+    # Coppie (indice a sinistra, indice a destra) distinte; si arrende dopo
+    # troppi doppioni se ne esistono meno di quelle chieste
+    if not sinistra or not destra:
+        return
+    viste = set()
+    destre = range(destra)
+    tentativi = 0
+    while len(viste) < numero and tentativi < numero * 10:
+        tentativi += 1
+        coppia = (rng.randrange(sinistra), rng.choices(destre, cum_weights=pesi_destra)[0])
+        if coppia not in viste:
+            viste.add(coppia)
+            yield coppia
+
+def genera_record(numero, seed=0, esponente=GENERATORE_ZIPF_ESPONENTE):
+    # numero: {"utenti": ..., "prodotti": ..., "tag": ..., "ordini": ..., "commenti": ..., "notifiche": ...}
+    # Stesso seed, stessi record
+    rng = random.Random(seed)
+    base = GENERATORE_ID_BASE
+
+    # Un solo hash per tutti: con PBKDF2 calcolarlo per utente costerebbe ore
+    password = make_password(GENERATORE_PASSWORD, salt=f"sintetici{seed}")
+    utenti = [f"bench{i:06d}" for i in range(numero['utenti'])]
+    for i, username in enumerate(utenti):
+        yield 'utenti', {'id': base + i, 'username': username, 'password_hash': password}
+
+    # Uso dei tag e popolarità dei prodotti con distribuzione di Zipf: pochi molto usati, lunga coda
+    tag = [_nome_tag(k) for k in range(numero['tag'])]
+    pesi_tag = pesi_zipf(len(tag), esponente)
+    for i in range(numero['prodotti']):
+        oggetto, aggettivo, sport = rng.choice(_OGGETTI), rng.choice(_AGGETTIVI), rng.choice(_SPORT)
+        yield 'prodotti', {
+            'id': base + i,
+            'nome': f"{oggetto.capitalize()} {aggettivo} da {sport}",
+            'descrizione_breve': f"{oggetto.capitalize()} {aggettivo}, ideale per {sport}.",
+            'descrizione': f"{oggetto.capitalize()} {aggettivo} per {sport}. Articolo {i}.",
+            'prezzo': f"{rng.uniform(1, 500):.2f}",
+            'condizione': rng.choice(PROD_CONDIZIONE_CHOICES_ID),
+            'tag': sorted(set(rng.choices(tag, cum_weights=pesi_tag, k=rng.randint(1, 4)))) if tag else [],
+            'immagini': [],
+        }
+
+    for i in range(numero['prodotti']):
+        yield 'annunci', {
+            'id': base + i,
+            'uuid': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'prodotto_id': base + i,
+            'inserzionista': rng.choice(utenti),
+            'qta_magazzino': 0 if rng.random() < 0.1 else rng.randint(1, 50),
+            'is_published': rng.random() < 0.9,
+        }
+
+    pesi_prodotti = pesi_zipf(numero['prodotti'], esponente)
+    for u, p in _coppie(rng, numero['ordini'], len(utenti), numero['prodotti'], pesi_prodotti):
+        yield 'ordini', {
+            'utente_username': utenti[u],
+            'prodotto_id': base + p,
+            'quantita': rng.randint(1, 5),
+            'stato_consegna': rng.choice(_STATI_ORDINE),
+            'luogo_consegna': {
+                'address_line_1': f"Via {rng.choice(_SPORT).capitalize()} {rng.randint(1, 200)}",
+                'admin_area_2': "Roma", 'admin_area_1': "RM", 'postal_code': "00184", 'country_code': "IT",
+            },
+        }
+
+    for u, p in _coppie(rng, numero['commenti'], len(utenti), numero['prodotti'], pesi_prodotti):
+        yield 'commenti', {
+            'annuncio_id': base + p,
+            'utente_username': utenti[u],
+            'testo': f"Commento {rng.randint(1, 1000000)}",
+            'rating': rng.randint(1, 5),
+            'data_commento': f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00Z",
+        }
+
+    for i in range(numero['notifiche']):
+        # Circa una su dieci globale
+        globale = rng.random() < 0.1
+        yield 'notifiche', {
+            'id': base + i,
+            'utente_username': None if globale else rng.choice(utenti),
+            'titolo': "Avviso" if globale else "Ordine",
+            'messaggio': f"Notifica di prova {i}",
+            'letta': rng.random() < 0.5,
+        }
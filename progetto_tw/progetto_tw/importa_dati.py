@@ -1,9 +1,20 @@
 import json
 import uuid
+from itertools import groupby, islice
+from operator import itemgetter
+
+from django.conf import settings
 from django.contrib.auth.models import User, Group
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.utils.dateparse import parse_datetime
 from sylvelius.models import Annuncio, CommentoAnnuncio, ImmagineProdotto, Ordine, Tag, Prodotto, Notification
+from sylvelius.ricerca import get_backend
+from sylvelius.suggerimenti import indice_suggerimenti, indice_tag
 from purchase.models import Invoice, Cart
-from progetto_tw.constants import _MODS_GRP_NAME
+from progetto_tw.constants import _MODS_GRP_NAME, CARICAMENTO_BATCH, CARICAMENTO_BLOCCO_CARATTERI
+
+DATI_JSON = settings.BASE_DIR / 'static' / 'json' / 'dati.json'
 
 def delete_db():
     ImmagineProdotto.objects.all().delete()
@@ -16,126 +27,352 @@ def delete_db():
     Notification.objects.all().delete()
     Cart.objects.all().delete()
 
-def init_db():
-    with open('static/json/dati.json', 'r', encoding='utf-8') as file:
-        dati = json.load(file)
-
-    for users in dati.get('utenti', []):
-        user, created = User.objects.get_or_create(
-            id=int(users['id']),
-            defaults={
-                'username': users['username'],
-            }
+class _LettoreJson:
+    # Legge un valore JSON alla volta da un file aperto, tenendo in memoria
+    # solo il blocco corrente e non l'intero documento
+    def __init__(self, file, blocco):
+        self.file = file
+        self.blocco = blocco
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def _leggi(self):
+        testo = self.file.read(self.blocco)
+        if not testo:
+            return False
+        self.buffer = self.buffer[self.pos:] + testo
+        self.pos = 0
+        return True
+
+    def prossimo(self):
+        # Primo carattere significativo, senza consumarlo ('' a fine file)
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._leggi():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def consuma(self, ammessi):
+        carattere = self.prossimo()
+        if not carattere or carattere not in ammessi:
+            raise ValueError(f"JSON non valido: atteso uno fra {ammessi!r}, trovato {carattere!r}")
+        self.pos += 1
+        return carattere
+
+    def valore(self):
+        self.prossimo()
+        while True:
+            try:
+                valore, fine = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Valore spezzato fra due blocchi: si legge il successivo e si riprova
+                if self._leggi():
+                    continue
+                raise
+            self.pos = fine
+            return valore
+
+def leggi_sezioni(file, blocco=CARICAMENTO_BLOCCO_CARATTERI):
+    # {"utenti": [...], "prodotti": [...], ...} -> coppie (sezione, record) in ordine di file
+    lettore = _LettoreJson(file, blocco)
+    lettore.consuma('{')
+    if lettore.prossimo() == '}':
+        return
+    while True:
+        sezione = lettore.valore()
+        lettore.consuma(':')
+        if lettore.prossimo() != '[':
+            lettore.valore()
+        else:
+            lettore.consuma('[')
+            if lettore.prossimo() == ']':
+                lettore.consuma(']')
+            else:
+                while True:
+                    yield sezione, lettore.valore()
+                    if lettore.consuma(',]') == ']':
+                        break
+        if lettore.consuma(',}') == '}':
+            return
+
+def scrivi_sezioni(record, file):
+    # Inverso di leggi_sezioni: scrive un record alla volta
+    file.write('{')
+    sezione = None
+    for nuova, dati in record:
+        if nuova != sezione:
+            if sezione is not None:
+                file.write('\n],')
+            file.write(f'\n{json.dumps(nuova)}: [\n')
+            sezione = nuova
+        else:
+            file.write(',\n')
+        file.write(json.dumps(dati, ensure_ascii=False))
+    file.write('\n]}\n' if sezione is not None else '}\n')
+
+def aggiorna_righe(modello, istanze, campi):
+    # Come bulk_update, che però per ogni campo costruisce un CASE WHEN con una
+    # clausola per riga: sui blocchi grandi compilarlo costa più dell'UPDATE.
+    # Qui un UPDATE parametrico eseguito con executemany.
+    if not istanze:
+        return
+    campi = [modello._meta.get_field(campo) for campo in campi]
+    quote = connection.ops.quote_name
+    assegnazioni = ', '.join(f'{quote(campo.column)} = %s' for campo in campi)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'UPDATE {quote(modello._meta.db_table)} SET {assegnazioni} WHERE {quote(modello._meta.pk.column)} = %s',
+            [[campo.get_db_prep_save(getattr(istanza, campo.attname), connection) for campo in campi] + [istanza.pk]
+             for istanza in istanze]
         )
 
-        if created:
-            user.set_password(users['password'])
-            user.save()
-        
-        mod = users.get('group')
-        if mod:
-            grp, _ = Group.objects.get_or_create(name=_MODS_GRP_NAME)
-            user.groups.add(grp)
-        
-        staff = users.get('staff')
-        if staff:
-            user.is_staff = True
-            user.is_superuser = True
-            user.save(force_update=True)
-    
-    # Importa Prodotti
-    for prodotto_data in dati.get('prodotti', []):
-        prodotto, created = Prodotto.objects.update_or_create(
-            id=prodotto_data['id'],
-            defaults={
-                'nome': prodotto_data['nome'],
-                'descrizione_breve': prodotto_data.get('descrizione_breve', ''),
-                'prezzo': prodotto_data['prezzo'],
-                'condizione' : prodotto_data['condizione']
-            }
+class CaricatoreDati:
+    # Le sezioni vanno lette nell'ordine del file: annunci, ordini e commenti
+    # cercano utenti, prodotti e annunci già caricati. Ogni blocco risolve le
+    # chiavi esterne con una query per tabella e scrive con bulk_create e UPDATE in blocco.
+    # Rieseguirlo sugli stessi dati non crea duplicati.
+    def __init__(self, batch=CARICAMENTO_BATCH):
+        self.batch = batch
+        self.prossimo_annuncio = 1
+        self.annunci_commentati = set()
+        self.conteggi = dict.fromkeys(('utenti', 'prodotti', 'annunci', 'ordini', 'commenti', 'notifiche'), 0)
+
+    def carica(self, record):
+        for sezione, gruppo in groupby(record, key=itemgetter(0)):
+            carica_blocco = getattr(self, f'_carica_{sezione}', None)
+            righe = map(itemgetter(1), gruppo)
+            while blocco := list(islice(righe, self.batch)):
+                if carica_blocco is not None:
+                    self.conteggi[sezione] += carica_blocco(blocco)
+        self._completa()
+        return self.conteggi
+
+    def _utenti_per_nome(self, nomi):
+        return dict(User.objects.filter(username__in=set(nomi)).values_list('username', 'id'))
+
+    def _prodotti_esistenti(self, ids):
+        return set(Prodotto.objects.filter(id__in=set(ids)).values_list('id', flat=True))
+
+    def _carica_utenti(self, blocco):
+        dati = {int(u['id']): u for u in blocco}
+        esistenti = User.objects.in_bulk(list(dati))
+        nuovi = []
+        for user_id, u in dati.items():
+            user = esistenti.get(user_id)
+            if user is None:
+                user = User(id=user_id, username=u['username'])
+                if 'password_hash' in u:
+                    # Già calcolato (es. dati sintetici): l'hash costa centinaia di ms per utente
+                    user.password = u['password_hash']
+                else:
+                    user.set_password(u['password'])
+                nuovi.append(user)
+            if u.get('staff'):
+                user.is_staff = True
+                user.is_superuser = True
+        User.objects.bulk_create(nuovi)
+        aggiorna_righe(
+            User,
+            [user for user in esistenti.values() if dati[user.id].get('staff')], ['is_staff', 'is_superuser']
         )
-        descr = prodotto_data.get('descrizione')
-        if descr:
-            prodotto.descrizione = descr
-            prodotto.save()
-
-        # Gestione dei tag
-        tag_names = prodotto_data.get('tag', [])
-        prodotto.tags.clear()
-        for tag_name in tag_names:
-            tag_obj, _ = Tag.objects.get_or_create(nome=tag_name.lower())
-            prodotto.tags.add(tag_obj)
-
-        # Gestione delle immagini
-        immagini = prodotto_data.get('immagini', []) or []
-        for img in immagini:
-            ImmagineProdotto.objects.get_or_create(
-                prodotto=prodotto,
-                immagine=img['immagine']
+
+        moderatori = [user_id for user_id, u in dati.items() if u.get('group')]
+        if moderatori:
+            grp, _ = Group.objects.get_or_create(name=_MODS_GRP_NAME)
+            User.groups.through.objects.bulk_create(
+                [User.groups.through(user_id=user_id, group=grp) for user_id in moderatori],
+                ignore_conflicts=True
             )
+        return len(dati)
 
-    # Importa Annunci
-    i = 1
-    for annuncio_data in dati.get('annunci', []):
-        try:
-            prodotto = Prodotto.objects.get(id=annuncio_data['prodotto_id'])
-        except Prodotto.DoesNotExist:
-            continue
-        
-        try:
-            inserzionista = User.objects.get(username=annuncio_data['inserzionista'])
-        except User.DoesNotExist:
-            continue
-
-        Annuncio.objects.update_or_create(
-            id=i,
-            uuid=uuid.uuid4(),
-            inserzionista=inserzionista,
-            prodotto=prodotto,
-            defaults={
-                'data_pubblicazione': annuncio_data.get('data_pubblicazione'),
-                'qta_magazzino': annuncio_data.get('qta_magazzino', 0),
-                'is_published': annuncio_data.get('is_published', True)
-            }
+    def _carica_prodotti(self, blocco):
+        dati = {p['id']: p for p in blocco}
+        Prodotto.objects.bulk_create(
+            [Prodotto(
+                id=prodotto_id,
+                nome=p['nome'],
+                descrizione_breve=p.get('descrizione_breve', ''),
+                descrizione=p.get('descrizione') or None,
+                prezzo=p['prezzo'],
+                condizione=p['condizione'],
+            ) for prodotto_id, p in dati.items()],
+            update_conflicts=True,
+            unique_fields=['id'],
+            update_fields=['nome', 'descrizione_breve', 'descrizione', 'prezzo', 'condizione'],
         )
-        i += 1
-
-    # Importa Ordini
-    for ordine_data in dati.get('ordini', []):
-        try:
-            utente = User.objects.get(username=ordine_data['utente_username'])
-        except User.DoesNotExist:
-            continue
-
-        try:
-            prodotto = Prodotto.objects.get(id=ordine_data['prodotto_id']) 
-        except Prodotto.DoesNotExist:
-            continue
-
-        Ordine.objects.update_or_create(
-            utente=utente,
-            prodotto=prodotto,
-            defaults={
-                'quantita': ordine_data['quantita'],
-                'stato_consegna': ordine_data['stato_consegna'],
-                'luogo_consegna': ordine_data['luogo_consegna']
-            }
+
+        # Tag: uno solo per nome, poi le righe della tabella ponte rifatte da capo
+        nomi = {p_id: {nome.lower() for nome in p.get('tag', [])} for p_id, p in dati.items()}
+        tutti = set().union(*nomi.values())
+        Tag.objects.bulk_create([Tag(nome=nome) for nome in tutti], ignore_conflicts=True)
+        tag_ids = dict(Tag.objects.filter(nome__in=tutti).values_list('nome', 'id'))
+        Ponte = Prodotto.tags.through
+        Ponte.objects.filter(prodotto_id__in=list(dati)).delete()
+        Ponte.objects.bulk_create([
+            Ponte(prodotto_id=p_id, tag_id=tag_ids[nome])
+            for p_id, tags in nomi.items() for nome in tags
+        ])
+
+        presenti = {
+            (p_id, immagine or '') for p_id, immagine in
+            ImmagineProdotto.objects.filter(prodotto_id__in=list(dati)).values_list('prodotto_id', 'immagine')
+        }
+        immagini = []
+        for p_id, p in dati.items():
+            for img in p.get('immagini', []) or []:
+                chiave = (p_id, img['immagine'] or '')
+                if chiave not in presenti:
+                    presenti.add(chiave)
+                    immagini.append(ImmagineProdotto(prodotto_id=p_id, immagine=img['immagine']))
+        ImmagineProdotto.objects.bulk_create(immagini)
+        return len(dati)
+
+    def _carica_annunci(self, blocco):
+        utenti = self._utenti_per_nome(a['inserzionista'] for a in blocco)
+        prodotti = self._prodotti_esistenti(a['prodotto_id'] for a in blocco)
+        annunci = []
+        for a in blocco:
+            if a['prodotto_id'] not in prodotti or a['inserzionista'] not in utenti:
+                continue
+            # Senza id esplicito gli annunci sono numerati da 1 in ordine di file
+            annuncio_id = a.get('id') or self.prossimo_annuncio
+            annunci.append(Annuncio(
+                id=annuncio_id,
+                uuid=a.get('uuid') or str(uuid.uuid4()),
+                inserzionista_id=utenti[a['inserzionista']],
+                prodotto_id=a['prodotto_id'],
+                qta_magazzino=a.get('qta_magazzino', 0),
+                is_published=a.get('is_published', True),
+            ))
+            self.prossimo_annuncio = annuncio_id + 1
+        # uuid e data di pubblicazione restano quelli della prima importazione
+        Annuncio.objects.bulk_create(
+            annunci,
+            update_conflicts=True,
+            unique_fields=['id'],
+            update_fields=['inserzionista', 'prodotto', 'qta_magazzino', 'is_published'],
         )
-    
-    for commenti_data in dati.get('commenti', []):
-        try:
-            annuncio = Annuncio.objects.get(id=commenti_data['annuncio_id'])
-            utente = User.objects.get(username=commenti_data['utente_username'])
-        except (Annuncio.DoesNotExist, User.DoesNotExist):
-            continue
-
-        commento, created = CommentoAnnuncio.objects.update_or_create(
-            annuncio=annuncio,
-            utente=utente,
-            defaults={
-                'testo': commenti_data['testo'],
-                'rating': commenti_data['rating']
-            }
+        return len(annunci)
+
+    def _aggiorna_o_crea(self, modello, chiavi, righe, campi):
+        # righe: {(chiave esterna, chiave esterna): istanza}, una per coppia.
+        # Le coppie già presenti si aggiornano, le altre si inseriscono.
+        filtro = {f'{campo}__in': {chiave[i] for chiave in righe} for i, campo in enumerate(chiavi)}
+        esistenti = {
+            tuple(riga[:-1]): riga[-1]
+            for riga in modello.objects.filter(**filtro).values_list(*chiavi, 'id')
+        }
+        nuovi, aggiornati = [], []
+        for chiave, istanza in righe.items():
+            if chiave in esistenti:
+                istanza.id = esistenti[chiave]
+                aggiornati.append(istanza)
+            else:
+                nuovi.append(istanza)
+        modello.objects.bulk_create(nuovi)
+        aggiorna_righe(modello, aggiornati, campi)
+        return len(righe)
+
+    def _carica_ordini(self, blocco):
+        utenti = self._utenti_per_nome(o['utente_username'] for o in blocco)
+        prodotti = self._prodotti_esistenti(o['prodotto_id'] for o in blocco)
+        righe = {}
+        for o in blocco:
+            if o['utente_username'] not in utenti or o['prodotto_id'] not in prodotti:
+                continue
+            utente_id = utenti[o['utente_username']]
+            righe[(utente_id, o['prodotto_id'])] = Ordine(
+                utente_id=utente_id,
+                prodotto_id=o['prodotto_id'],
+                quantita=o['quantita'],
+                stato_consegna=o['stato_consegna'],
+                luogo_consegna=o['luogo_consegna'],
+            )
+        return self._aggiorna_o_crea(
+            Ordine, ('utente_id', 'prodotto_id'), righe, ['quantita', 'stato_consegna', 'luogo_consegna']
+        )
+
+    def _carica_commenti(self, blocco):
+        utenti = self._utenti_per_nome(c['utente_username'] for c in blocco)
+        annunci = set(Annuncio.objects.filter(
+            id__in={c['annuncio_id'] for c in blocco}).values_list('id', flat=True))
+        righe = {}
+        date = {}
+        for c in blocco:
+            if c['annuncio_id'] not in annunci or c['utente_username'] not in utenti:
+                continue
+            chiave = (c['annuncio_id'], utenti[c['utente_username']])
+            righe[chiave] = CommentoAnnuncio(
+                annuncio_id=chiave[0],
+                utente_id=chiave[1],
+                testo=c['testo'],
+                rating=c['rating'],
+            )
+            date[chiave] = parse_datetime(c['data_commento']) if c.get('data_commento') else None
+        # bulk_create mette la data corrente (auto_now_add): quella del file si scrive dopo
+        caricati = self._aggiorna_o_crea(
+            CommentoAnnuncio, ('annuncio_id', 'utente_id'), righe, ['testo', 'rating']
         )
-        commento.data_pubblicazione = commenti_data.get('data_commento')
-        commento.save()
\ No newline at end of file
+        datati = []
+        for chiave, commento in righe.items():
+            if date[chiave] is not None:
+                commento.data_pubblicazione = date[chiave]
+                datati.append(commento)
+        aggiorna_righe(CommentoAnnuncio, datati, ['data_pubblicazione'])
+        self.annunci_commentati.update(annuncio_id for annuncio_id, _ in righe)
+        return caricati
+
+    def _carica_notifiche(self, blocco):
+        # Senza utente_username la notifica è globale. Sono già state inviate:
+        # il caricamento non le mette nella outbox del dispatcher
+        utenti = self._utenti_per_nome(n['utente_username'] for n in blocco if n.get('utente_username'))
+        notifiche = [
+            Notification(
+                id=n.get('id'),
+                recipient_id=utenti.get(n.get('utente_username')),
+                is_global=not n.get('utente_username'),
+                title=n['titolo'],
+                message=n['messaggio'],
+                read=n.get('letta', False),
+                inviata=True,
+            )
+            for n in blocco if not n.get('utente_username') or n['utente_username'] in utenti
+        ]
+        Notification.objects.bulk_create(
+            notifiche,
+            update_conflicts=True,
+            unique_fields=['id'],
+            update_fields=['recipient', 'is_global', 'title', 'message', 'read'],
+        )
+        return len(notifiche)
+
+    def _completa(self):
+        # bulk_create non invia i signals: rating, indice di ricerca e indici
+        # dei suggerimenti si aggiornano una volta sola alla fine
+        campi = ['rating_somma', 'rating_numero', 'rating_media']
+        aggregati = {
+            riga['annuncio_id']: (riga['somma'], riga['numero'])
+            for riga in CommentoAnnuncio.objects.filter(annuncio_id__in=self.annunci_commentati)
+                .values('annuncio_id').annotate(somma=Sum('rating'), numero=Count('id')).order_by()
+        }
+        annunci = list(Annuncio.objects.filter(id__in=list(aggregati)).only('id', *campi))
+        for annuncio in annunci:
+            somma, numero = aggregati[annuncio.id]
+            annuncio.rating_somma = somma
+            annuncio.rating_numero = numero
+            annuncio.rating_media = somma / numero
+        aggiorna_righe(Annuncio, annunci, campi)
+
+        get_backend().ricostruisci()
+        indice_suggerimenti.invalida()
+        indice_tag.invalida()
+
+def carica_dati(percorso=DATI_JSON, batch=CARICAMENTO_BATCH, reset=False):
+    with open(percorso, 'r', encoding='utf-8') as file, transaction.atomic():
+        if reset:
+            delete_db()
+        return CaricatoreDati(batch).carica(leggi_sezioni(file))
+
+def init_db():
+    return carica_dati()
@@ -1,7 +1,7 @@
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import resolve_url
 from django.core.exceptions import PermissionDenied
-from .constants import _MODS_GRP_NAME
+from .permessi import is_moderatore
 
 class CustomLoginRequiredMixin(LoginRequiredMixin):
     def get_login_url(self):
@@ -11,7 +11,7 @@ class CustomLoginRequiredMixin(LoginRequiredMixin):
 class ModeratoreAccessForbiddenMixin:
     def dispatch(self, request, *args, **kwargs):
         if request.user.is_authenticated:
-            if request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+            if is_moderatore(request):
                 raise PermissionDenied 
         # Se l'utente non è un moderatore, procedi normalmente
         return super().dispatch(request, *args, **kwargs) # type: ignore
\ No newline at end of file
@@ -0,0 +1,100 @@
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+# Paginazione keyset: al posto di OFFSET la pagina parte dall'ultima riga vista,
+# ordinando per (campo data, id) decrescenti. Il costo di una pagina non dipende
+# da quanto è profonda. Il cursore è opaco per il client (base64 di JSON).
+
+def codifica_cursore(valore, pk, avanti=True, numero=1):
+    dati = json.dumps([valore.isoformat(), pk, avanti, numero], separators=(',', ':'))
+    return base64.urlsafe_b64encode(dati.encode()).decode().rstrip('=')
+
+def decodifica_cursore(cursore):
+    # None se il cursore è assente o manomesso: si riparte dalla prima pagina
+    if not cursore:
+        return None
+    try:
+        valore, pk, avanti, numero = json.loads(base64.urlsafe_b64decode(cursore + '=' * (-len(cursore) % 4)))
+        valore = parse_datetime(valore)
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if valore is None or not isinstance(pk, int) or not isinstance(numero, int):
+        return None
+    return valore, pk, bool(avanti), max(numero, 1)
+
+def filtro_keyset(campo, valore, pk, avanti=True):
+    # Righe successive (più vecchie) o precedenti (più recenti) rispetto a (valore, pk)
+    confronto = 'lt' if avanti else 'gt'
+    return Q(**{f'{campo}__{confronto}': valore}) | Q(**{campo: valore, f'id__{confronto}': pk})
+
+def valore_keyset(riga, campo):
+    if isinstance(riga, dict):
+        return riga[campo], riga['id']
+    return getattr(riga, campo), riga.pk
+
+class PaginaKeyset:
+    # Stessa interfaccia usata dalle view con django.core.paginator.Page
+    def __init__(self, object_list, number, successiva, precedente):
+        self.object_list = object_list
+        self.number = number
+        self.cursore_successivo = successiva
+        self.cursore_precedente = precedente
+
+    def has_next(self):
+        return self.cursore_successivo is not None
+
+    def has_previous(self):
+        return self.cursore_precedente is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+class PaginatorKeyset:
+    def __init__(self, queryset, campo, per_pagina):
+        self.queryset = queryset
+        self.campo = campo
+        self.per_pagina = per_pagina
+
+    def _righe(self, filtro, avanti):
+        ordine = (f'-{self.campo}', '-id') if avanti else (self.campo, 'id')
+        queryset = self.queryset.order_by(*ordine)
+        if filtro is not None:
+            queryset = queryset.filter(filtro)
+        # Una riga in più dice se esiste un'altra pagina in quella direzione
+        righe = list(queryset[:self.per_pagina + 1])
+        return righe[:self.per_pagina], len(righe) > self.per_pagina
+
+    def _cursore(self, riga, avanti, numero):
+        return codifica_cursore(*valore_keyset(riga, self.campo), avanti=avanti, numero=numero)
+
+    def get_page(self, cursore=None):
+        posizione = decodifica_cursore(cursore)
+        if posizione is not None:
+            valore, pk, avanti, numero = posizione
+            righe, altre = self._righe(filtro_keyset(self.campo, valore, pk, avanti), avanti)
+            if righe:
+                if avanti:
+                    numero, ci_sono_successive, ci_sono_precedenti = numero + 1, altre, True
+                else:
+                    righe.reverse()
+                    numero, ci_sono_successive, ci_sono_precedenti = max(numero - 1, 1), True, altre
+                return self._pagina(righe, numero, ci_sono_successive, ci_sono_precedenti)
+        righe, altre = self._righe(None, True)
+        return self._pagina(righe, 1, altre, False)
+
+    def _pagina(self, righe, numero, ci_sono_successive, ci_sono_precedenti):
+        # Se non ci sono precedenti è comunque la prima pagina
+        numero = numero if ci_sono_precedenti else 1
+        return PaginaKeyset(
+            righe,
+            numero,
+            self._cursore(righe[-1], True, numero) if ci_sono_successive else None,
+            self._cursore(righe[0], False, numero) if ci_sono_precedenti else None,
+        )
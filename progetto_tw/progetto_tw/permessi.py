@@ -0,0 +1,12 @@
+from .constants import _MODS_GRP_NAME
+
+def is_moderatore(request):
+    # Una sola query sui gruppi per richiesta, poi il valore resta su request.is_moderator.
+    # Niente copia in sessione: verificarne la validità in ogni processo costerebbe
+    # comunque una query, e così un gruppo tolto vale dalla richiesta successiva.
+    user = request.user
+    if getattr(request, '_moderatore_di', False) == user.pk:
+        return request.is_moderator
+    request._moderatore_di = user.pk
+    request.is_moderator = user.is_authenticated and user.groups.filter(name=_MODS_GRP_NAME).exists()
+    return request.is_moderator
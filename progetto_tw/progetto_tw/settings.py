@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'sylvelius.middlewares.StrumentazioneMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,9 +55,24 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'sylvelius.middlewares.AllowPopupCrossOriginMiddleware',
+    'sylvelius.middlewares.ModeratoreMiddleware',
 ]
 
+# Query, tempo SQL e di render per richiesta (header Server-Timing e log), vedi StrumentazioneMiddleware
+STRUMENTAZIONE = os.getenv('STRUMENTAZIONE') == '1'
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "sylvelius.strumentazione": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
+
 ROOT_URLCONF = 'progetto_tw.urls'
+TEST_RUNNER = 'progetto_tw.testing.DatiRunner'
 LOGIN_URL = "/login/?auth=error"
 LOGIN_REDIRECT_URL = '/account/profilo/'
 
@@ -73,6 +89,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'progetto_tw.context_processors.global_constants',
+                'progetto_tw.context_processors.moderatore',
             ],
         },
     },
@@ -81,21 +98,46 @@ TEMPLATES = [
 WSGI_APPLICATION = 'progetto_tw.wsgi.application'
 ASGI_APPLICATION = 'progetto_tw.asgi.application'
 
-CHANNEL_LAYERS = {
-    "default": {
-    "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Channel layer: in memoria di default (un solo processo). Con CHANNEL_LAYER_URL
+# (es. redis://localhost:6379/0) i worker Daphne condividono gruppi e notifiche via Redis;
+# il layer pub/sub pubblica un solo messaggio per group_send, anche per il gruppo "global".
+CHANNEL_LAYER_URL = os.getenv('CHANNEL_LAYER_URL')
+if CHANNEL_LAYER_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": [CHANNEL_LAYER_URL],
+                "prefix": "sylvelius",
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
     }
-}
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Le transazioni prendono il lock di scrittura all'inizio (BEGIN IMMEDIATE): con più
+# richieste che scrivono insieme (es. webhook PayPal) le altre aspettano fino a
+# "timeout" secondi invece di fallire con "database is locked" a metà transazione
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
+# Backend della ricerca testuale (sylvelius.ricerca.BackendOrm per il vecchio icontains)
+RICERCA_BACKEND = 'sylvelius.ricerca.BackendFts5'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -148,4 +190,5 @@ MEDIA_URL = '/media/'
 PAYPAL_TEST = True  # Usa l'ambiente sandbox per i test
 PAYPAL_CLIENT_ID= os.getenv('PAYPAL_CLIENT_ID')
 PAYPAL_SECRET= os.getenv('PAYPAL_SECRET')
-PAYPAL_COA_ID = os.getenv('PAYPAL_COA_ID')
\ No newline at end of file
+PAYPAL_COA_ID = os.getenv('PAYPAL_COA_ID')
+PAYPAL_API_BASE = os.getenv('PAYPAL_API_BASE', 'https://api-m.sandbox.paypal.com')
\ No newline at end of file
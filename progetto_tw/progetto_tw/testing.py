@@ -0,0 +1,35 @@
+from django.core.management import call_command
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+
+class DatiRunner(DiscoverRunner):
+    # I test si aspettano i dati di static/json/dati.json nel database di test.
+    # Con --parallel i cloni dei worker si creano solo dopo il caricamento dei dati
+    def setup_databases(self, **kwargs):
+        parallel, self.parallel = self.parallel, 1
+        try:
+            old_config = super().setup_databases(**kwargs)
+        finally:
+            self.parallel = parallel
+        call_command('carica_dati', verbosity=0)
+        if parallel > 1:
+            for conn, _, principale in old_config:
+                if not principale:
+                    continue
+                for index in range(parallel):
+                    conn.creation.clone_test_db(suffix=str(index + 1), verbosity=self.verbosity, keepdb=self.keepdb)
+        return old_config
+
+class QueryBudgetMixin:
+    # Da usare insieme a django.test.TestCase
+    def assertQueryBudget(self, budget, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data) # type: ignore
+        eseguite = len(queries.captured_queries)
+        if eseguite > budget:
+            elenco = "\n".join(
+                f"{i}. {query['sql']}" for i, query in enumerate(queries.captured_queries, start=1)
+            )
+            self.fail(f"{url} ha eseguito {eseguite} query, budget {budget}:\n{elenco}") # type: ignore
+        return response, eseguite
@@ -1,6 +1,5 @@
 from django.contrib import admin
 from django.urls import path, include
-from .importa_dati import init_db, delete_db
 from django.conf import settings
 from django.conf.urls.static import static
 
@@ -10,6 +9,3 @@ urlpatterns = [
     path('spedizione/', include("shipping.urls")),
     path('admin/', admin.site.urls),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) # DA RIMUOVERE IN PRODUZIONE
-
-delete_db()
-init_db()
\ No newline at end of file
@@ -1,7 +1,8 @@
 from django.contrib import admin
-from .models import Invoice, Iban, Cart
+from .models import Invoice, Iban, Cart, WebhookEvento
 
 # Register your models here.
 admin.site.register(Invoice)
 admin.site.register(Iban)
-admin.site.register(Cart)
\ No newline at end of file
+admin.site.register(Cart)
+admin.site.register(WebhookEvento)
\ No newline at end of file
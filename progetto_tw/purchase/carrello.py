@@ -0,0 +1,50 @@
+import threading
+import weakref
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+# Numero di righe del carrello per il badge, contato dal database a ogni richiesta:
+# le righe cambiano anche in altri processi (es. il worker dei webhook).
+# Il valore aggiornato arriva alle pagine aperte sul WebSocket delle notifiche
+# (gruppo user_<id>), che lo invia anche alla connessione: niente richieste a /api/cart_check/.
+
+def conteggio_carrello(user_id):
+    from .models import Invoice
+
+    return Invoice.objects.filter(cart__utente_id=user_id).count()
+
+def invia_conteggio_carrello(user_id):
+    async_to_sync(get_channel_layer().group_send)( #type: ignore
+        f"user_{user_id}", {"type": "send_cart_count", "count": conteggio_carrello(user_id)}
+    )
+
+class _InvioConteggio:
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def __call__(self):
+        if _locale.in_attesa.get(self.user_id) is self:
+            del _locale.in_attesa[self.user_id]
+        invia_conteggio_carrello(self.user_id)
+
+class _Locale(threading.local):
+    def __init__(self):
+        # Riferimenti deboli: se la transazione viene annullata Django scarta il
+        # callback e l'utente esce da solo dagli invii in attesa
+        self.in_attesa = weakref.WeakValueDictionary()
+
+_locale = _Locale()
+
+def carrello_modificato(user_id):
+    # Il conteggio si ricalcola e si invia dopo il commit, così le pagine non vedono
+    # righe di una transazione poi annullata; se il channel layer non risponde
+    # la richiesta non fallisce, il badge si riallinea alla prossima connessione.
+    # Svuotare un carrello cancella una riga alla volta dentro la stessa transazione:
+    # un solo invio per utente, anche se il segnale arriva più volte.
+    if user_id in _locale.in_attesa:
+        return
+    invio = _InvioConteggio(user_id)
+    _locale.in_attesa[user_id] = invio
+    transaction.on_commit(invio, robust=True)
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:04
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchase', '0010_remove_invoice_is_locked'),
+        ('sylvelius', '0036_indici_composti'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['cart', 'prodotto'], name='invoice_carrello_prodotto_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchase', '0011_indici_composti'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvento',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('evento_id', models.CharField(max_length=255, unique=True)),
+                ('tipo', models.CharField(max_length=100)),
+                ('payload', models.JSONField()),
+                ('ricevuto', models.DateTimeField(auto_now_add=True)),
+                ('elaborato', models.DateTimeField(blank=True, null=True)),
+                ('esito', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('tentativi', models.PositiveSmallIntegerField(default=0)),
+                ('errore', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'verbose_name_plural': 'Eventi webhook',
+                'indexes': [models.Index(fields=['elaborato', 'id'], name='webhook_coda_idx')],
+            },
+        ),
+    ]
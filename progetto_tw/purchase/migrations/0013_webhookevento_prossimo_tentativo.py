@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchase', '0012_webhookevento'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookevento',
+            name='prossimo_tentativo',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
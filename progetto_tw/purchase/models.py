@@ -1,5 +1,12 @@
 from django.db import models
-from progetto_tw.constants import MAX_ORDN_INVOICE_CHARS, IBAN_LENGTH
+from django.db.models import DecimalField, F, Sum
+from progetto_tw.constants import (
+    IBAN_LENGTH,
+    MAX_ORDN_INVOICE_CHARS,
+    MAX_PROD_PREZZO_DIGITS_DECIMAL,
+    MAX_WEBHOOK_EVENTO_ID_CHARS,
+    MAX_WEBHOOK_TIPO_CHARS,
+)
 from sylvelius.models import Prodotto
 
 # Create your models here.
@@ -10,6 +17,11 @@ class Invoice(models.Model):
     prodotto = models.ForeignKey(Prodotto, on_delete=models.CASCADE, related_name='invoices', null=True)
     cart = models.ForeignKey('Cart', on_delete=models.CASCADE, related_name='invoices', null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['cart', 'prodotto'], name='invoice_carrello_prodotto_idx'),
+        ]
+
     @property
     def total(self):
         return self.prodotto.prezzo * self.quantita # type: ignore
@@ -33,8 +45,34 @@ class Cart(models.Model):
 
     @property
     def total(self):
-        invoices = self.invoices.select_related('prodotto').all() #type:ignore
-        return sum(invoice.total for invoice in invoices)
+        # Somma calcolata dal database, arrotondata ai centesimi come i prezzi
+        totale = self.invoices.aggregate(totale=Sum( #type:ignore
+            F('quantita') * F('prodotto__prezzo'),
+            output_field=DecimalField(max_digits=MAX_PROD_PREZZO_DIGITS_DECIMAL[0] * 2,
+                                      decimal_places=MAX_PROD_PREZZO_DIGITS_DECIMAL[1])
+        ))['totale']
+        return totale if totale is not None else 0
     
     def __str__(self):
-        return "Carrello di " + self.utente.username
\ No newline at end of file
+        return "Carrello di " + self.utente.username
+
+class WebhookEvento(models.Model):
+    # Registro degli eventi PayPal: la view li salva, il worker li elabora una volta sola
+    evento_id = models.CharField(max_length=MAX_WEBHOOK_EVENTO_ID_CHARS, unique=True)
+    tipo = models.CharField(max_length=MAX_WEBHOOK_TIPO_CHARS)
+    payload = models.JSONField()
+    ricevuto = models.DateTimeField(auto_now_add=True)
+    elaborato = models.DateTimeField(null=True, blank=True)
+    esito = models.PositiveSmallIntegerField(null=True, blank=True) # status HTTP della vecchia risposta sincrona
+    tentativi = models.PositiveSmallIntegerField(default=0)
+    prossimo_tentativo = models.DateTimeField(null=True, blank=True) # dopo un errore, prima non si ritenta
+    errore = models.TextField(blank=True, default='')
+
+    class Meta:
+        verbose_name_plural = "Eventi webhook"
+        indexes = [
+            models.Index(fields=['elaborato', 'id'], name='webhook_coda_idx'),
+        ]
+
+    def __str__(self):
+        return self.tipo + " - " + self.evento_id
@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .carrello import carrello_modificato
+from .models import Cart, Invoice
+
+@receiver(post_save, sender=Invoice)
+def riga_aggiunta(sender, instance, created, **kwargs):
+    # Le modifiche di quantità non cambiano il numero di righe
+    if created and instance.cart_id is not None:
+        carrello_modificato(instance.utente_id)
+
+@receiver(post_delete, sender=Invoice)
+def riga_rimossa(sender, instance, **kwargs):
+    if instance.cart_id is not None:
+        carrello_modificato(instance.utente_id)
+
+@receiver(post_delete, sender=Cart)
+def carrello_rimosso(sender, instance, **kwargs):
+    carrello_modificato(instance.utente_id)
@@ -1,17 +1,35 @@
 import json
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 
 import requests
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
 from django.contrib.auth.models import Group, User
 from django.core.exceptions import ValidationError
-from django.test import Client, RequestFactory, TestCase
+from decimal import Decimal
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from sylvelius.models import Annuncio, Ordine, Prodotto, Tag
+from django.utils import timezone
+from sylvelius.models import Annuncio, Notification, Ordine, Prodotto, Tag
 from unittest.mock import MagicMock, patch
 
-from progetto_tw.constants import _MODS_GRP_NAME, _NEXT_PROD_ID
-from .models import Cart, Iban, Invoice
+from progetto_tw.constants import (
+    _MODS_GRP_NAME, _NEXT_PROD_ID, PAYPAL_TIMEOUT_SECONDI, WEBHOOK_BACKOFF_SECONDI, WEBHOOK_MAX_TENTATIVI
+)
+from progetto_tw.consumers import GetNotifications
+from sylvelius.notifiche import dispatcher
+from .models import Cart, Iban, Invoice, WebhookEvento
 from .views import SetupIban, get_paypal_access_token, verify_paypal_webhook
+from .webhook import chiave_evento, elabora_eventi, eventi_in_coda, ritenta_falliti
 
 # Create your tests here.
 class AnonUrls(TestCase):
@@ -187,6 +205,7 @@ class PayPalCOATests(TestCase):
         )
 
         self.assertEqual(response.status_code, 200)
+        elabora_eventi()
         self.assertTrue(Ordine.objects.exists())
         self.assertEqual(Ordine.objects.first().stato_consegna, "da spedire")#type: ignore
         self.annuncio.refresh_from_db()
@@ -226,6 +245,7 @@ class PayPalCOATests(TestCase):
         )
 
         self.assertEqual(response.status_code, 200)
+        elabora_eventi()
         ordine = Ordine.objects.first()
         self.assertEqual(ordine.stato_consegna, "annullato")#type: ignore
 
@@ -320,7 +340,9 @@ class PayPalCOATests(TestCase):
             HTTP_X_PAYPAL_SIGNATURE='dummy-signature'
         )
 
-        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(elabora_eventi(), 1)
+        self.assertEqual(WebhookEvento.objects.get(payload__resource__purchase_units__0__invoice_id='INV-err').esito, 404)
         
         Annuncio.objects.filter(prodotto=self.invoice.prodotto).delete()
         payload = {
@@ -351,6 +373,7 @@ class PayPalCOATests(TestCase):
         )
 
         self.assertEqual(response.status_code, 200)
+        elabora_eventi()
 
     @patch('purchase.views.verify_paypal_webhook', return_value=True)
     def test_checkout_order_approved_with_cart(self, mock_verify):
@@ -403,6 +426,7 @@ class PayPalCOATests(TestCase):
         )
 
         self.assertEqual(response.status_code, 200)
+        elabora_eventi()
         
         self.assertEqual(Ordine.objects.count(), 2)
         
@@ -454,6 +478,7 @@ class PayPalCOATests(TestCase):
         )
 
         self.assertEqual(response.status_code, 200)
+        elabora_eventi()
         
         ordine = Ordine.objects.first()
         self.assertEqual(ordine.stato_consegna, "annullato")#type: ignore
@@ -493,11 +518,306 @@ class PayPalCOATests(TestCase):
         )
 
         self.assertEqual(response.status_code, 200)
+        elabora_eventi()
         # Nessun ordine dovrebbe essere creato
         self.assertFalse(Ordine.objects.exists())
 
+def payload_coa(invoice_id, evento_id=None):
+    return json.dumps({
+        **({"id": evento_id} if evento_id else {}),
+        "event_type": "CHECKOUT.ORDER.APPROVED",
+        "resource": {"purchase_units": [{
+            "invoice_id": invoice_id,
+            "shipping": {"address": {
+                "address_line_1": "123 Test St", "admin_area_2": "Test City",
+                "admin_area_1": "TS", "postal_code": "12345", "country_code": "IT"
+            }}
+        }]}
+    })
+
+class PayPalCOAQueryTests(TestCase):
+    def setUp(self):
+        self.venditore = User.objects.create_user(username='qzvenditorecoa', password='Testpass0')
+
+    def carrello(self, righe):
+        compratore = User.objects.create_user(username=f'qzcompratorecoa{righe}', password='Testpass0')
+        cart = Cart.objects.create(uuid=str(uuid.uuid4()), utente=compratore)
+        for i in range(righe):
+            prodotto = Prodotto.objects.create(nome=f'qzcoa {righe} {i}', descrizione_breve='qz', prezzo=5.0)
+            Annuncio.objects.create(prodotto=prodotto, inserzionista=self.venditore, qta_magazzino=3)
+            Invoice.objects.create(uuid=str(uuid.uuid4()), utente=compratore, prodotto=prodotto, quantita=1, cart=cart)
+        return cart
+
+    @patch('purchase.views.verify_paypal_webhook', return_value=True)
+    def test_carrello_senza_scritture_per_riga(self, mock_verify):
+        def regola(cart):
+            response = self.client.post('/pagamento/paypal/coa/', data=payload_coa(cart.uuid),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(elabora_eventi(), 1)
+            return len(queries.captured_queries)
+
+        pochi = regola(self.carrello(2))
+        molti = regola(self.carrello(12))
+        # Solo l'UPDATE condizionale delle scorte cresce con le righe
+        self.assertEqual(molti - pochi, 10)
+        compratori = User.objects.filter(username__startswith='qzcompratorecoa')
+        self.assertEqual(Ordine.objects.filter(utente__in=compratori, stato_consegna='da spedire').count(), 14)
+        self.assertFalse(Invoice.objects.filter(utente__in=compratori).exists())
+        self.assertEqual(Notification.objects.filter(title='Un utente ha acquistato!', recipient=self.venditore).count(), 14)
+
+    @patch('purchase.views.verify_paypal_webhook', return_value=True)
+    def test_indirizzo_mancante_nessuna_scrittura(self, mock_verify):
+        cart = self.carrello(2)
+        payload = json.loads(payload_coa(cart.uuid))
+        del payload['resource']['purchase_units'][0]['shipping']['address']
+        response = self.client.post('/pagamento/paypal/coa/', data=json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvento.objects.exists())
+        self.assertEqual(cart.invoices.count(), 2) #type: ignore
+        self.assertFalse(Ordine.objects.filter(utente=cart.utente).exists())
+        self.assertFalse(Annuncio.objects.filter(inserzionista=self.venditore).exclude(qta_magazzino=3).exists())
+
+    @patch('purchase.views.verify_paypal_webhook', return_value=True)
+    def test_annullato_non_confermato(self, mock_verify):
+        cart = self.carrello(1)
+        Annuncio.objects.filter(inserzionista=self.venditore).update(qta_magazzino=0)
+        self.client.post('/pagamento/paypal/coa/', data=payload_coa(cart.uuid), content_type='application/json')
+        elabora_eventi()
+        self.assertEqual(Ordine.objects.get(utente=cart.utente).stato_consegna, 'annullato')
+        titoli = set(Notification.objects.filter(recipient__in=[cart.utente, self.venditore]).values_list('title', flat=True))
+        self.assertEqual(titoli, {'Acquisto Annullato'})
+
+class PayPalCOAConcorrenzaTests(TransactionTestCase):
+    # Webhook e worker paralleli da thread diversi, ognuno con la sua connessione al database.
+    # Il database in memoria dei test rifiuta le scritture concorrenti invece di aspettare:
+    # come PayPal i webhook rifiutati vengono ripetuti, e i worker riprovano gli eventi
+    SCORTE = 10
+    COMPRATORI = 25
+    THREAD = 8
+
+    def setUp(self):
+        venditore = User.objects.create(username='qzvenditorestress')
+        self.prodotto = Prodotto.objects.create(nome='qzstress', descrizione_breve='qz', prezzo=5.0)
+        self.annuncio = Annuncio.objects.create(prodotto=self.prodotto, inserzionista=venditore, qta_magazzino=self.SCORTE)
+        self.carrelli = []
+        for i in range(self.COMPRATORI):
+            compratore = User.objects.create(username=f'qzcompratorestress{i}')
+            cart = Cart.objects.create(uuid=str(uuid.uuid4()), utente=compratore)
+            Invoice.objects.create(uuid=str(uuid.uuid4()), utente=compratore, prodotto=self.prodotto, quantita=1, cart=cart)
+            self.carrelli.append(cart.uuid)
+
+    def in_parallelo(self, funzione, argomenti):
+        partenza = threading.Barrier(self.THREAD)
+
+        def esegui(argomento):
+            try:
+                partenza.wait(timeout=5)
+            except threading.BrokenBarrierError:
+                pass
+            try:
+                return funzione(argomento)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=self.THREAD) as pool:
+            return list(pool.map(esegui, argomenti))
+
+    @patch('purchase.webhook.logger')
+    @patch('purchase.webhook.WEBHOOK_MAX_TENTATIVI', 1000)
+    @patch('purchase.webhook.WEBHOOK_BACKOFF_SECONDI', 0)
+    @patch('django.core.handlers.exception.log_response')
+    @patch('purchase.views.verify_paypal_webhook', return_value=True)
+    def test_nessuna_vendita_oltre_le_scorte(self, mock_verify, mock_log, mock_logger):
+        def webhook(consegna):
+            client = Client(raise_request_exception=False)
+            for _ in range(200):
+                stato = client.post('/pagamento/paypal/coa/', data=payload_coa(*consegna),
+                                    content_type='application/json').status_code
+                if stato == 200:
+                    return stato
+                time.sleep(0.01)
+            return stato
+
+        def worker(_):
+            for _ in range(500):
+                try:
+                    elabora_eventi()
+                    if not eventi_in_coda():
+                        return
+                except OperationalError:
+                    pass
+                time.sleep(0.01)
+
+        # Ogni pagamento consegnato due volte con lo stesso id evento, più un
+        # secondo evento distinto per lo stesso carrello
+        consegne = [(cart, f'WH-{i}') for i, cart in enumerate(self.carrelli)]
+        consegne += consegne + [(cart, f'WH-{i}-bis') for i, cart in enumerate(self.carrelli)]
+        self.assertEqual(set(self.in_parallelo(webhook, consegne)), {200})
+        self.assertEqual(WebhookEvento.objects.count(), 2 * self.COMPRATORI)
+        self.assertFalse(Ordine.objects.filter(prodotto=self.prodotto).exists())
+
+        self.in_parallelo(worker, range(self.THREAD))
+        self.assertFalse(WebhookEvento.objects.filter(elaborato__isnull=True).exists())
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.qta_magazzino, 0)
+        ordini = Ordine.objects.filter(prodotto=self.prodotto)
+        self.assertEqual(ordini.count(), self.COMPRATORI)
+        self.assertEqual(ordini.filter(stato_consegna='da spedire').count(), self.SCORTE)
+        self.assertEqual(ordini.filter(stato_consegna='annullato').count(), self.COMPRATORI - self.SCORTE)
+        self.assertFalse(Invoice.objects.filter(prodotto=self.prodotto).exists())
+
+class FakePayPal(ThreadingHTTPServer):
+    # API PayPal finta su localhost: token OAuth e verifica della firma dei webhook.
+    # La firma è valida se vale FIRMA_VALIDA; ogni richiesta ricevuta resta in self.richieste
+    FIRMA_VALIDA = 'firma-valida'
+
+    def __init__(self):
+        self.richieste = []
+        super().__init__(('127.0.0.1', 0), FakePayPalHandler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+class FakePayPalHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        corpo = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.richieste.append(self.path) #type: ignore
+        if self.path == '/v1/oauth2/token':
+            risposta = {"access_token": "token-finto", "expires_in": 3600}
+        elif self.path == '/v1/notifications/verify-webhook-signature':
+            firma = json.loads(corpo).get('transmission_sig')
+            risposta = {"verification_status": "SUCCESS" if firma == FakePayPal.FIRMA_VALIDA else "FAILURE"}
+        else:
+            self.send_error(404)
+            return
+        dati = json.dumps(risposta).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(dati)))
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def log_message(self, format, *args):
+        pass
+
+class WebhookRegistroTests(TestCase):
+    def setUp(self):
+        self.paypal = FakePayPal()
+        threading.Thread(target=self.paypal.serve_forever, daemon=True).start()
+        self.override = override_settings(PAYPAL_API_BASE=self.paypal.url, PAYPAL_COA_ID='WH-COA')
+        self.override.enable()
+        cache.clear()
+        venditore = User.objects.create_user(username='qzvenditorewh', password='Testpass0')
+        self.user = User.objects.create_user(username='qzcompratorewh', password='Testpass0')
+        prodotto = Prodotto.objects.create(nome='qzwebhook', descrizione_breve='qz', prezzo=5.0)
+        self.annuncio = Annuncio.objects.create(prodotto=prodotto, inserzionista=venditore, qta_magazzino=5)
+        self.cart = Cart.objects.create(uuid=str(uuid.uuid4()), utente=self.user)
+        Invoice.objects.create(uuid=str(uuid.uuid4()), utente=self.user, prodotto=prodotto, quantita=2, cart=self.cart)
+
+    def tearDown(self):
+        self.override.disable()
+        self.paypal.shutdown()
+        self.paypal.server_close()
+
+    def consegna(self, evento_id, firma=FakePayPal.FIRMA_VALIDA, invoice_id=None):
+        return self.client.post(
+            '/pagamento/paypal/coa/', data=payload_coa(invoice_id or self.cart.uuid, evento_id),
+            content_type='application/json',
+            HTTP_PAYPAL_TRANSMISSION_ID=str(uuid.uuid4()), HTTP_PAYPAL_TRANSMISSION_SIG=firma
+        )
+
+    def test_consegne_ripetute_elaborate_una_volta(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.consegna('WH-1').status_code, 200)
+        # Verifica della firma e INSERT nel registro, il pagamento lo regola il worker
+        self.assertFalse(any('purchase_invoice' in q['sql'] for q in queries.captured_queries))
+        self.assertFalse(Ordine.objects.filter(utente=self.user).exists())
+
+        for _ in range(3):
+            self.assertEqual(self.consegna('WH-1').status_code, 200)
+        self.assertEqual(self.paypal.richieste.count('/v1/notifications/verify-webhook-signature'), 4)
+        # Il token OAuth si chiede una volta e resta in cache fino alla scadenza
+        self.assertEqual(self.paypal.richieste.count('/v1/oauth2/token'), 1)
+        evento = WebhookEvento.objects.get()
+        self.assertEqual((evento.evento_id, evento.tipo, evento.elaborato), ('WH-1', 'CHECKOUT.ORDER.APPROVED', None))
+
+        self.assertEqual(elabora_eventi(), 1)
+        self.assertEqual(elabora_eventi(), 0)
+        evento.refresh_from_db()
+        self.assertEqual(evento.esito, 200)
+        self.assertIsNotNone(evento.elaborato)
+        self.assertEqual(Ordine.objects.filter(utente=self.user).count(), 1)
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.qta_magazzino, 3)
+
+        # Consegna dopo l'elaborazione: ancora nessun effetto
+        self.assertEqual(self.consegna('WH-1').status_code, 200)
+        self.assertEqual(elabora_eventi(), 0)
+        self.assertEqual(Ordine.objects.filter(utente=self.user).count(), 1)
+
+    def test_firma_non_valida(self):
+        self.assertEqual(self.consegna('WH-2', firma='falsa').status_code, 401)
+        self.assertFalse(WebhookEvento.objects.exists())
+        self.assertEqual(self.paypal.richieste, ['/v1/oauth2/token', '/v1/notifications/verify-webhook-signature'])
+
+    def test_senza_id_evento(self):
+        # Stesso corpo, trasmissioni diverse: la chiave è l'hash del corpo
+        corpo = payload_coa(self.cart.uuid).encode()
+        self.assertEqual(chiave_evento(json.loads(corpo), None, corpo), chiave_evento(json.loads(corpo), None, corpo))
+        self.assertEqual(chiave_evento(json.loads(corpo), 'T-1', corpo), 'T-1')
+        self.assertEqual(self.consegna(None, invoice_id='INV-inesistente').status_code, 200)
+        self.assertEqual(elabora_eventi(), 1)
+        self.assertEqual(WebhookEvento.objects.get().esito, 404)
+
+    @patch('purchase.webhook.logger')
+    def test_errori_ritentati_fino_al_limite(self, mock_logger):
+        self.consegna('WH-3')
+        with patch('purchase.views.invoice_validation', side_effect=RuntimeError('guasto')):
+            for tentativo in range(1, WEBHOOK_MAX_TENTATIVI + 1):
+                inizio = timezone.now()
+                self.assertEqual(elabora_eventi(), 0)
+                evento = WebhookEvento.objects.get()
+                self.assertEqual(evento.tentativi, tentativo)
+                attesa = (evento.prossimo_tentativo - inizio).total_seconds() #type: ignore
+                self.assertAlmostEqual(attesa, WEBHOOK_BACKOFF_SECONDI * 2 ** (tentativo - 1), delta=5)
+                # Prima della scadenza l'evento non torna in coda
+                self.assertEqual(eventi_in_coda(), [])
+                WebhookEvento.objects.update(prossimo_tentativo=inizio)
+            # Oltre il limite non si ritenta più, anche a scadenza passata
+            self.assertEqual(eventi_in_coda(), [])
+        evento = WebhookEvento.objects.get()
+        self.assertEqual((evento.tentativi, evento.errore, evento.elaborato), (WEBHOOK_MAX_TENTATIVI, 'guasto', None))
+        self.assertEqual(mock_logger.exception.call_count, WEBHOOK_MAX_TENTATIVI)
+        # Il pagamento fallito non ha lasciato righe a metà
+        self.assertEqual(self.cart.invoices.count(), 1) #type: ignore
+        self.assertFalse(Ordine.objects.filter(utente=self.user).exists())
+
+    def test_ritenta_falliti(self):
+        self.consegna('WH-5')
+        WebhookEvento.objects.update(tentativi=WEBHOOK_MAX_TENTATIVI, errore='guasto')
+        self.consegna('WH-6')
+        self.assertEqual(len(eventi_in_coda()), 1)
+        out = StringIO()
+        call_command('elabora_webhook', '--ritenta-falliti', stdout=out)
+        self.assertIn("Eventi rimessi in coda: 1", out.getvalue())
+        self.assertIn("Eventi elaborati: 2", out.getvalue())
+        self.assertEqual(ritenta_falliti(), 0)
+        self.assertFalse(WebhookEvento.objects.filter(elaborato__isnull=True).exists())
+
+    def test_comando_elabora_webhook(self):
+        self.consegna('WH-4')
+        out = StringIO()
+        call_command('elabora_webhook', stdout=out)
+        self.assertIn("Eventi elaborati: 1", out.getvalue())
+        self.assertEqual(Ordine.objects.filter(utente=self.user).count(), 1)
+
 class TestPaypalFunctions(TestCase):
-    
+    def setUp(self):
+        cache.clear()
+
     @patch('requests.post')
     def test_get_paypal_access_token_success(self, mock_post):
         mock_response = MagicMock()
@@ -509,6 +829,7 @@ class TestPaypalFunctions(TestCase):
         
         self.assertEqual(token, "test_token")
         mock_response.raise_for_status.assert_called_once()
+        self.assertEqual(mock_post.call_args.kwargs['timeout'], PAYPAL_TIMEOUT_SECONDI)
     
     @patch('requests.post')
     def test_get_paypal_access_token_failure(self, mock_post):
@@ -520,6 +841,18 @@ class TestPaypalFunctions(TestCase):
         with self.assertRaises(requests.HTTPError):
             get_paypal_access_token()
     
+    @patch('requests.post')
+    def test_token_rifiutato_tolto_dalla_cache(self, mock_post):
+        token = MagicMock(status_code=200)
+        token.json.return_value = {"access_token": "vecchio", "expires_in": 3600}
+        rifiutato = MagicMock(status_code=401)
+        rifiutato.raise_for_status.side_effect = requests.HTTPError("Unauthorized")
+        mock_post.side_effect = [token, rifiutato]
+        request = MagicMock(headers={})
+        with self.assertRaises(requests.HTTPError):
+            verify_paypal_webhook(request, json.dumps({"event_type": "CHECKOUT.ORDER.APPROVED"}))
+        self.assertIsNone(cache.get('paypal_access_token'))
+
     @patch('purchase.views.get_paypal_access_token')
     @patch('requests.post')
     def test_verify_paypal_webhook_success(self, mock_post, mock_get_token):
@@ -968,6 +1301,178 @@ class CartTests(TestCase):
         self.assertIn('count', response.json())
         self.assertEqual(response.json()['count'], 0) # type: ignore
 
+class CarrelloIntegritaTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='qzacquirente', password='testpass123')
+        self.venditore = User.objects.create_user(username='qzvenditore', password='testpass123')
+        self.client.force_login(self.user)
+        self.cart = Cart.objects.create(utente=self.user, uuid=str(uuid.uuid4()))
+
+    def aggiungi_righe(self, n, qta_magazzino=10, quantita=1):
+        annunci = []
+        for i in range(n):
+            prodotto = Prodotto.objects.create(nome=f'qzprodotto {i}', descrizione_breve='qz', prezzo=10, condizione='nuovo')
+            annunci.append(Annuncio.objects.create(
+                inserzionista=self.venditore, prodotto=prodotto, qta_magazzino=qta_magazzino, uuid=str(uuid.uuid4())
+            ))
+            Invoice.objects.create(uuid=str(uuid.uuid4()), utente=self.user, quantita=quantita,
+                                   prodotto=prodotto, cart=self.cart)
+        return annunci
+
+    def conta_query(self, metodo, url):
+        # La prima richiesta scalda le cache e non si conta
+        metodo(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = metodo(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries.captured_queries)
+
+    def test_query_costanti_al_crescere_del_carrello(self):
+        self.aggiungi_righe(3)
+        carrello = self.conta_query(self.client.get, reverse('purchase:carrello'))
+        checkout = self.conta_query(self.client.post, reverse('purchase:checkout'))
+        self.aggiungi_righe(60)
+        self.assertEqual(self.conta_query(self.client.get, reverse('purchase:carrello')), carrello)
+        self.assertEqual(self.conta_query(self.client.post, reverse('purchase:checkout')), checkout)
+
+    def test_righe_non_acquistabili_rimosse_con_una_notifica(self):
+        nascosto, cancellato, bandito, valido = self.aggiungi_righe(4)
+        nascosto.is_published = False
+        nascosto.save()
+        cancellato.delete()
+        altro = User.objects.create_user(username='qzbandito', password='testpass123', is_active=False)
+        bandito.inserzionista = altro
+        bandito.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('purchase:carrello'))
+        self.assertIn('?evento=articoli_inesistenti', response.url) #type:ignore
+        self.assertEqual(list(self.cart.invoices.values_list('prodotto_id', flat=True)), [valido.prodotto_id]) #type:ignore
+        notifiche = Notification.objects.filter(recipient=self.user)
+        self.assertEqual(notifiche.count(), 1)
+        self.assertIn('3 articoli', notifiche.get().message)
+        self.assertEqual(sum('DELETE FROM "purchase_invoice"' in q['sql'] for q in queries.captured_queries), 1)
+
+    def test_quantita_ridotte_tutte_insieme(self):
+        self.aggiungi_righe(3, qta_magazzino=2, quantita=5)
+        response = self.client.post(reverse('purchase:checkout'))
+        self.assertIn('?evento=troppi_articoli', response.url) #type:ignore
+        self.assertEqual(set(self.cart.invoices.values_list('quantita', flat=True)), {2}) #type:ignore
+        # Al secondo giro il carrello è coerente
+        response = self.client.post(reverse('purchase:checkout'))
+        self.assertEqual(response.status_code, 200)
+
+class ArticoliCarrelloMixin:
+    def setUp(self):
+        self.user = User.objects.create_user(username='qzcarrello', password='testpass123')
+        self.venditore = User.objects.create_user(username='qzvende', password='testpass123')
+        self.client.force_login(self.user)
+        self.cart = Cart.objects.create(utente=self.user, uuid=str(uuid.uuid4()))
+        self.annunci = []
+        for i, prezzo in enumerate(['0.10', '19.99', '1234.56']):
+            prodotto = Prodotto.objects.create(nome=f'qzarticolo {i}', descrizione_breve='qz',
+                                               prezzo=Decimal(prezzo), condizione='nuovo')
+            self.annunci.append(Annuncio.objects.create(inserzionista=self.venditore, prodotto=prodotto,
+                                                        qta_magazzino=50, uuid=str(uuid.uuid4())))
+
+    def aggiungi(self, annuncio, quantita):
+        return self.client.post(reverse('purchase:add_to_cart'), {'annuncio_id': annuncio.uuid, 'quantita': quantita})
+
+    def conteggio(self):
+        return self.client.get(reverse('sylvelius:cart_check')).json()['count']
+
+class CarrelloTotaleEConteggioTests(ArticoliCarrelloMixin, TestCase):
+    def test_totale_calcolato_dal_database(self):
+        for annuncio, quantita in zip(self.annunci, (3, 7, 2)):
+            self.aggiungi(annuncio, quantita)
+        atteso = sum(invoice.total for invoice in self.cart.invoices.select_related('prodotto')) #type:ignore
+        with CaptureQueriesContext(connection) as queries:
+            totale = self.cart.total
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertEqual(totale, atteso)
+        self.assertEqual(totale, Decimal('2609.35'))
+        self.assertEqual(Cart.objects.create(utente=self.venditore, uuid=str(uuid.uuid4())).total, 0)
+
+    def test_badge_dal_database(self):
+        self.assertEqual(self.conteggio(), 0)
+        self.aggiungi(self.annunci[0], 1)
+        self.aggiungi(self.annunci[1], 1)
+        self.assertEqual(self.conteggio(), 2)
+
+        # Cambiare quantità non cambia il numero di righe
+        invoice = self.cart.invoices.get(prodotto=self.annunci[0].prodotto) #type:ignore
+        self.client.post(reverse('purchase:aumenta_carrello', args=[invoice.uuid]))
+        self.assertEqual(self.conteggio(), 2)
+        self.client.post(reverse('purchase:diminuisci_carrello', args=[invoice.uuid]))
+        self.client.post(reverse('purchase:diminuisci_carrello', args=[invoice.uuid]))
+        self.assertEqual(self.conteggio(), 1)
+
+        # Righe staccate senza segnali, come dal worker dei webhook in un altro processo
+        Invoice.objects.filter(cart=self.cart).update(cart=None)
+        self.assertEqual(self.conteggio(), 0)
+
+    def test_badge_dopo_rimozione_e_pagamento(self):
+        self.aggiungi(self.annunci[0], 1)
+        invoice = self.cart.invoices.get() #type:ignore
+        self.assertEqual(self.conteggio(), 1)
+        self.client.post(reverse('purchase:rimuovi_da_carrello', args=[invoice.uuid]))
+        self.assertEqual(self.conteggio(), 0)
+
+        # Il webhook elimina le righe pagate del carrello
+        self.aggiungi(self.annunci[1], 1)
+        self.assertEqual(self.conteggio(), 1)
+        self.cart.invoices.get().delete() #type:ignore
+        self.assertEqual(self.conteggio(), 0)
+
+class CarrelloWebsocketTests(ArticoliCarrelloMixin, TestCase):
+    def esegui(self, url, dati=None):
+        # Gli invii partono dopo il commit: restituisce quanti ne sono stati programmati
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.client.post(url, dati)
+        return len(callbacks)
+
+    def test_conteggio_inviato_al_websocket(self):
+        self.esegui(reverse('purchase:add_to_cart'), {'annuncio_id': self.annunci[0].uuid, 'quantita': 1})
+
+        async def ricevi():
+            communicator = WebsocketCommunicator(GetNotifications.as_asgi(), '/ws/notifications/')
+            communicator.scope['user'] = self.user
+            connesso, _ = await communicator.connect()
+            self.assertTrue(connesso)
+            messaggi = [await communicator.receive_json_from(timeout=5)]
+
+            for annuncio in self.annunci[1:]:
+                self.assertEqual(await sync_to_async(self.esegui)(
+                    reverse('purchase:add_to_cart'), {'annuncio_id': annuncio.uuid, 'quantita': 1}), 1)
+                messaggi.append(await communicator.receive_json_from(timeout=5))
+
+            # Tre righe cancellate, un solo invio
+            self.assertEqual(await sync_to_async(self.esegui)(reverse('purchase:rimuovi_carrello', args=[self.cart.uuid])), 1)
+            messaggi.append(await communicator.receive_json_from(timeout=5))
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+            await dispatcher.ferma()
+            return messaggi
+
+        messaggi = async_to_sync(ricevi)()
+        self.assertEqual([m['count'] for m in messaggi], [1, 2, 3, 0])
+        self.assertEqual({m['type'] for m in messaggi}, {'cart_count'})
+
+    def test_invio_dopo_transazione_annullata(self):
+        self.esegui(reverse('purchase:add_to_cart'), {'annuncio_id': self.annunci[0].uuid, 'quantita': 1})
+        invoice = self.cart.invoices.get() #type:ignore
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                invoice.delete()
+                raise RuntimeError
+        # L'invio della transazione annullata non blocca quelli successivi
+        self.assertEqual(self.esegui(reverse('purchase:rimuovi_da_carrello', args=[invoice.uuid])), 1)
+
+    def test_quantita_non_inviata(self):
+        self.esegui(reverse('purchase:add_to_cart'), {'annuncio_id': self.annunci[0].uuid, 'quantita': 1})
+        invoice = self.cart.invoices.get() #type:ignore
+        self.assertEqual(self.esegui(reverse('purchase:aumenta_carrello', args=[invoice.uuid])), 0)
+
 class ModelStrTests(TestCase):
     def setUp(self):
         # Creazione dati di test comuni
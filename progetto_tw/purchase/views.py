@@ -1,6 +1,9 @@
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import F, Prefetch
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
@@ -11,9 +14,12 @@ from django.views.decorators.cache import cache_control
 from django.utils.decorators import method_decorator
 from django.views.generic import TemplateView
 
-from sylvelius.models import Ordine, Annuncio
+from sylvelius.models import Ordine, Annuncio, Notification
+from sylvelius.notifiche import accoda_notifiche
 from sylvelius.views import create_notification
 from .models import Invoice, Iban, Cart
+from .webhook import chiave_evento, registra_evento
+from progetto_tw.constants import PAYPAL_TIMEOUT_SECONDI, PAYPAL_TOKEN_MARGINE_SECONDI
 from progetto_tw.mixins import CustomLoginRequiredMixin, ModeratoreAccessForbiddenMixin
 
 import json
@@ -104,19 +110,30 @@ def payment_done(request):
 
 def payment_cancelled(request):
     return render(request, 'purchase/payment_cancelled.html')
+_CHIAVE_TOKEN_PAYPAL = 'paypal_access_token'
 # non callable
 def get_paypal_access_token():
+    # Il token vale per expires_in secondi: resta in cache fino a poco prima,
+    # così ogni webhook fa una sola chiamata a PayPal invece di due
+    token = cache.get(_CHIAVE_TOKEN_PAYPAL)
+    if token:
+        return token
     PAYPAL_CLIENT_ID = settings.PAYPAL_CLIENT_ID
     PAYPAL_SECRET = settings.PAYPAL_SECRET
-    PAYPAL_API_BASE = "https://api-m.sandbox.paypal.com"  
+    PAYPAL_API_BASE = settings.PAYPAL_API_BASE
     response = requests.post(
         f"{PAYPAL_API_BASE}/v1/oauth2/token",
         data={"grant_type": "client_credentials"},
         auth=HTTPBasicAuth(PAYPAL_CLIENT_ID, PAYPAL_SECRET),
+        timeout=PAYPAL_TIMEOUT_SECONDI,
     )
 
     response.raise_for_status()
-    return response.json()["access_token"]
+    dati = response.json()
+    durata = int(dati.get("expires_in", 0)) - PAYPAL_TOKEN_MARGINE_SECONDI
+    if durata > 0:
+        cache.set(_CHIAVE_TOKEN_PAYPAL, dati["access_token"], durata)
+    return dati["access_token"]
 # non callable
 def verify_paypal_webhook(request,body):
     webhook_event = json.loads(body)
@@ -127,7 +144,7 @@ def verify_paypal_webhook(request,body):
     else:
         return False
     
-    PAYPAL_API_BASE = "https://api-m.sandbox.paypal.com" 
+    PAYPAL_API_BASE = settings.PAYPAL_API_BASE
     access_token = get_paypal_access_token()
     headers = request.headers
     
@@ -148,67 +165,96 @@ def verify_paypal_webhook(request,body):
             "Authorization": f"Bearer {access_token}",
         },
         json=verification_data,
+        timeout=PAYPAL_TIMEOUT_SECONDI,
     )
 
+    if response.status_code == 401:
+        # Token revocato prima della scadenza: il prossimo tentativo di PayPal ne chiede uno nuovo
+        cache.delete(_CHIAVE_TOKEN_PAYPAL)
     response.raise_for_status()
     verification_status = response.json().get("verification_status")
     return verification_status == "SUCCESS"
 # non callable
-def invoice_validation(invoice_obj, pu):
-    user = invoice_obj.utente
-    prodotto = invoice_obj.prodotto
-    quantita = invoice_obj.quantita
+def invoice_validation(invoices, pu):
+    # Tutte le righe pagate in una transazione: scorte scalate con un UPDATE
+    # condizionale per riga (mai sotto zero, anche con webhook concorrenti),
+    # ordini, cancellazione delle righe e notifiche con una query ciascuno
+    address = pu.get('shipping', {}).get('address', {})
+    if not address:
+        return HttpResponse(status=400)
 
     try:
-        annuncio = Annuncio.objects.get(prodotto=prodotto)
-    except Annuncio.DoesNotExist:
-        create_notification(
-            recipient=user,
-            title="Acquisto Annullato",
-            message=f"Purtroppo l'acquisto non è andato a buon fine, il prodotto {prodotto.nome} è stato rimosso dalla piattaforma. Le arriverà un rimborso completo il prima possibile."
-        )
+        with transaction.atomic():
+            righe = list(invoices.select_for_update(of=('self',)).select_related(
+                'utente', 'prodotto__annuncio__inserzionista').order_by('id'))
+            ordini = []
+            notifiche = []
+            for invoice in righe:
+                user = invoice.utente
+                prodotto = invoice.prodotto
+                annuncio = getattr(prodotto, 'annuncio', None)
+                if annuncio is None:
+                    notifiche.append(Notification(
+                        recipient=user,
+                        title="Acquisto Annullato",
+                        message=f"Purtroppo l'acquisto non è andato a buon fine, il prodotto {prodotto.nome} è stato rimosso dalla piattaforma. Le arriverà un rimborso completo il prima possibile."
+                    ))
+                    continue
+
+                venduto = Annuncio.objects.filter(pk=annuncio.pk, qta_magazzino__gte=invoice.quantita).update(
+                    qta_magazzino=F('qta_magazzino') - invoice.quantita)
+                if venduto:
+                    stato = "da spedire"
+                    notifiche.append(Notification(
+                        recipient=user,
+                        title="Acquisto Confermato!",
+                        message=f"L'acquisto di {prodotto.nome} è andato a buon fine!"
+                    ))
+                    notifiche.append(Notification(
+                        recipient=annuncio.inserzionista,
+                        title="Un utente ha acquistato!",
+                        message=f"Un utente ha acquistato {invoice.quantita} unità di {prodotto.nome}!"
+                    ))
+                else:
+                    stato = "annullato"
+                    notifiche.append(Notification(
+                        recipient=user,
+                        title="Acquisto Annullato",
+                        message=f"Purtroppo l'acquisto non è andato a buon fine, le scorte del prodotto {prodotto.nome} in magazzino sono finite o inferiori alla sua richiesta. Le arriverà un rimborso completo il prima possibile."
+                    ))
+                ordini.append(Ordine(
+                    utente=user,
+                    prodotto=prodotto,
+                    quantita=invoice.quantita,
+                    invoice=invoice.uuid,
+                    stato_consegna=stato,
+                    luogo_consegna=address
+                ))
+
+            Ordine.objects.bulk_create(ordini)
+            Invoice.objects.filter(uuid__in=[ordine.invoice for ordine in ordini]).delete()
+            accoda_notifiche(notifiche)
+    except IntegrityError:
+        # Stessa riga già regolata da un webhook concorrente: l'ordine esiste, niente da rifare
         return HttpResponse(status=200)
-    
-    if annuncio.qta_magazzino < quantita:
-        create_notification(
-            recipient=user,
-            title="Acquisto Annullato",
-            message=f"Purtroppo l'acquisto non è andato a buon fine, le scorte del prodotto {prodotto.nome} in magazzino sono finite o inferiori alla sua richiesta. Le arriverà un rimborso completo il prima possibile."
-        )
-        stato = "annullato"
-    else:
-        annuncio.qta_magazzino = annuncio.qta_magazzino - quantita
-        annuncio.save()
-        stato = "da spedire"
-
-    ordine = Ordine.objects.create(
-        utente=user,
-        prodotto=prodotto,
-        quantita=quantita,
-        invoice=invoice_obj.uuid,
-        stato_consegna=stato
-    )
-
-    shipping = pu.get('shipping', {})
-    address = shipping.get('address', {})
-    if address:
-        ordine.luogo_consegna = address
-        ordine.save()
-        invoice_obj.delete()
-        create_notification(
-            recipient=user,
-            title="Acquisto Confermato!",
-            message=f"L'acquisto di {prodotto.nome} è andato a buon fine!"
-        )
-        create_notification(
-            recipient=annuncio.inserzionista,
-            title="Un utente ha acquistato!",
-            message=f"Un utente ha acquistato {ordine.quantita} unità di {ordine.prodotto.nome}!"
-        )
-    else:
-        return HttpResponse(status=400)
     return HttpResponse(status=200)
 
+# non callable
+def regola_pagamento(payload):
+    # Eseguita dal worker su un evento già verificato e salvato (purchase/webhook.py);
+    # restituisce lo status che prima era la risposta del webhook
+    pu = payload['resource']['purchase_units'][0]
+    uuid = pu.get('invoice_id')
+
+    # invoice_id è la riga acquistata da sola o il carrello intero
+    invoices = Invoice.objects.filter(uuid=uuid)
+    if not invoices.exists():
+        cart_obj = Cart.objects.filter(uuid=uuid).first()
+        if cart_obj is None:
+            return 404
+        invoices = Invoice.objects.filter(cart=cart_obj)
+    return invoice_validation(invoices, pu).status_code
+
 @csrf_exempt
 @require_POST
 def paypal_coa(request):
@@ -227,27 +273,13 @@ def paypal_coa(request):
             return HttpResponse(status=400)
 
         pu = purchase_units[0]
-        uuid = pu.get('invoice_id')
-
-        invoice_obj = None
-        cart_obj = None
+        if not pu.get('invoice_id') or not pu.get('shipping', {}).get('address'):
+            return HttpResponse(status=400)
 
-        try:
-            invoice_obj = Invoice.objects.get(uuid=uuid)
-        except Invoice.DoesNotExist:
-            try:
-                cart_obj = Cart.objects.get(uuid=uuid)
-            except Cart.DoesNotExist:
-                return HttpResponse(status=404)
-        
-        if invoice_obj:
-            return invoice_validation(invoice_obj, pu)
-        else:
-            invoices = Invoice.objects.filter(cart=cart_obj)
-            response = None
-            for inv in invoices:
-                response = invoice_validation(inv, pu)
-            return response if response else HttpResponse(status=200)
+        # Si risponde prima di regolare il pagamento: PayPal non ripete l'invio per
+        # timeout, e se lo ripete l'evento è già nel registro e non succede nulla
+        registra_evento(payload, chiave_evento(payload, request.headers.get('PAYPAL-TRANSMISSION-ID'), body))
+        return HttpResponse(status=200)
 
     return HttpResponse(status=400)
 
@@ -325,26 +357,49 @@ def controlla_annuncio_e_quantita(invoice, incremento=1):
 
     return None
 # non callable
-def carrello_or_checkout_integrity(request):
-    redirects = redirect(
-        reverse("purchase:carrello") +
-        "?evento=articoli_inesistenti"
-    )
-    deleted = False 
-    for invoice in request.user.cart.invoices.all():  #type:ignore
-        try:
-            Annuncio.objects.get(prodotto=invoice.prodotto,inserzionista__is_active=True,is_published=True)
-        except Annuncio.DoesNotExist:
-            inv = Invoice.objects.filter(prodotto=invoice.prodotto, cart=request.user.cart)#type:ignore
-            for invc in inv:
-                create_notification(recipient=invc.utente, title='Articolo nel carrello rimosso', 
-                                    message='L\'annuncio relativo all\'articolo è stato rimosso/nascosto o l\'inserzionista è stato bandito.')
-            inv.delete()
-            deleted = True
-        error_redirect = controlla_annuncio_e_quantita(invoice, incremento=0)
-        if error_redirect:
-            return error_redirect
-    return redirects if deleted else None
+def carrello_con_articoli(user):
+    # Carrello, righe, prodotti, annunci e inserzionisti con due query qualunque sia
+    # il numero di righe: li usano sia il controllo di integrità sia il template
+    return Cart.objects.filter(utente=user).prefetch_related(Prefetch(
+        'invoices',
+        queryset=Invoice.objects.select_related('prodotto__annuncio__inserzionista').order_by('id')
+    )).first()
+# non callable
+def carrello_or_checkout_integrity(request, cart=None):
+    # Un solo passaggio sulle righe già caricate: un DELETE per quelle non più
+    # acquistabili, un UPDATE per le quantità oltre la disponibilità, una notifica
+    if cart is None:
+        cart = carrello_con_articoli(request.user)
+    da_rimuovere = []
+    da_ridurre = []
+    for invoice in cart.invoices.all():  #type:ignore
+        annuncio = getattr(invoice.prodotto, 'annuncio', None)
+        if annuncio is None or not annuncio.is_published or not annuncio.inserzionista.is_active:
+            da_rimuovere.append(invoice.id)
+        elif invoice.quantita > annuncio.qta_magazzino:
+            invoice.quantita = annuncio.qta_magazzino
+            da_ridurre.append(invoice)
+
+    if da_ridurre:
+        Invoice.objects.bulk_update(da_ridurre, ['quantita'])
+    if da_rimuovere:
+        Invoice.objects.filter(id__in=da_rimuovere).delete()
+        if len(da_rimuovere) == 1:
+            create_notification(recipient=request.user, title='Articolo nel carrello rimosso',
+                                message='L\'annuncio relativo all\'articolo è stato rimosso/nascosto o l\'inserzionista è stato bandito.')
+        else:
+            create_notification(recipient=request.user, title='Articoli nel carrello rimossi',
+                                message=f'{len(da_rimuovere)} articoli sono stati rimossi: gli annunci sono stati rimossi/nascosti o gli inserzionisti sono stati banditi.')
+        return redirect(
+            reverse("purchase:carrello") +
+            "?evento=articoli_inesistenti"
+        )
+    if da_ridurre:
+        return redirect(
+            reverse("purchase:carrello") +
+            "?evento=troppi_articoli"
+        )
+    return None
 
 class CarrelloPageView(CustomLoginRequiredMixin, ModeratoreAccessForbiddenMixin,View):
     template_name = "purchase/carrello.html"
@@ -352,12 +407,13 @@ class CarrelloPageView(CustomLoginRequiredMixin, ModeratoreAccessForbiddenMixin,
 
     def get(self, request):
         context = {}
-        if Cart.objects.filter(utente=request.user).exists(): #type:ignore
-            err = carrello_or_checkout_integrity(request)
+        cart = carrello_con_articoli(request.user)
+        if cart is not None:
+            err = carrello_or_checkout_integrity(request, cart)
             if err:
                 return err
 
-            context['cart'] = request.user.cart #type:ignore
+            context['cart'] = cart
         return render(request, self.template_name, context)
 
 @method_decorator(cache_control(no_cache=True, must_revalidate=True, no_store=True), name='dispatch')
@@ -367,15 +423,16 @@ class CheckoutPageView(CustomLoginRequiredMixin, ModeratoreAccessForbiddenMixin,
 
     def post(self,request):
         context = {}
-        if Cart.objects.filter(utente = request.user).exists():
-            err = carrello_or_checkout_integrity(request)
+        cart = carrello_con_articoli(request.user)
+        if cart is not None:
+            err = carrello_or_checkout_integrity(request, cart)
             if err:
                 return err
             
-            context['cart'] = request.user.cart  #type:ignore
-            context['amount'] = request.user.cart.total #type:ignore
+            context['cart'] = cart
+            context['amount'] = cart.total
             context['paypal_client_id'] = settings.PAYPAL_CLIENT_ID
-            context['uuid'] = request.user.cart.uuid #type:ignore
+            context['uuid'] = cart.uuid
         return render(request, self.template_name, context)
 
 @require_POST
@@ -416,7 +473,6 @@ def rimuovi_da_carrello(request, uuid):
 @login_required
 def rimuovi_carrello(request, cart_id):
     cart = get_object_or_404(Cart,uuid=cart_id,utente=request.user)
-    for invoice in cart.invoices.all():  # type: ignore
-        invoice.delete()
+    cart.invoices.all().delete()  # type: ignore
     
     return redirect(reverse("purchase:carrello") + '?evento=rimossi')
\ No newline at end of file
@@ -0,0 +1,87 @@
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from progetto_tw.constants import WEBHOOK_BACKOFF_SECONDI, WEBHOOK_BATCH, WEBHOOK_MAX_TENTATIVI
+
+# Registro degli eventi PayPal: paypal_coa verifica la firma, salva l'evento e
+# risponde subito; il pagamento lo regola il worker (comando elabora_webhook).
+# Le consegne ripetute dello stesso evento trovano la riga già presente e non
+# fanno altro, né nella view né nel worker.
+# Un evento fallito si ritenta dopo WEBHOOK_BACKOFF_SECONDI, poi il doppio a ogni
+# errore; dopo WEBHOOK_MAX_TENTATIVI resta fermo finché non lo rimette in coda ritenta_falliti.
+
+logger = logging.getLogger(__name__)
+
+def chiave_evento(payload, transmission_id, body):
+    # L'id dell'evento PayPal resta uguale in tutti i tentativi di consegna;
+    # senza, l'id di trasmissione o l'hash del corpo
+    return str(payload.get('id') or transmission_id or hashlib.sha256(body).hexdigest())
+
+def registra_evento(payload, chiave):
+    # True se l'evento è nuovo, False se era già nel registro
+    from .models import WebhookEvento
+
+    try:
+        with transaction.atomic():
+            WebhookEvento.objects.create(evento_id=chiave, tipo=payload.get('event_type', ''), payload=payload)
+    except IntegrityError:
+        return False
+    return True
+
+def eventi_in_coda(batch=WEBHOOK_BATCH):
+    from .models import WebhookEvento
+
+    return list(
+        WebhookEvento.objects.filter(elaborato__isnull=True, tentativi__lt=WEBHOOK_MAX_TENTATIVI)
+        .filter(Q(prossimo_tentativo__isnull=True) | Q(prossimo_tentativo__lte=timezone.now()))
+        .order_by('id').values_list('id', flat=True)[:batch]
+    )
+
+def ritenta_falliti():
+    # Rimette in coda gli eventi fermi per troppi errori; restituisce quanti
+    from .models import WebhookEvento
+
+    return WebhookEvento.objects.filter(elaborato__isnull=True, tentativi__gte=WEBHOOK_MAX_TENTATIVI).update(
+        tentativi=0, prossimo_tentativo=None)
+
+def elabora_evento(pk):
+    # Esattamente una volta: l'evento si segna elaborato nella stessa transazione
+    # del pagamento, e un altro worker arrivato insieme non lo trova più in coda.
+    # Restituisce l'esito, o None se l'evento non era da elaborare o è fallito.
+    from .models import WebhookEvento
+    from .views import regola_pagamento
+
+    try:
+        with transaction.atomic():
+            evento = WebhookEvento.objects.select_for_update(skip_locked=True).filter(
+                pk=pk, elaborato__isnull=True).first()
+            if evento is None:
+                return None
+            evento.esito = regola_pagamento(evento.payload)
+            evento.elaborato = timezone.now()
+            evento.save(update_fields=['esito', 'elaborato'])
+    except Exception as e:
+        logger.exception("Elaborazione dell'evento webhook %s non riuscita", pk)
+        tentativi = WebhookEvento.objects.filter(pk=pk).values_list('tentativi', flat=True).first() or 0
+        WebhookEvento.objects.filter(pk=pk).update(
+            tentativi=F('tentativi') + 1, errore=str(e),
+            prossimo_tentativo=timezone.now() + timedelta(seconds=WEBHOOK_BACKOFF_SECONDI * 2 ** tentativi)
+        )
+        return None
+    return evento.esito
+
+def elabora_eventi(batch=WEBHOOK_BATCH):
+    # Svuota la coda; restituisce quanti eventi sono stati elaborati
+    elaborati = 0
+    while True:
+        coda = eventi_in_coda(batch)
+        for pk in coda:
+            if elabora_evento(pk) is not None:
+                elaborati += 1
+        if len(coda) < batch:
+            return elaborati
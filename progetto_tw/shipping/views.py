@@ -8,6 +8,11 @@ from progetto_tw.mixins import CustomLoginRequiredMixin, ModeratoreAccessForbidd
 from sylvelius.models import Ordine
 from sylvelius.views import create_notification
 # Create your views here.
+def pagina_clienti(request):
+    # Cursore della pagina clienti da cui si è partiti (paginazione keyset)
+    cursore = request.GET.get('cursore')
+    return f'&cursore={cursore}' if cursore else ''
+
 class SpedizionePageView(CustomLoginRequiredMixin,ModeratoreAccessForbiddenMixin,TemplateView):
     template_name = "shipping/spedizione.html"
     login_url = reverse_lazy('sylvelius:login')
@@ -17,6 +22,7 @@ class SpedizionePageView(CustomLoginRequiredMixin,ModeratoreAccessForbiddenMixin
 
         ordine = get_object_or_404(Ordine,id=self.request.GET.get('ordine'),prodotto__annuncio__inserzionista=self.request.user, stato_consegna='da spedire', utente__is_active=True)
         context['page'] = self.request.GET.get('page')
+        context['cursore'] = self.request.GET.get('cursore', '')
         context['ordine'] = ordine
         return context
     
@@ -32,7 +38,7 @@ def imposta_spedito(request, ordine_id):
     create_notification(recipient=ordine.prodotto.annuncio.inserzionista,title="Ordine spedito!", sender=request.user,#type:ignore
                                     message=f"Il tuo ordine di {ordine.prodotto.nome} per {ordine.utente} è stato spedito!")
 
-    return redirect(f'{reverse("sylvelius:profile_clienti")}?page={page}&evento=spedito_ordine')
+    return redirect(f'{reverse("sylvelius:profile_clienti")}?page={page}&evento=spedito_ordine{pagina_clienti(request)}')
 
 @login_required
 @require_POST
@@ -45,4 +51,4 @@ def imposta_completato(request, ordine_id):
     create_notification(recipient=ordine.prodotto.annuncio.inserzionista,title="Ordine consegnato!", sender=request.user, #type:ignore
                                     message=f"Il tuo ordine di {ordine.prodotto.nome} per {ordine.utente} è stato consegnato!")
     page = request.GET.get('page')
-    return redirect(f'{reverse("sylvelius:profile_clienti")}?page={page}&evento=completato_ordine')
\ No newline at end of file
+    return redirect(f'{reverse("sylvelius:profile_clienti")}?page={page}&evento=completato_ordine{pagina_clienti(request)}')
\ No newline at end of file
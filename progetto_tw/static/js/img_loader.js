@@ -1,16 +1,30 @@
 document.addEventListener('DOMContentLoaded', () => {
+    const MAX_IMG_BATCH = Number(window.COSTANTI && window.COSTANTI.MAX_IMG_BATCH_VALUE) || 100;
     const immagini = document.querySelectorAll('.immagine-asincrona');
+    const prodottiIds = [...new Set(
+        Array.from(immagini, img => img.getAttribute('data-prodotto-id'))
+    )];
 
-    immagini.forEach(img => {
-        const prodottoId = img.getAttribute('data-prodotto-id');
-        fetch(`/api/immagine/${prodottoId}/`)
+    // Una sola richiesta per ogni blocco di prodotti invece di una per immagine
+    for (let i = 0; i < prodottiIds.length; i += MAX_IMG_BATCH) {
+        const blocco = prodottiIds.slice(i, i + MAX_IMG_BATCH);
+        fetch(`/api/immagini/?prodotti=${blocco.join(',')}`)
             .then(response => response.json())
             .then(data => {
-                img.src = data.url;
+                immagini.forEach(img => {
+                    const url = data.urls[img.getAttribute('data-prodotto-id')];
+                    if (url) {
+                        img.src = url;
+                    }
+                });
             })
             .catch(err => {
-                console.error("Errore nel caricamento immagine:", err);
-                img.src = '/static/img/default_product.png';
+                console.error("Errore nel caricamento immagini:", err);
+                immagini.forEach(img => {
+                    if (blocco.includes(img.getAttribute('data-prodotto-id'))) {
+                        img.src = '/static/img/default_product.png';
+                    }
+                });
             });
-    });
-});
\ No newline at end of file
+    }
+});
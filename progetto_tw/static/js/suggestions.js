@@ -24,6 +24,8 @@ function setupSuggestions({
         ws = new WebSocket(wsStart + loc.host + wsUrl);
         ws.onmessage = function(e) {
             const data = JSON.parse(e.data);
+            // Risposta a una query ormai superata da quanto scritto dopo: si ignora
+            if (data.query !== undefined && data.query !== input.value.trim()) return;
             if (data.suggestions && input.value.length > 0) {
                 suggestions.innerHTML = '';
                 const limited = data.suggestions.slice(0, MAX_WS_QUERIES);
@@ -6,7 +6,8 @@ from .models import (
     Annuncio,
     CommentoAnnuncio,
     Ordine,
-    Notification
+    Notification,
+    LetturaNotifiche
 )
 # Register your models here.
 admin.site.register(Tag)
@@ -15,4 +16,5 @@ admin.site.register(ImmagineProdotto)
 admin.site.register(Annuncio)
 admin.site.register(CommentoAnnuncio)
 admin.site.register(Ordine)
-admin.site.register(Notification)
\ No newline at end of file
+admin.site.register(Notification)
+admin.site.register(LetturaNotifiche)
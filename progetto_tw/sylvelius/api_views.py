@@ -1,55 +1,79 @@
 from asgiref.sync import sync_to_async
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
 from django.http import JsonResponse
-from .models import ImmagineProdotto, Notification
-from progetto_tw.constants import MAX_MESSAGES_PER_PAGE
-from purchase.models import Cart
+from .models import ImmagineProdotto
+from .notifiche import notifiche_utente
+from .suggerimenti import indice_suggerimenti, indice_tag
+from progetto_tw.consumers import statistiche_ws
+from progetto_tw.constants import MAX_MESSAGES_PER_PAGE, MAX_IMG_BATCH_VALUE
+from purchase.carrello import conteggio_carrello
 
-async def get_immagine_prodotto(request, prodotto_id):
-    immagini = await sync_to_async(list)(ImmagineProdotto.objects.filter(prodotto_id=prodotto_id).order_by('id')[:1])
-    if immagini and immagini[0].immagine:
-        return JsonResponse({'url': immagini[0].immagine.url})
-    else:
-        return JsonResponse({'url': '/static/img/default_product.png'})
+# Query e controlli sul disco delle derivate (storage.exists) girano in un thread,
+# fuori dal loop degli eventi
 
-async def get_immagini_prodotto(request, prodotto_id):
-    immagini = await sync_to_async(list)(
-        ImmagineProdotto.objects.filter(prodotto_id=prodotto_id).order_by('id')
-    )
-    
-    immagini_urls = [img.immagine.url for img in immagini if img.immagine]
+def _immagine_prodotto(prodotto_id):
+    immagine = ImmagineProdotto.objects.filter(prodotto_id=prodotto_id).order_by('id').first()
+    if immagine and immagine.immagine:
+        return {'url': immagine.url_variante('card'), 'varianti': immagine.varianti}
+    return {'url': '/static/img/default_product.png'}
+
+def _immagini_prodotto(prodotto_id):
+    immagini = [img for img in ImmagineProdotto.objects.filter(prodotto_id=prodotto_id).order_by('id') if img.immagine]
+    immagini_urls = [img.url_variante('carosello') for img in immagini]
     if not immagini_urls:
         immagini_urls = ['/static/img/default_product.png']
-        
-    return JsonResponse({'urls': immagini_urls})
+    return {'urls': immagini_urls, 'varianti': [img.varianti for img in immagini]}
+
+def _immagini_prodotti(prodotti_ids):
+    urls = {str(prodotto_id): '/static/img/default_product.png' for prodotto_id in prodotti_ids}
+    for img in ImmagineProdotto.prime_per_prodotto().filter(prodotto_id__in=prodotti_ids):
+        if img.immagine:
+            urls[str(img.prodotto_id)] = img.url_variante('card') # type: ignore
+    return {'urls': urls}
+
+async def get_immagine_prodotto(request, prodotto_id):
+    return JsonResponse(await sync_to_async(_immagine_prodotto)(prodotto_id))
+
+async def get_immagini_prodotto(request, prodotto_id):
+    return JsonResponse(await sync_to_async(_immagini_prodotto)(prodotto_id))
+
+async def get_immagini_prodotti(request):
+    prodotti_ids = [
+        int(prodotto_id) for prodotto_id in request.GET.get('prodotti', '').split(',')
+        if prodotto_id.strip().isdigit()
+    ][:MAX_IMG_BATCH_VALUE]
+    return JsonResponse(await sync_to_async(_immagini_prodotti)(prodotti_ids))
 
 async def notifications_api(request):
     is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
     if not is_authenticated:
         return JsonResponse([], safe=False)
     
-    notifications = await sync_to_async(list)(
-        Notification.objects.filter(
-            Q(recipient=request.user) | 
-            Q(is_global=True)
-        ).order_by('created_at')[:MAX_MESSAGES_PER_PAGE]
+    # Dalla più recente; le più vecchie con ?cursore= preso dall'header X-Cursore-Successivo
+    notifications, successivo = await sync_to_async(notifiche_utente)(
+        request.user, MAX_MESSAGES_PER_PAGE, request.GET.get('cursore')
     )
     
     data = [{
-        'title': n.title,
-        'message': n.message,
-        'read': n.read,
-        'date': n.created_at.isoformat()
+        'title': n['title'],
+        'message': n['message'],
+        'read': n['letta'],
+        'date': n['created_at'].isoformat()
     } for n in notifications]
     
-    return JsonResponse(data, safe=False)
+    response = JsonResponse(data, safe=False)
+    if successivo:
+        response['X-Cursore-Successivo'] = successivo
+    return response
 
 @login_required
 def cart_check(request):
-    try:
-        cart = request.user.cart
-        count = cart.invoices.count()
-        return JsonResponse({'count': count})
-    except Cart.DoesNotExist:
-        return JsonResponse({'count': 0})
\ No newline at end of file
+    return JsonResponse({'count': conteggio_carrello(request.user.pk)})
+@staff_member_required
+def statistiche_suggerimenti(request):
+    return JsonResponse({
+        'prodotti': indice_suggerimenti.statistiche(),
+        'tag': indice_tag.statistiche(),
+        'websocket': statistiche_ws,
+    })
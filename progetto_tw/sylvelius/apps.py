@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SylveliusConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sylvelius'
+
+    def ready(self):
+        from . import signals # noqa: F401
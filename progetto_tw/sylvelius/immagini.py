@@ -0,0 +1,79 @@
+import os
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from progetto_tw.constants import (
+    IMG_VARIANTI_DIMENSIONI,
+    IMG_VARIANTI_FORMATI,
+    IMG_VARIANTI_QUALITA,
+)
+
+# Niente import di modelli qui: le funzioni vengono eseguite anche nei processi
+# figli di "manage.py genera_derivate_immagini"
+
+def nome_derivata(nome_originale, variante, estensione):
+    # "prodotti/immagini/kayak.jpg" -> "prodotti/immagini/kayak.jpg.card.webp"
+    return f"{nome_originale}.{variante}.{estensione}"
+
+def is_derivata(nome):
+    parti = os.path.basename(nome).rsplit('.', 2)
+    return (
+        len(parti) == 3 and
+        parti[1] in dict(IMG_VARIANTI_DIMENSIONI) and
+        parti[2] in dict(IMG_VARIANTI_FORMATI)
+    )
+
+def _converti(immagine, formato_pil):
+    if formato_pil == "JPEG":
+        if immagine.mode in ("RGBA", "LA", "P"):
+            immagine = immagine.convert("RGBA")
+            sfondo = Image.new("RGB", immagine.size, (255, 255, 255))
+            sfondo.paste(immagine, mask=immagine.getchannel("A"))
+            return sfondo
+        return immagine.convert("RGB")
+    if immagine.mode not in ("RGB", "RGBA"):
+        return immagine.convert("RGBA" if immagine.mode in ("LA", "P", "PA") else "RGB")
+    return immagine
+
+def genera_derivate(percorso, forza=False):
+    # Ritorna i percorsi delle derivate scritte; salta quelle già presenti se non forzato
+    if is_derivata(percorso) or not os.path.isfile(percorso):
+        return []
+
+    mancanti = [
+        (variante, lato, estensione, formato_pil)
+        for variante, lato in IMG_VARIANTI_DIMENSIONI
+        for estensione, formato_pil in IMG_VARIANTI_FORMATI
+        if forza or not os.path.exists(nome_derivata(percorso, variante, estensione))
+    ]
+    if not mancanti:
+        return []
+
+    try:
+        with Image.open(percorso) as originale:
+            originale = ImageOps.exif_transpose(originale)
+            originale.load()
+    except OSError:
+        return []
+
+    scritte = []
+    ridimensionate = {}
+    for variante, lato, estensione, formato_pil in mancanti:
+        if variante not in ridimensionate:
+            copia = originale.copy()
+            copia.thumbnail((lato, lato), Image.Resampling.LANCZOS)
+            ridimensionate[variante] = copia
+
+        buffer = BytesIO()
+        _converti(ridimensionate[variante], formato_pil).save(
+            buffer, formato_pil, quality=IMG_VARIANTI_QUALITA, optimize=True
+        )
+        destinazione = nome_derivata(percorso, variante, estensione)
+        # Scrittura atomica: chi serve il file non vede mai una derivata a metà
+        temporaneo = f"{destinazione}.tmp"
+        with open(temporaneo, "wb") as file:
+            file.write(buffer.getvalue())
+        os.replace(temporaneo, destinazione)
+        scritte.append(destinazione)
+    return scritte
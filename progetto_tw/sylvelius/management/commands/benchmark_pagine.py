@@ -0,0 +1,83 @@
+import json
+import subprocess
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from progetto_tw.benchmark import confronta, esegui
+from progetto_tw.constants import BENCHMARK_RIPETIZIONI, GENERATORE_ID_BASE, GENERATORE_PROFILI
+from sylvelius.models import Annuncio, CommentoAnnuncio, Notification, Ordine
+
+class BenchmarkInterrotto(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = ("Misura p50/p95 e numero di query delle pagine principali e delle API sul dataset di genera_dati "
+            "(se manca lo genera; tutto viene annullato alla fine) e salva i risultati in JSON")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ripetizioni', type=int, default=BENCHMARK_RIPETIZIONI)
+        parser.add_argument('--riscaldamento', type=int, default=1, help="Richieste iniziali non misurate")
+        parser.add_argument('--profilo', choices=list(GENERATORE_PROFILI), default='piccolo',
+                            help="Profilo di genera_dati se il dataset non c'è ancora")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--solo', default=None, help="Misura solo gli scenari che contengono questo testo")
+        parser.add_argument('--output', default=None, help="File JSON dei risultati")
+        parser.add_argument('--confronta', default=None, help="JSON di un'esecuzione precedente da confrontare")
+        parser.add_argument('--soglia', type=float, default=20, help="Peggioramento del p95 tollerato, in %%")
+
+    def handle(self, *args, **options):
+        if options['ripetizioni'] < 1:
+            raise CommandError("--ripetizioni deve essere almeno 1")
+        if options['riscaldamento'] < 0:
+            raise CommandError("--riscaldamento non può essere negativo")
+        esito = {}
+        try:
+            with transaction.atomic():
+                if not User.objects.filter(id=GENERATORE_ID_BASE).exists():
+                    call_command('genera_dati', profilo=options['profilo'], seed=options['seed'], stdout=self.stdout)
+                esito['dataset'] = {
+                    'annunci': Annuncio.objects.count(),
+                    'ordini': Ordine.objects.count(),
+                    'commenti': CommentoAnnuncio.objects.count(),
+                    'notifiche': Notification.objects.count(),
+                }
+                esito['risultati'] = esegui(options['ripetizioni'], options['riscaldamento'], options['solo'])
+                raise BenchmarkInterrotto
+        except BenchmarkInterrotto:
+            pass
+
+        risultati = esito['risultati']
+        self.stdout.write(f"{'scenario':<26}{'status':>7}{'p50 ms':>10}{'p95 ms':>10}{'query':>7}")
+        for nome, r in risultati.items():
+            self.stdout.write(f"{nome:<26}{r['status']:>7}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['query']:>7}")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump({
+                    'commit': self._commit(),
+                    'data': timezone.now().isoformat(),
+                    'ripetizioni': options['ripetizioni'],
+                    **esito,
+                }, file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Risultati salvati in {options['output']}"))
+
+        if options['confronta']:
+            with open(options['confronta'], encoding='utf-8') as file:
+                regressioni = confronta(json.load(file)['risultati'], risultati, options['soglia'])
+            if regressioni:
+                raise CommandError("Regressioni rispetto a " + options['confronta'] + ":\n" + "\n".join(regressioni))
+            self.stdout.write(self.style.SUCCESS(f"Nessuna regressione rispetto a {options['confronta']}"))
+
+    def _commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,96 @@
+import random
+import statistics
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from progetto_tw.constants import MAX_PAGINATOR_RICERCA_VALUE
+from sylvelius.models import Annuncio, Prodotto, Tag
+from sylvelius.ricerca import BackendFts5, BackendOrm
+
+PAROLE = [
+    "smartphone", "cover", "lampada", "divano", "bicicletta", "zaino", "orologio",
+    "cuffie", "tastiera", "monitor", "scarpe", "giacca", "tavolo", "sedia", "libro",
+    "chitarra", "fotocamera", "borraccia", "tenda", "pentola",
+]
+AGGETTIVI = [
+    "nuovo", "usato", "vintage", "elegante", "robusto", "leggero", "compatto",
+    "professionale", "economico", "resistente", "colorato", "artigianale",
+]
+QUERY = ["smartphone", "vintage", "chitarra elettrica", "artigianale", "xyzzy"]
+
+class RicercaInterrotta(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = ("Confronta la ricerca icontains con l'indice FTS5 su un dataset sintetico "
+            "(creato in una transazione e poi annullato)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--annunci', type=int, default=100_000)
+        parser.add_argument('--ripetizioni', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._popola(options['annunci'], random.Random(options['seed']))
+                BackendFts5().ricostruisci()
+                self._confronta(options['ripetizioni'])
+                raise RicercaInterrotta
+        except RicercaInterrotta:
+            pass
+
+    def _popola(self, n, rnd):
+        inizio = time.perf_counter()
+        utente = User.objects.create_user(username=f"bench_{uuid.uuid4().hex[:8]}")
+        Tag.objects.bulk_create([Tag(nome=f"bench-{p}") for p in PAROLE + AGGETTIVI], ignore_conflicts=True)
+        tags = list(Tag.objects.filter(nome__startswith="bench-"))
+        primo_id = (Prodotto.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        prodotti = [
+            Prodotto(
+                id=primo_id + i,
+                nome=f"{rnd.choice(PAROLE).capitalize()} {rnd.choice(AGGETTIVI)} {i}",
+                descrizione_breve=" ".join(rnd.choice(AGGETTIVI + PAROLE) for _ in range(8)),
+                prezzo=rnd.randint(1, 500),
+            )
+            for i in range(n)
+        ]
+        Prodotto.objects.bulk_create(prodotti, batch_size=1000)
+        through = Prodotto.tags.through
+        through.objects.bulk_create(
+            [through(prodotto_id=p.id, tag_id=t.id) for p in prodotti for t in rnd.sample(tags, 2)],
+            batch_size=1000,
+        )
+        Annuncio.objects.bulk_create(
+            [Annuncio(inserzionista=utente, prodotto=p, qta_magazzino=rnd.randint(0, 20)) for p in prodotti],
+            batch_size=1000,
+        )
+        self.stdout.write(f"Dataset di {n} annunci creato in {time.perf_counter() - inizio:.1f}s")
+
+    def _misura(self, backend, query, ripetizioni, rilevanza):
+        tempi = []
+        for _ in range(ripetizioni):
+            inizio = time.perf_counter()
+            annunci = backend.filtra(Annuncio.objects.filter(qta_magazzino__gt=0), query)
+            if rilevanza:
+                annunci = backend.ordina_per_rilevanza(annunci, query)
+            else:
+                annunci = annunci.order_by('-data_pubblicazione')
+            n = annunci.count()
+            list(annunci[:MAX_PAGINATOR_RICERCA_VALUE])
+            tempi.append(time.perf_counter() - inizio)
+        return n, statistics.median(tempi) * 1000
+
+    def _confronta(self, ripetizioni):
+        self.stdout.write(f"{'query':<22}{'risultati':>10}{'orm ms':>10}{'fts ms':>10}{'fts+rank ms':>13}")
+        for query in QUERY:
+            n_orm, t_orm = self._misura(BackendOrm(), query, ripetizioni, False)
+            n_fts, t_fts = self._misura(BackendFts5(), query, ripetizioni, False)
+            _, t_rank = self._misura(BackendFts5(), query, ripetizioni, True)
+            if n_orm != n_fts:
+                self.stderr.write(f"Risultati diversi per '{query}': orm={n_orm} fts={n_fts}")
+            self.stdout.write(f"{query:<22}{n_fts:>10}{t_orm:>10.1f}{t_fts:>10.1f}{t_rank:>13.1f}")
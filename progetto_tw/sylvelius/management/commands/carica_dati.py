@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from progetto_tw.constants import CARICAMENTO_BATCH
+from progetto_tw.importa_dati import DATI_JSON, carica_dati
+
+class Command(BaseCommand):
+    help = "Carica utenti, prodotti, annunci, ordini e commenti da un file JSON (di default static/json/dati.json)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('percorso', nargs='?', default=DATI_JSON, help="File JSON da caricare")
+        parser.add_argument('--batch', type=int, default=CARICAMENTO_BATCH, help="Record per ogni bulk_create")
+        parser.add_argument('--reset', action='store_true', help="Svuota prima i dati esistenti (come il vecchio delete_db)")
+
+    def handle(self, *args, **options):
+        conteggi = carica_dati(options['percorso'], batch=options['batch'], reset=options['reset'])
+        if not options['verbosity']:
+            return
+        riepilogo = ", ".join(f"{sezione}: {numero}" for sezione, numero in conteggi.items())
+        self.stdout.write(self.style.SUCCESS(f"Dati caricati ({riepilogo})"))
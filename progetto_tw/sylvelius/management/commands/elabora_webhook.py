@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from progetto_tw.constants import WEBHOOK_BATCH, WEBHOOK_INTERVALLO_SECONDI
+from purchase.webhook import elabora_eventi, ritenta_falliti
+
+class Command(BaseCommand):
+    help = "Regola i pagamenti degli eventi PayPal salvati dal webhook e non ancora elaborati"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=WEBHOOK_BATCH, help="Eventi prelevati per ogni giro")
+        parser.add_argument('--continuo', action='store_true',
+                            help="Resta in attesa di nuovi eventi (worker) invece di fermarsi a coda vuota")
+        parser.add_argument('--ritenta-falliti', action='store_true',
+                            help="Rimette in coda gli eventi fermi dopo troppi errori prima di elaborare")
+
+    def handle(self, *args, **options):
+        if options['ritenta_falliti']:
+            self.stdout.write(f"Eventi rimessi in coda: {ritenta_falliti()}")
+        if not options['continuo']:
+            elaborati = elabora_eventi(options['batch'])
+            self.stdout.write(self.style.SUCCESS(f"Eventi elaborati: {elaborati}"))
+            return
+        while True:
+            try:
+                elaborati = elabora_eventi(options['batch'])
+            except Exception as e:
+                # Es. database non raggiungibile: si riprova al giro successivo
+                self.stderr.write(f"Elaborazione degli eventi non riuscita: {e}")
+                elaborati = 0
+            if elaborati and options['verbosity']:
+                self.stdout.write(f"Eventi elaborati: {elaborati}")
+            close_old_connections()
+            time.sleep(WEBHOOK_INTERVALLO_SECONDI)
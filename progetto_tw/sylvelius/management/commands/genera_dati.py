@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from progetto_tw.constants import CARICAMENTO_BATCH, GENERATORE_PROFILI, GENERATORE_ZIPF_ESPONENTE
+from progetto_tw.dati_sintetici import genera_record
+from progetto_tw.importa_dati import CaricatoreDati, scrivi_sezioni
+
+class Command(BaseCommand):
+    help = "Genera un dataset sintetico riproducibile (utenti, prodotti, tag, annunci, ordini, commenti, notifiche) per i benchmark"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profilo', choices=list(GENERATORE_PROFILI), default='piccolo',
+                            help="Dimensioni di partenza, modificabili con le opzioni sotto")
+        for sezione in GENERATORE_PROFILI['piccolo']:
+            parser.add_argument(f'--{sezione}', type=int, default=None, help=f"Numero di {sezione}")
+        parser.add_argument('--seed', type=int, default=0, help="Stesso seed, stesso dataset")
+        parser.add_argument('--zipf', type=float, default=GENERATORE_ZIPF_ESPONENTE,
+                            help="Esponente della distribuzione di popolarità di tag e prodotti")
+        parser.add_argument('--batch', type=int, default=CARICAMENTO_BATCH, help="Record per ogni bulk_create")
+        parser.add_argument('--output', default=None,
+                            help="Scrive il JSON (formato di carica_dati) invece di caricarlo nel database")
+
+    def handle(self, *args, **options):
+        numero = {
+            sezione: options[sezione] if options[sezione] is not None else valore
+            for sezione, valore in GENERATORE_PROFILI[options['profilo']].items()
+        }
+        if any(valore < 0 for valore in numero.values()):
+            raise CommandError("I numeri di record non possono essere negativi")
+        if numero['utenti'] < 1 and any(numero[s] for s in ('prodotti', 'ordini', 'commenti', 'notifiche')):
+            raise CommandError("Serve almeno un utente")
+
+        record = genera_record(numero, seed=options['seed'], esponente=options['zipf'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                scrivi_sezioni(record, file)
+            self.stdout.write(self.style.SUCCESS(f"Dataset scritto in {options['output']}"))
+            return
+
+        with transaction.atomic():
+            conteggi = CaricatoreDati(options['batch']).carica(record)
+        riepilogo = ", ".join(f"{sezione}: {valore}" for sezione, valore in conteggi.items())
+        self.stdout.write(self.style.SUCCESS(f"Dataset generato ({riepilogo})"))
@@ -0,0 +1,44 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from sylvelius.immagini import genera_derivate, is_derivata
+from sylvelius.models import ImmagineProdotto
+
+class Command(BaseCommand):
+    help = "Rigenera le miniature (card, carosello, full) di tutte le immagini dei prodotti"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help="Numero di processi da usare (1 = nessun pool)"
+        )
+        parser.add_argument(
+            '--forza', action='store_true',
+            help="Rigenera anche le derivate già presenti"
+        )
+
+    def handle(self, *args, **options):
+        cartella = os.path.join(settings.MEDIA_ROOT, ImmagineProdotto._meta.get_field('immagine').upload_to) # type: ignore
+        if not os.path.isdir(cartella):
+            self.stdout.write(f"Cartella {cartella} inesistente, nulla da fare")
+            return
+
+        percorsi = sorted(
+            voce.path for voce in os.scandir(cartella)
+            if voce.is_file() and not is_derivata(voce.name) and not voce.name.endswith('.tmp')
+        )
+        forza = [options['forza']] * len(percorsi)
+
+        if options['workers'] > 1:
+            with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+                risultati = list(pool.map(genera_derivate, percorsi, forza, chunksize=8))
+        else:
+            risultati = list(map(genera_derivate, percorsi, forza))
+
+        generate = sum(len(scritte) for scritte in risultati)
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(percorsi)} immagini elaborate, {generate} derivate generate"
+        ))
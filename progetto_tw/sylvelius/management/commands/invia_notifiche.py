@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from sylvelius.notifiche import svuota_coda_notifiche
+
+class Command(BaseCommand):
+    help = "Invia sul channel layer le notifiche rimaste nella outbox (es. accodate da processi senza WebSocket)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=None, help="Notifiche prelevate per ogni giro")
+
+    def handle(self, *args, **options):
+        if options['batch']:
+            inviate = svuota_coda_notifiche(options['batch'])
+        else:
+            inviate = svuota_coda_notifiche()
+        self.stdout.write(self.style.SUCCESS(f"Notifiche inviate: {inviate}"))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from sylvelius.models import Annuncio, CommentoAnnuncio
+
+BATCH_SIZE = 1000
+
+class Command(BaseCommand):
+    help = "Ricalcola somma, numero e media dei rating di tutti gli annunci a partire dai commenti"
+
+    def handle(self, *args, **options):
+        aggregati = {
+            riga['annuncio_id']: (riga['somma'], riga['numero'])
+            for riga in CommentoAnnuncio.objects
+                .values('annuncio_id')
+                .annotate(somma=Sum('rating'), numero=Count('id'))
+                .order_by()
+        }
+
+        campi = ['rating_somma', 'rating_numero', 'rating_media']
+        aggiornati = 0
+        batch = []
+        with transaction.atomic():
+            for annuncio in Annuncio.objects.only('id', *campi).order_by('id').iterator(chunk_size=BATCH_SIZE):
+                somma, numero = aggregati.get(annuncio.id, (0, 0)) # type: ignore
+                annuncio.rating_somma = somma
+                annuncio.rating_numero = numero
+                annuncio.rating_media = somma / numero if numero else None
+                batch.append(annuncio)
+                if len(batch) >= BATCH_SIZE:
+                    Annuncio.objects.bulk_update(batch, campi)
+                    aggiornati += len(batch)
+                    batch = []
+            if batch:
+                Annuncio.objects.bulk_update(batch, campi)
+                aggiornati += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(f"Rating ricalcolati per {aggiornati} annunci"))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from sylvelius.ricerca import get_backend
+
+class Command(BaseCommand):
+    help = "Ricostruisce da zero l'indice della ricerca testuale (dopo import massivi con bulk_create)"
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        with transaction.atomic():
+            backend.ricostruisci()
+        self.stdout.write(self.style.SUCCESS(f"Indice ricostruito ({type(backend).__name__})"))
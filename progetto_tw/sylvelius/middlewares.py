@@ -1,3 +1,19 @@
+import contextvars
+import json
+import logging
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.template.base import Template
+
+from progetto_tw.constants import STRUMENTAZIONE_SOGLIA_DUPLICATE
+from progetto_tw.permessi import is_moderatore
+
+logger = logging.getLogger('sylvelius.strumentazione')
+
 class AllowPopupCrossOriginMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -6,3 +22,97 @@ class AllowPopupCrossOriginMiddleware:
         response = self.get_response(request)
         response['Cross-Origin-Opener-Policy'] = 'same-origin-allow-popups'
         return response
+
+class ModeratoreMiddleware:
+    # Imposta request.is_moderator una volta per richiesta (dopo AuthenticationMiddleware)
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        is_moderatore(request)
+        return self.get_response(request)
+
+_misure_correnti = contextvars.ContextVar('misure_correnti', default=None)
+_render_originale = Template._render
+
+def _render_misurato(self, context):
+    # Conta solo il template più esterno: gli {% include %} sono già nel suo tempo
+    misure = _misure_correnti.get()
+    if misure is None or misure.in_render:
+        return _render_originale(self, context)
+    misure.in_render = True
+    inizio = time.perf_counter()
+    try:
+        return _render_originale(self, context)
+    finally:
+        misure.render_ms += (time.perf_counter() - inizio) * 1000
+        misure.in_render = False
+
+class MisureRichiesta:
+    def __init__(self):
+        self.query = Counter()
+        self.sql_ms = 0.0
+        self.render_ms = 0.0
+        self.in_render = False
+
+    def __call__(self, execute, sql, params, many, context):
+        # execute_wrapper: lo stesso SQL parametrico ripetuto è il segno di un N+1
+        inizio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_ms += (time.perf_counter() - inizio) * 1000
+            self.query[sql] += 1
+
+    @property
+    def duplicate(self):
+        return sum(n - 1 for n in self.query.values() if n > 1)
+
+class StrumentazioneMiddleware:
+    # Attivo solo con STRUMENTAZIONE=1 nel file .env. Per ogni richiesta: numero di
+    # query, tempo SQL, query duplicate e tempo di render, nell'header Server-Timing
+    # e in una riga JSON sul logger sylvelius.strumentazione. Non richiede DEBUG.
+    def __init__(self, get_response):
+        if not getattr(settings, 'STRUMENTAZIONE', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        Template._render = _render_misurato
+
+    def __call__(self, request):
+        misure = MisureRichiesta()
+        token = _misure_correnti.set(misure)
+        inizio = time.perf_counter()
+        try:
+            with connection.execute_wrapper(misure):
+                response = self.get_response(request)
+        finally:
+            _misure_correnti.reset(token)
+        totale_ms = (time.perf_counter() - inizio) * 1000
+
+        numero = sum(misure.query.values())
+        response['Server-Timing'] = ", ".join([
+            f'sql;desc="{numero} query, {misure.duplicate} duplicate";dur={misure.sql_ms:.1f}',
+            f'render;dur={misure.render_ms:.1f}',
+            f'totale;dur={totale_ms:.1f}',
+        ])
+
+        match = getattr(request, 'resolver_match', None)
+        dati = {
+            'view': match.view_name if match else None,
+            'metodo': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'query': numero,
+            'duplicate': misure.duplicate,
+            'sql_ms': round(misure.sql_ms, 1),
+            'render_ms': round(misure.render_ms, 1),
+            'totale_ms': round(totale_ms, 1),
+        }
+        if misure.duplicate >= STRUMENTAZIONE_SOGLIA_DUPLICATE:
+            dati['piu_ripetute'] = [
+                {'sql': sql, 'volte': n} for sql, n in misure.query.most_common(3) if n > 1
+            ]
+            logger.warning(json.dumps(dati, ensure_ascii=False))
+        else:
+            logger.info(json.dumps(dati, ensure_ascii=False))
+        return response
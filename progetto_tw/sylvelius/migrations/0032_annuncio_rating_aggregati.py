@@ -0,0 +1,47 @@
+# Generated by Django 5.2.1 on 2026-10-18 10:26
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def popola_rating(apps, schema_editor):
+    Annuncio = apps.get_model('sylvelius', 'Annuncio')
+    CommentoAnnuncio = apps.get_model('sylvelius', 'CommentoAnnuncio')
+    aggregati = (
+        CommentoAnnuncio.objects
+        .values('annuncio_id')
+        .annotate(somma=Sum('rating'), numero=Count('id'))
+        .order_by()
+    )
+    for riga in aggregati:
+        Annuncio.objects.filter(pk=riga['annuncio_id']).update(
+            rating_somma=riga['somma'],
+            rating_numero=riga['numero'],
+            rating_media=riga['somma'] / riga['numero']
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sylvelius', '0031_alter_annuncio_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annuncio',
+            name='rating_media',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='annuncio',
+            name='rating_numero',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='annuncio',
+            name='rating_somma',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(popola_rating, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+import django.db.models.deletion
+import sylvelius.models
+from django.db import migrations, models
+
+
+# Nome fisso: le migrazioni non devono dipendere da costanti che possono cambiare
+TABELLA = 'sylvelius_prodotto_fts'
+
+
+def crea_indice(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Prodotto = apps.get_model('sylvelius', 'Prodotto')
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABELLA} "
+        "USING fts5(nome, descrizione_breve, tags, tokenize='trigram')"
+    )
+    # Pesi bm25 per colonna: il nome conta più dei tag, i tag più della descrizione
+    schema_editor.execute(
+        f"INSERT INTO {TABELLA}({TABELLA}, rank) VALUES ('rank', 'bm25(10.0, 2.0, 5.0)')"
+    )
+    tags = {}
+    for p_id, nome in Prodotto.tags.through.objects.values_list('prodotto_id', 'tag__nome'):
+        tags.setdefault(p_id, []).append(nome)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {TABELLA}(rowid, nome, descrizione_breve, tags) VALUES (%s, %s, %s, %s)",
+            [(p_id, nome, descr, ' '.join(tags.get(p_id, [])))
+             for p_id, nome, descr in Prodotto.objects.values_list('id', 'nome', 'descrizione_breve')]
+        )
+
+
+def elimina_indice(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f"DROP TABLE IF EXISTS {TABELLA}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sylvelius', '0032_annuncio_rating_aggregati'),
+    ]
+
+    operations = [
+        migrations.RunPython(crea_indice, elimina_indice),
+        migrations.CreateModel(
+            name='IndiceRicercaProdotto',
+            fields=[
+                ('prodotto', models.OneToOneField(db_column='rowid', db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='indice_ricerca', serialize=False, to='sylvelius.prodotto')),
+                ('nome', models.TextField()),
+                ('descrizione_breve', models.TextField()),
+                ('tags', models.TextField()),
+                ('testo', sylvelius.models.CampoFts(db_column='sylvelius_prodotto_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'sylvelius_prodotto_fts',
+                'managed': False,
+            },
+        ),
+    ]
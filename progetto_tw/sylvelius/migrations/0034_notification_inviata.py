@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sylvelius', '0033_prodotto_fts'),
+    ]
+
+    operations = [
+        # Le notifiche già esistenti sono già state inviate: default True solo per quelle
+        migrations.AddField(
+            model_name='notification',
+            name='inviata',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AlterField(
+            model_name='notification',
+            name='inviata',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.1 on 2026-10-18 11:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sylvelius', '0034_notification_inviata'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LetturaNotifiche',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ultima_globale_letta', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Letture notifiche',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['recipient', 'created_at', 'id'], name='notifica_personale_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('is_global', True)), fields=['created_at', 'id'], name='notifica_globale_idx'),
+        ),
+        migrations.AddField(
+            model_name='letturanotifiche',
+            name='utente',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='lettura_notifiche', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
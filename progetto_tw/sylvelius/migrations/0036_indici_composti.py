@@ -0,0 +1,56 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:04
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sylvelius', '0035_notifiche_globali_lettura'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='inviata',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='annuncio',
+            index=models.Index(condition=models.Q(('is_published', True), ('qta_magazzino__gt', 0)), fields=['data_pubblicazione'], name='annuncio_vetrina_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='annuncio',
+            index=models.Index(condition=models.Q(('is_published', True)), fields=['data_pubblicazione'], name='annuncio_pubblicato_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='annuncio',
+            index=models.Index(fields=['inserzionista', 'data_pubblicazione'], name='annuncio_inserzionista_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='commentoannuncio',
+            index=models.Index(fields=['annuncio', 'data_pubblicazione', 'id'], name='commento_annuncio_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='commentoannuncio',
+            index=models.Index(fields=['utente', 'data_pubblicazione', 'id'], name='commento_utente_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('read', False)), fields=['recipient'], name='notifica_non_letta_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('inviata', False)), fields=['id'], name='notifica_da_inviare_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ordine',
+            index=models.Index(fields=['utente', 'data_ordine', 'id'], name='ordine_utente_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ordine',
+            index=models.Index(fields=['prodotto', 'stato_consegna'], name='ordine_prodotto_stato_idx'),
+        ),
+    ]
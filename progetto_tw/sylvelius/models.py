@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Count, Sum, Window
+from django.db.models.functions import RowNumber
 import json
 from django.core.validators import MinValueValidator, MaxValueValidator
 from progetto_tw.constants import (
@@ -21,8 +23,12 @@ from progetto_tw.constants import (
     INVALID_COMMNT_RATING_VALUE,
     MAX_MESSAGE_MESSAGE_VALUE,
     ALIQUOTE_LIST,
-    MAX_MESSAGE_TITLE_VALUE
+    MAX_MESSAGE_TITLE_VALUE,
+    IMG_VARIANTI_DIMENSIONI,
+    IMG_VARIANTI_FORMATI,
+    FTS_TABELLA,
 )
+from .immagini import genera_derivate, nome_derivata
 
 # Create your models here.
 class Tag(models.Model):
@@ -52,6 +58,35 @@ class Prodotto(models.Model):
     class Meta:
         verbose_name_plural = "Prodotti"
 
+class Match(models.Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} MATCH {rhs}", lhs_params + rhs_params
+
+class CampoFts(models.TextField):
+    pass
+
+CampoFts.register_lookup(Match)
+
+class IndiceRicercaProdotto(models.Model):
+    # Tabella virtuale FTS5 (migrazione 0033), tenuta allineata da signals.py.
+    # La colonna nascosta con il nome della tabella accetta MATCH su tutte le colonne,
+    # rank è il punteggio bm25 pesato (più basso = più pertinente).
+    prodotto = models.OneToOneField(Prodotto, primary_key=True, db_column='rowid', db_constraint=False,
+                                    on_delete=models.DO_NOTHING, related_name='indice_ricerca')
+    nome = models.TextField()
+    descrizione_breve = models.TextField()
+    tags = models.TextField()
+    testo = CampoFts(db_column=FTS_TABELLA)
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = FTS_TABELLA
+
 class ImmagineProdotto(models.Model):
     prodotto = models.ForeignKey(Prodotto, on_delete=models.CASCADE, related_name='immagini')
     immagine = models.ImageField(upload_to='prodotti/immagini/', blank=True, null=True)
@@ -62,6 +97,57 @@ class ImmagineProdotto(models.Model):
     class Meta:
         verbose_name_plural = "Immagini Prodotti"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if self.immagine:
+            genera_derivate(self.immagine.storage.path(self._nome_file))
+
+    @property
+    def _nome_file(self):
+        # dati.json salva i percorsi con lo "/" iniziale
+        return self.immagine.name.lstrip('/') # type: ignore
+
+    def formati_variante(self, variante):
+        # {formato: url} delle derivate già generate di una sola variante
+        formati = {}
+        if not self.immagine:
+            return formati
+        storage = self.immagine.storage
+        for estensione, _ in IMG_VARIANTI_FORMATI:
+            nome = nome_derivata(self._nome_file, variante, estensione)
+            if storage.exists(nome):
+                formati[estensione] = storage.url(nome)
+        return formati
+
+    @property
+    def derivate_card(self):
+        # Le card usano solo questa: due controlli sul disco invece di sei
+        return self.formati_variante('card')
+
+    @property
+    def varianti(self):
+        # {variante: {formato: url}} delle sole derivate già generate
+        varianti = {}
+        for variante, _ in IMG_VARIANTI_DIMENSIONI:
+            formati = self.formati_variante(variante)
+            if formati:
+                varianti[variante] = formati
+        return varianti
+
+    def url_variante(self, variante, estensione="webp"):
+        # Url della derivata se presente, altrimenti dell'originale
+        nome = nome_derivata(self._nome_file, variante, estensione)
+        if self.immagine.storage.exists(nome):
+            return self.immagine.storage.url(nome)
+        return self.immagine.url
+
+    @classmethod
+    def prime_per_prodotto(cls):
+        # Solo la prima immagine (id più basso) di ogni prodotto, in un'unica query
+        return cls.objects.annotate(
+            posizione=Window(RowNumber(), partition_by='prodotto', order_by='id')
+        ).filter(posizione=1)
+
 class Annuncio(models.Model):
     uuid = models.CharField(max_length=MAX_ANNU_UUID_CHARS, unique=True, blank=True, null=True)
     inserzionista = models.ForeignKey('auth.User', on_delete=models.CASCADE, related_name='annunci')
@@ -75,6 +161,10 @@ class Annuncio(models.Model):
         default=MIN_ANNU_QTA_MAGAZZINO_VALUE
     )
     is_published = models.BooleanField(default=True)
+    # Aggregati dei commenti, mantenuti da sylvelius.signals e ricalcolabili con "manage.py ricalcola_rating"
+    rating_somma = models.PositiveIntegerField(default=0, editable=False)
+    rating_numero = models.PositiveIntegerField(default=0, editable=False)
+    rating_media = models.FloatField(null=True, blank=True, editable=False, db_index=True)
 
     def __str__(self):
         return self.prodotto.nome + " - " + self.inserzionista.username
@@ -82,17 +172,40 @@ class Annuncio(models.Model):
     class Meta:
         ordering = ['-data_pubblicazione']
         verbose_name_plural = "Annunci"
+        indexes = [
+            # Home: pubblicati e disponibili, dai più recenti. Parziale perché Django
+            # scrive is_published=True come WHERE "is_published" senza confronto
+            models.Index(fields=['data_pubblicazione'], condition=models.Q(is_published=True, qta_magazzino__gt=0),
+                         name='annuncio_vetrina_idx'),
+            # Ricerca senza filtri e profili pubblici: solo pubblicati
+            models.Index(fields=['data_pubblicazione'], condition=models.Q(is_published=True),
+                         name='annuncio_pubblicato_idx'),
+            models.Index(fields=['inserzionista', 'data_pubblicazione'], name='annuncio_inserzionista_idx'),
+        ]
 
     @property
     def rating_medio(self):
-        commenti = self.commenti.all() # type: ignore
-        if not commenti:
+        if not self.rating_numero:
             return INVALID_COMMNT_RATING_VALUE
-        return sum(commento.rating for commento in commenti) / len(commenti)
+        return self.rating_media
     
     @property
     def rating_count(self):
-        return self.commenti.count() # type: ignore
+        return self.rating_numero
+
+    @classmethod
+    def aggiorna_rating(cls, annuncio_id):
+        aggregati = CommentoAnnuncio.objects.filter(annuncio_id=annuncio_id).aggregate(
+            somma=Sum('rating'),
+            numero=Count('id')
+        )
+        somma = aggregati['somma'] or 0
+        numero = aggregati['numero']
+        cls.objects.filter(pk=annuncio_id).update(
+            rating_somma=somma,
+            rating_numero=numero,
+            rating_media=somma / numero if numero else None
+        )
 
 class CommentoAnnuncio(models.Model):
     annuncio = models.ForeignKey(Annuncio, on_delete=models.CASCADE, related_name='commenti')
@@ -108,6 +221,11 @@ class CommentoAnnuncio(models.Model):
     
     class Meta:
         verbose_name_plural = "Commenti Annunci"
+        indexes = [
+            # Paginazione keyset su (data_pubblicazione, id)
+            models.Index(fields=['annuncio', 'data_pubblicazione', 'id'], name='commento_annuncio_idx'),
+            models.Index(fields=['utente', 'data_pubblicazione', 'id'], name='commento_utente_idx'),
+        ]
 
 class Ordine(models.Model):
     invoice = models.CharField(max_length=MAX_ORDN_INVOICE_CHARS, unique=True, blank=True, null=True)
@@ -132,6 +250,10 @@ class Ordine(models.Model):
     
     class Meta:
         verbose_name_plural = "Ordini"
+        indexes = [
+            models.Index(fields=['utente', 'data_ordine', 'id'], name='ordine_utente_idx'),
+            models.Index(fields=['prodotto', 'stato_consegna'], name='ordine_prodotto_stato_idx'),
+        ]
     
 class Notification(models.Model):
     recipient = models.ForeignKey('auth.User', on_delete=models.CASCADE, related_name='notifications', null=True, blank=True)
@@ -142,10 +264,33 @@ class Notification(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     read = models.BooleanField(default=False)
     is_global = models.BooleanField(default=False)
+    # Outbox: False finché il dispatcher non l'ha inoltrata sul channel layer
+    inviata = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Uno per flusso: personali dell'utente e globali, dalle più recenti
+            models.Index(fields=['recipient', 'created_at', 'id'], name='notifica_personale_idx'),
+            # Parziale: Django scrive il filtro is_global=True come WHERE "is_global" senza confronto
+            models.Index(fields=['created_at', 'id'], condition=models.Q(is_global=True), name='notifica_globale_idx'),
+            models.Index(fields=['recipient'], condition=models.Q(read=False), name='notifica_non_letta_idx'),
+            # Outbox: solo le righe ancora da inviare, nell'ordine in cui le preleva il dispatcher
+            models.Index(fields=['id'], condition=models.Q(inviata=False), name='notifica_da_inviare_idx'),
+        ]
 
     def __str__(self):
         utnt = "utente" if not self.recipient else self.recipient.username
         return utnt + " HA RICEVUTO " + self.title + " CON MESSAGGIO " + self.message
+
+class LetturaNotifiche(models.Model):
+    # Le notifiche globali sono salvate una volta sola e il loro campo read non è
+    # per utente: ogni utente ha l'id dell'ultima globale letta
+    utente = models.OneToOneField('auth.User', on_delete=models.CASCADE, related_name='lettura_notifiche')
+    ultima_globale_letta = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Letture notifiche"
+
+    def __str__(self):
+        return self.utente.username + " HA LETTO LE GLOBALI FINO A " + str(self.ultima_globale_letta)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from heapq import merge
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import BooleanField, ExpressionWrapper, F, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from progetto_tw.constants import (
+    MAX_MESSAGES_PER_PAGE,
+    MAX_NOTIFICHE_PER_MESSAGGIO,
+    NOTIFICHE_BATCH,
+    NOTIFICHE_INTERVALLO_SECONDI,
+)
+from progetto_tw.paginazione import codifica_cursore, decodifica_cursore, filtro_keyset, valore_keyset
+
+logger = logging.getLogger(__name__)
+
+def accoda_notifiche(notifiche):
+    # Outbox: le notifiche si salvano con un solo INSERT e restano inviata=False;
+    # l'invio sul channel layer lo fa il dispatcher dopo il commit della richiesta
+    from .models import Notification
+
+    notifiche = Notification.objects.bulk_create(notifiche)
+    if notifiche:
+        transaction.on_commit(dispatcher.sveglia)
+    return notifiche
+
+def _cursore_globali(user):
+    from .models import LetturaNotifiche
+
+    return Coalesce(Subquery(
+        LetturaNotifiche.objects.filter(utente=user).values('ultima_globale_letta')[:1]
+    ), Value(0))
+
+def notifiche_utente(user, limite=MAX_MESSAGES_PER_PAGE, cursore=None):
+    # Fan-out in lettura: le ultime personali e le ultime globali con due query
+    # sui rispettivi indici, unite per data. Una globale è letta se non è più
+    # recente del cursore di lettura dell'utente. Restituisce le notifiche dalla
+    # più recente e il cursore keyset della pagina successiva (o None).
+    from .models import Notification
+
+    ordine = ('-created_at', '-id')
+    campi = ('id', 'title', 'message', 'created_at', 'letta')
+    personali = Notification.objects.filter(recipient=user, is_global=False).annotate(letta=F('read'))
+    globali = Notification.objects.filter(is_global=True).annotate(
+        letta=ExpressionWrapper(Q(id__lte=_cursore_globali(user)), output_field=BooleanField())
+    )
+    posizione = decodifica_cursore(cursore)
+    if posizione is not None:
+        valore, pk, _, _ = posizione
+        personali = personali.filter(filtro_keyset('created_at', valore, pk))
+        globali = globali.filter(filtro_keyset('created_at', valore, pk))
+    recenti = list(merge(
+        personali.order_by(*ordine).values(*campi)[:limite + 1],
+        globali.order_by(*ordine).values(*campi)[:limite + 1],
+        key=lambda n: (n['created_at'], n['id']), reverse=True
+    ))
+    successivo = None
+    if len(recenti) > limite:
+        recenti = recenti[:limite]
+        successivo = codifica_cursore(*valore_keyset(recenti[-1], 'created_at'))
+    return recenti, successivo
+
+def segna_notifiche_lette(user):
+    from .models import LetturaNotifiche, Notification
+
+    Notification.objects.filter(recipient=user, read=False).update(read=True)
+    # Le globali non si toccano: basta spostare il cursore sull'ultima
+    ultima = Notification.objects.filter(is_global=True).order_by(
+        '-created_at', '-id').values_list('id', flat=True).first()
+    LetturaNotifiche.objects.update_or_create(utente=user, defaults={'ultima_globale_letta': ultima or 0})
+
+def preleva_notifiche(batch=NOTIFICHE_BATCH):
+    # Le righe prelevate vengono segnate subito come inviate: se il channel layer
+    # non risponde la notifica resta comunque nel database e nel menu delle notifiche
+    from .models import Notification
+
+    with transaction.atomic():
+        righe = list(
+            Notification.objects.select_for_update(skip_locked=True)
+            .filter(inviata=False).order_by('id')
+            .values_list('id', 'recipient_id', 'is_global', 'title', 'message')[:batch]
+        )
+        Notification.objects.filter(id__in=[riga[0] for riga in righe]).update(inviata=True)
+    return righe
+
+def messaggi_notifiche(righe):
+    # Una notifica sola per gruppo mantiene il vecchio messaggio "send_notification",
+    # più notifiche vanno in messaggi "send_notifications" da MAX_NOTIFICHE_PER_MESSAGGIO
+    gruppi = {}
+    for _, recipient_id, is_global, title, message in righe:
+        if is_global:
+            gruppo = "global"
+        elif recipient_id:
+            gruppo = f"user_{recipient_id}"
+        else:
+            continue
+        gruppi.setdefault(gruppo, []).append({"title": title, "message": message})
+    for gruppo, notifiche in gruppi.items():
+        if len(notifiche) == 1:
+            yield gruppo, {"type": "send_notification", **notifiche[0]}
+            continue
+        for i in range(0, len(notifiche), MAX_NOTIFICHE_PER_MESSAGGIO):
+            yield gruppo, {"type": "send_notifications", "notifiche": notifiche[i:i + MAX_NOTIFICHE_PER_MESSAGGIO]}
+
+async def invia_notifiche_in_coda(batch=NOTIFICHE_BATCH):
+    channel_layer = get_channel_layer()
+    inviate = 0
+    while True:
+        righe = await database_sync_to_async(preleva_notifiche)(batch)
+        if not righe:
+            return inviate
+        for gruppo, messaggio in messaggi_notifiche(righe):
+            await channel_layer.group_send(gruppo, messaggio) #type: ignore
+        inviate += len(righe)
+
+class DispatcherNotifiche:
+    # Task sul loop del server ASGI, avviato dalla prima connessione alle notifiche:
+    # svuota la outbox quando una richiesta la sveglia dopo il commit e comunque ogni
+    # NOTIFICHE_INTERVALLO_SECONDI (notifiche accodate da altri processi o da comandi).
+    def __init__(self):
+        self._loop = None
+        self._task = None
+        self._evento = None
+
+    def attivo(self):
+        return self._task is not None and not self._task.done()
+
+    def avvia(self):
+        loop = asyncio.get_running_loop()
+        if self.attivo() and self._loop is loop:
+            return
+        self._loop = loop
+        self._evento = asyncio.Event()
+        self._task = loop.create_task(self._ciclo())
+
+    async def ferma(self):
+        if self.attivo():
+            self._task.cancel() #type: ignore
+            try:
+                await self._task #type: ignore
+            except asyncio.CancelledError:
+                pass
+        self._loop = self._task = self._evento = None
+
+    def sveglia(self):
+        # Chiamata dai thread delle view: senza dispatcher attivo le notifiche
+        # aspettano in coda la prima connessione (o il comando invia_notifiche)
+        loop, evento = self._loop, self._evento
+        if loop is not None and evento is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(evento.set)
+
+    async def _ciclo(self):
+        while True:
+            try:
+                await invia_notifiche_in_coda()
+            except Exception:
+                logger.exception("Invio delle notifiche in coda non riuscito")
+            try:
+                await asyncio.wait_for(self._evento.wait(), NOTIFICHE_INTERVALLO_SECONDI) #type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self._evento.clear() #type: ignore
+
+dispatcher = DispatcherNotifiche()
+
+def svuota_coda_notifiche(batch=NOTIFICHE_BATCH):
+    # Versione sincrona per i comandi di gestione e i processi senza loop ASGI
+    return async_to_sync(invia_notifiche_in_coda)(batch)
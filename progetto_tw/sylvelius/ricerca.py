@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.utils.module_loading import import_string
+
+from progetto_tw.constants import FTS_MIN_QUERY_CHARS, FTS_TABELLA
+
+class BackendOrm:
+    # Ricerca storica: icontains su nome, descrizione breve e tag.
+    # Nessun indice, nessun punteggio di pertinenza.
+    def disponibile(self):
+        return True
+
+    def filtra(self, annunci, query):
+        return annunci.filter(
+            Q(prodotto__nome__icontains=query) |
+            Q(prodotto__descrizione_breve__icontains=query) |
+            Q(prodotto__tags__nome__icontains=query)
+        ).distinct()
+
+    def ordina_per_rilevanza(self, annunci, query):
+        return annunci.order_by('-data_pubblicazione')
+
+    def indicizza(self, prodotti_ids):
+        pass
+
+    def rimuovi(self, prodotti_ids):
+        pass
+
+    def ricostruisci(self):
+        pass
+
+class BackendFts5(BackendOrm):
+    # Tabella virtuale FTS5 con tokenizer trigram: stessa semantica "contiene"
+    # di icontains ma risolta dall'indice, con punteggio bm25.
+    def disponibile(self):
+        return connection.vendor == 'sqlite'
+
+    def _match(self, query):
+        return '"' + query.replace('"', '""') + '"'
+
+    def _usa_indice(self, query):
+        # Il tokenizer trigram non trova termini più corti di 3 caratteri
+        return self.disponibile() and len(query) >= FTS_MIN_QUERY_CHARS
+
+    def filtra(self, annunci, query):
+        if not self._usa_indice(query):
+            return super().filtra(annunci, query)
+        return annunci.filter(prodotto__indice_ricerca__testo__match=self._match(query))
+
+    def ordina_per_rilevanza(self, annunci, query):
+        # Da chiamare dopo filtra(): rank è valorizzato solo nelle query con MATCH
+        if not self._usa_indice(query):
+            return super().ordina_per_rilevanza(annunci, query)
+        return annunci.annotate(
+            rilevanza=F('prodotto__indice_ricerca__rank')
+        ).order_by('rilevanza', '-data_pubblicazione')
+
+    def _righe(self, prodotti_ids):
+        from .models import Prodotto
+
+        righe = {p_id: [nome, descr, []] for p_id, nome, descr in
+                 Prodotto.objects.filter(id__in=prodotti_ids).values_list('id', 'nome', 'descrizione_breve')}
+        for p_id, tag in Prodotto.tags.through.objects.filter(
+                prodotto_id__in=righe.keys()).values_list('prodotto_id', 'tag__nome'):
+            righe[p_id][2].append(tag)
+        return [(p_id, nome, descr, ' '.join(tags)) for p_id, (nome, descr, tags) in righe.items()]
+
+    def indicizza(self, prodotti_ids):
+        if not self.disponibile():
+            return
+        prodotti_ids = list(prodotti_ids)
+        self.rimuovi(prodotti_ids)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABELLA}(rowid, nome, descrizione_breve, tags) VALUES (%s, %s, %s, %s)",
+                self._righe(prodotti_ids)
+            )
+
+    def rimuovi(self, prodotti_ids):
+        if not self.disponibile():
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"DELETE FROM {FTS_TABELLA} WHERE rowid = %s",
+                [(p_id,) for p_id in prodotti_ids]
+            )
+
+    def ricostruisci(self, batch=1000):
+        from .models import Prodotto
+
+        if not self.disponibile():
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABELLA}")
+        ids = list(Prodotto.objects.values_list('id', flat=True))
+        for i in range(0, len(ids), batch):
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f"INSERT INTO {FTS_TABELLA}(rowid, nome, descrizione_breve, tags) VALUES (%s, %s, %s, %s)",
+                    self._righe(ids[i:i + batch])
+                )
+
+def get_backend():
+    backend = import_string(getattr(settings, 'RICERCA_BACKEND', 'sylvelius.ricerca.BackendFts5'))()
+    if not backend.disponibile():
+        return BackendOrm()
+    return backend
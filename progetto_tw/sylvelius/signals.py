@@ -0,0 +1,84 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .models import Annuncio, CommentoAnnuncio, Prodotto, Tag
+from .ricerca import get_backend
+from .suggerimenti import indice_suggerimenti, indice_tag
+
+def aggiorna_indice_tag(prodotti_ids):
+    if not indice_tag.costruito():
+        return
+    annunci = {}
+    for annuncio_id, pubblicato, tag in Annuncio.objects.filter(prodotto_id__in=prodotti_ids).values_list(
+            'id', 'is_published', 'prodotto__tags__nome'):
+        tags = annunci.setdefault(annuncio_id, set())
+        if pubblicato and tag is not None:
+            tags.add(tag)
+    for annuncio_id, tags in annunci.items():
+        indice_tag.aggiorna_annuncio(annuncio_id, tags)
+
+@receiver(post_save, sender=CommentoAnnuncio)
+@receiver(post_delete, sender=CommentoAnnuncio)
+def aggiorna_rating_annuncio(sender, instance, **kwargs):
+    # Se si sta eliminando l'annuncio stesso non c'è nulla da aggiornare
+    origin = kwargs.get('origin')
+    if isinstance(origin, Annuncio) or getattr(origin, 'model', None) is Annuncio:
+        return
+    Annuncio.aggiorna_rating(instance.annuncio_id)
+
+@receiver(post_save, sender=Prodotto)
+def indicizza_prodotto(sender, instance, **kwargs):
+    get_backend().indicizza([instance.pk])
+    if indice_suggerimenti.costruito():
+        for annuncio_id, pubblicato in Annuncio.objects.filter(prodotto=instance).values_list('id', 'is_published'):
+            indice_suggerimenti.aggiorna(annuncio_id, instance.nome, pubblicato)
+
+@receiver(post_save, sender=Annuncio)
+def aggiorna_suggerimenti_annuncio(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'is_published' not in update_fields:
+        return
+    if indice_suggerimenti.costruito():
+        indice_suggerimenti.aggiorna(instance.pk, instance.prodotto.nome, instance.is_published)
+    aggiorna_indice_tag([instance.prodotto_id])
+
+@receiver(post_delete, sender=Annuncio)
+def rimuovi_suggerimenti_annuncio(sender, instance, **kwargs):
+    indice_suggerimenti.rimuovi(instance.pk)
+    indice_tag.aggiorna_annuncio(instance.pk, ())
+
+@receiver(post_delete, sender=Prodotto)
+def rimuovi_prodotto_indice(sender, instance, **kwargs):
+    get_backend().rimuovi([instance.pk])
+
+@receiver(m2m_changed, sender=Prodotto.tags.through)
+def indicizza_tags_prodotto(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # tag.prodotti.clear(): dopo il clear i prodotti non sono più raggiungibili
+        instance._prodotti_indice = list(instance.prodotti.values_list('id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        prodotti_ids = [instance.pk]
+    elif action == 'post_clear':
+        prodotti_ids = instance._prodotti_indice
+    else:
+        prodotti_ids = list(pk_set)
+    get_backend().indicizza(prodotti_ids)
+    aggiorna_indice_tag(prodotti_ids)
+
+@receiver(pre_delete, sender=Tag)
+def memorizza_prodotti_tag(sender, instance, **kwargs):
+    instance._prodotti_indice = list(instance.prodotti.values_list('id', flat=True))
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def indicizza_prodotti_tag(sender, instance, created=False, **kwargs):
+    if created:
+        indice_tag.aggiungi_tag(instance.nome)
+        return
+    # Rinomina o eliminazione: rare, l'indice dei tag si ricostruisce al prossimo uso
+    indice_tag.invalida()
+    ids = getattr(instance, '_prodotti_indice', None)
+    if ids is None:
+        ids = instance.prodotti.values_list('id', flat=True)
+    get_backend().indicizza(ids)
@@ -0,0 +1,286 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from bisect import bisect_left, insort
+from heapq import nsmallest
+
+from progetto_tw.constants import (
+    MAX_WS_QUERIES,
+    SUGGERIMENTI_CACHE_DIMENSIONE,
+    SUGGERIMENTI_CACHE_TTL_SECONDI,
+    SUGGERIMENTI_MAX_ETA_SECONDI,
+)
+
+_CONFINE_PAROLA = re.compile(r'\b')
+_FINE_CHIAVI = '\U0010ffff'
+
+def _chiavi(nome):
+    # Un suffisso per ogni confine di parola: "cover per x" -> "cover per x", " per x", "per x", ...
+    # così la ricerca per prefisso equivale alla vecchia iregex r'\b<query>'
+    nome = nome.lower()
+    return {nome[m.start():] for m in _CONFINE_PAROLA.finditer(nome) if m.start() < len(nome)}
+
+def _trigrammi(testo):
+    return {testo[i:i + 3] for i in range(len(testo) - 2)}
+
+class CacheLRU:
+    # LRU con scadenza, chiavi (query normalizzata, limite). Non è thread-safe:
+    # la usa l'indice proprietario sotto il proprio lock.
+    def __init__(self, dimensione=SUGGERIMENTI_CACHE_DIMENSIONE, ttl=SUGGERIMENTI_CACHE_TTL_SECONDI):
+        self.dimensione = dimensione
+        self.ttl = ttl
+        self._voci = OrderedDict()
+        self.azzera_statistiche()
+
+    def azzera_statistiche(self):
+        self._statistiche = {'hit': 0, 'miss': 0, 'scadute': 0, 'espulse': 0, 'invalidate': 0}
+
+    def get(self, chiave):
+        voce = self._voci.get(chiave)
+        if voce is not None and voce[0] < time.monotonic():
+            del self._voci[chiave]
+            self._statistiche['scadute'] += 1
+            voce = None
+        if voce is None:
+            self._statistiche['miss'] += 1
+            return None
+        self._voci.move_to_end(chiave)
+        self._statistiche['hit'] += 1
+        return voce[1]
+
+    def set(self, chiave, valore):
+        self._voci[chiave] = (time.monotonic() + self.ttl, valore)
+        self._voci.move_to_end(chiave)
+        while len(self._voci) > self.dimensione:
+            self._voci.popitem(last=False)
+            self._statistiche['espulse'] += 1
+
+    def invalida(self, condizione):
+        # Rimuove solo le query il cui risultato può essere cambiato
+        chiavi = [chiave for chiave in self._voci if condizione(chiave[0])]
+        for chiave in chiavi:
+            del self._voci[chiave]
+        self._statistiche['invalidate'] += len(chiavi)
+
+    def pulisci(self):
+        self._voci.clear()
+
+    def statistiche(self):
+        s = dict(self._statistiche)
+        s['voci'] = len(self._voci)
+        s['dimensione'] = self.dimensione
+        richieste = s['hit'] + s['miss']
+        s['hit_rate'] = s['hit'] / richieste if richieste else 0.0
+        return s
+
+class _IndiceInMemoria:
+    # Base comune degli indici di processo: costruiti al primo utilizzo, aggiornati
+    # dai signals e ricostruiti dopo SUGGERIMENTI_MAX_ETA_SECONDI per recepire le
+    # modifiche fatte da altri processi.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lock_costruzione = threading.Lock()
+        self._cache = CacheLRU()
+        self.svuota()
+
+    def costruito(self):
+        return self._costruito_il is not None
+
+    def da_costruire(self):
+        return self._costruito_il is None or time.monotonic() - self._costruito_il > SUGGERIMENTI_MAX_ETA_SECONDI
+
+    def assicura_costruito(self):
+        # Più connessioni possono chiederlo insieme all'avvio: una sola costruisce
+        with self._lock_costruzione:
+            if self.da_costruire():
+                self.costruisci()
+
+    def invalida(self):
+        with self._lock:
+            self._costruito_il = None
+
+    def svuota(self):
+        with self._lock:
+            self._azzera()
+            self._cache.pulisci()
+            self._cache.azzera_statistiche()
+            self._costruito_il = None
+            self._statistiche = {'richieste': 0, 'hit': 0, 'miss': 0, 'ricostruzioni': 0,
+                                  'tempo_totale_us': 0.0, 'tempo_max_us': 0.0}
+
+    def _segna_costruito(self):
+        self._cache.pulisci()
+        self._costruito_il = time.monotonic()
+        self._statistiche['ricostruzioni'] += 1
+
+    def _registra(self, inizio, risultati):
+        durata = (time.perf_counter() - inizio) * 1_000_000
+        s = self._statistiche
+        s['richieste'] += 1
+        s['hit' if risultati else 'miss'] += 1
+        s['tempo_totale_us'] += durata
+        s['tempo_max_us'] = max(s['tempo_max_us'], durata)
+
+    def statistiche(self):
+        s = dict(self._statistiche)
+        s['tempo_medio_us'] = s['tempo_totale_us'] / s['richieste'] if s['richieste'] else 0.0
+        s['cache'] = self._cache.statistiche()
+        return s
+
+    def cerca(self, query, limite=MAX_WS_QUERIES):
+        inizio = time.perf_counter()
+        chiave = (query.lower(), limite)
+        with self._lock:
+            risultati = self._cache.get(chiave)
+            if risultati is None:
+                risultati = self._cerca(chiave[0], limite)
+                self._cache.set(chiave, risultati)
+        self._registra(inizio, risultati)
+        return list(risultati)
+
+class IndiceSuggerimenti(_IndiceInMemoria):
+    # Array ordinato di (suffisso, nome, annuncio_id) sugli annunci pubblicati,
+    # interrogato con bisect.
+    def _azzera(self):
+        self._voci = []
+        self._annunci = {}
+
+    def costruisci(self):
+        from .models import Annuncio
+
+        annunci = dict(Annuncio.objects.filter(is_published=True).values_list('id', 'prodotto__nome'))
+        voci = sorted(
+            (chiave, nome, annuncio_id)
+            for annuncio_id, nome in annunci.items()
+            for chiave in _chiavi(nome)
+        )
+        with self._lock:
+            self._voci = voci
+            self._annunci = annunci
+            self._segna_costruito()
+
+    def _invalida_cache(self, *nomi):
+        chiavi = set().union(*(_chiavi(nome) for nome in nomi if nome is not None))
+        self._cache.invalida(lambda query: any(chiave.startswith(query) for chiave in chiavi))
+
+    def _rimuovi(self, annuncio_id):
+        nome = self._annunci.pop(annuncio_id, None)
+        if nome is None:
+            return
+        for chiave in _chiavi(nome):
+            voce = (chiave, nome, annuncio_id)
+            i = bisect_left(self._voci, voce)
+            if i < len(self._voci) and self._voci[i] == voce:
+                del self._voci[i]
+
+    def aggiorna(self, annuncio_id, nome, pubblicato):
+        with self._lock:
+            if self._costruito_il is None:
+                return
+            vecchio = self._annunci.get(annuncio_id)
+            if vecchio == (nome if pubblicato else None):
+                return
+            self._invalida_cache(vecchio, nome)
+            self._rimuovi(annuncio_id)
+            if pubblicato:
+                self._annunci[annuncio_id] = nome
+                for chiave in _chiavi(nome):
+                    insort(self._voci, (chiave, nome, annuncio_id))
+
+    def rimuovi(self, annuncio_id):
+        with self._lock:
+            self._invalida_cache(self._annunci.get(annuncio_id))
+            self._rimuovi(annuncio_id)
+
+    def _cerca(self, query, limite):
+        da = bisect_left(self._voci, (query,))
+        a = bisect_left(self._voci, (query + _FINE_CHIAVI,), lo=da)
+        # Stesso nome può comparire con più suffissi: un risultato per annuncio
+        trovati = {annuncio_id: nome for _, nome, annuncio_id in self._voci[da:a]}
+        return [nome for nome, _ in nsmallest(limite, ((nome, i) for i, nome in trovati.items()))]
+
+    def statistiche(self):
+        s = super().statistiche()
+        s['voci'] = len(self._voci)
+        s['annunci'] = len(self._annunci)
+        return s
+
+class IndiceTag(_IndiceInMemoria):
+    # Nomi dei tag con indice a trigrammi per la ricerca per sottostringa e
+    # popolarità = numero di annunci pubblicati che usano il tag.
+    def _azzera(self):
+        self._nomi = []
+        self._trigrammi = {}
+        self._popolarita = {}
+        self._tag_annunci = {}
+
+    def costruisci(self):
+        from .models import Annuncio, Tag
+
+        nomi = sorted(Tag.objects.values_list('nome', flat=True))
+        tag_annunci = {}
+        for annuncio_id, nome in Annuncio.objects.filter(
+                is_published=True, prodotto__tags__isnull=False).values_list('id', 'prodotto__tags__nome'):
+            tag_annunci.setdefault(annuncio_id, set()).add(nome)
+        popolarita = dict.fromkeys(nomi, 0)
+        for tags in tag_annunci.values():
+            for nome in tags:
+                popolarita[nome] += 1
+        trigrammi = {}
+        for nome in nomi:
+            for trigramma in _trigrammi(nome):
+                trigrammi.setdefault(trigramma, set()).add(nome)
+        with self._lock:
+            self._nomi = nomi
+            self._trigrammi = trigrammi
+            self._popolarita = popolarita
+            self._tag_annunci = tag_annunci
+            self._segna_costruito()
+
+    def aggiungi_tag(self, nome):
+        with self._lock:
+            if self._costruito_il is None or nome in self._popolarita:
+                return
+            self._cache.invalida(lambda query: query in nome)
+            insort(self._nomi, nome)
+            self._popolarita[nome] = 0
+            for trigramma in _trigrammi(nome):
+                self._trigrammi.setdefault(trigramma, set()).add(nome)
+
+    def aggiorna_annuncio(self, annuncio_id, tags):
+        # tags: quelli dell'annuncio se pubblicato, nessuno se nascosto o eliminato
+        with self._lock:
+            if self._costruito_il is None:
+                return
+            tags = set(tags)
+            vecchi = self._tag_annunci.pop(annuncio_id, set())
+            cambiati = vecchi ^ tags
+            if cambiati:
+                self._cache.invalida(lambda query: any(query in nome for nome in cambiati))
+            for nome in vecchi - tags:
+                self._popolarita[nome] -= 1
+            for nome in tags - vecchi:
+                self._popolarita[nome] = self._popolarita.get(nome, 0) + 1
+            if tags:
+                self._tag_annunci[annuncio_id] = tags
+
+    def _cerca(self, query, limite):
+        if len(query) >= 3:
+            candidati = set.intersection(*(self._trigrammi.get(t, set()) for t in _trigrammi(query)))
+            trovati = [nome for nome in candidati if query in nome]
+        else:
+            trovati = [nome for nome in self._nomi if query in nome]
+        # Prima i tag che iniziano con la query, poi i più usati
+        return nsmallest(limite, trovati, key=lambda nome: (
+            not nome.startswith(query), -self._popolarita.get(nome, 0), nome
+        ))
+
+    def statistiche(self):
+        s = super().statistiche()
+        s['tag'] = len(self._nomi)
+        s['annunci'] = len(self._tag_annunci)
+        return s
+
+indice_suggerimenti = IndiceSuggerimenti()
+indice_tag = IndiceTag()
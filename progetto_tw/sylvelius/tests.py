@@ -1,39 +1,77 @@
-from django.test import TestCase, RequestFactory, Client
+from django.test import TestCase, RequestFactory, Client, override_settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User, Group, AnonymousUser
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
 from django.conf import settings
+from django.template.loader import render_to_string
 from django.http import HttpResponse, JsonResponse
 from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 from django.views import View
 
+import asyncio
+import os
+import re
 import tempfile
+import gc
+import time
 import shutil
+import subprocess
+import sys
+import threading
 import json
 import uuid
+from io import BytesIO, StringIO
+from PIL import Image
 from decimal import Decimal
+from unittest import skipUnless
 from unittest.mock import patch
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
 
 from .models import (
     Annuncio, CommentoAnnuncio, ImmagineProdotto,
-    Ordine, Tag, Prodotto, Notification
+    Ordine, Tag, Prodotto, Notification, LetturaNotifiche
 )
 from .views import (
     RicercaAnnunciView, send_notification, 
     mark_notifications_read, create_notification, annulla_ordine_free, 
     check_if_annuncio_is_valid, annulla_ordine
 )
+from .notifiche import accoda_notifiche, dispatcher, notifiche_utente, svuota_coda_notifiche
+from .suggerimenti import CacheLRU, indice_suggerimenti, indice_tag
 from sylvelius.forms import CustomUserCreationForm
+from progetto_tw import constants
+from progetto_tw.context_processors import _costanti, global_constants
+from progetto_tw.benchmark import confronta, percentile
+from progetto_tw.dati_sintetici import genera_record
+from progetto_tw.importa_dati import carica_dati, leggi_sezioni
+from progetto_tw.consumers import GetNotifications, SearchConsumer, SearchTags, statistiche_ws
 from progetto_tw.mixins import ModeratoreAccessForbiddenMixin
-from purchase.models import Invoice
+from progetto_tw.paginazione import PaginatorKeyset, codifica_cursore
+from progetto_tw.testing import QueryBudgetMixin
+from purchase.models import Cart, Invoice
 from progetto_tw.constants import (
     MAX_PAGINATOR_COMMENTI_ANNUNCIO_VALUE,
     MAX_UNAME_CHARS, 
     MAX_PWD_CHARS,
     MAX_PAGINATOR_RICERCA_VALUE,
+    MAX_PAGINATOR_HOME_VALUE,
     MAX_PAGINATOR_COMMENTI_DETTAGLI_VALUE,
+    MAX_QUERIES_HOME_VALUE,
+    MAX_QUERIES_RICERCA_VALUE,
     MAX_ANNUNCI_PER_DETTAGLI_VALUE,
+    INVALID_COMMNT_RATING_VALUE,
+    IMG_VARIANTI_DIMENSIONI,
+    FTS_TABELLA,
+    MAX_WS_QUERIES,
     _MODS_GRP_NAME,
     _NEXT_PROD_ID
 )
@@ -219,6 +257,27 @@ class UrlsWithData(TestCase):
         self.assertIn('urls', data)
         self.assertEqual(data['urls'][0],"/static/img/default_product.png")
 
+    def test_api_immagini_prodotti(self):
+        response = self.client.get(reverse('sylvelius:immagini_prodotti'), {'prodotti': f'{_NEXT_PROD_ID},1,abc'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['urls'], {
+            str(_NEXT_PROD_ID): "/media/prodotti/immagini/test_image.jpg",
+            '1': "/static/img/default_product.png",
+        })
+
+        prodotto = Prodotto.objects.get(id=_NEXT_PROD_ID)
+        ImmagineProdotto.objects.create(prodotto=prodotto, immagine='prodotti/immagini/test_image2.jpg')
+        response = self.client.get(reverse('sylvelius:immagini_prodotti'), {'prodotti': f'{_NEXT_PROD_ID}'})
+        self.assertEqual(response.json()['urls'], {str(_NEXT_PROD_ID): "/media/prodotti/immagini/test_image.jpg"})
+
+        response = self.client.get(reverse('sylvelius:immagini_prodotti'))
+        self.assertEqual(response.json()['urls'], {})
+
+    def test_card_con_immagine(self):
+        response = self.client.get(reverse('sylvelius:home'))
+        self.assertContains(response, 'src="/media/prodotti/immagini/test_image.jpg"')
+        self.assertNotContains(response, 'immagine-asincrona')
+
 class ModelsTestingStringsCoverage(TestCase):
 
     def setUp(self):
@@ -361,9 +420,11 @@ class UtilityFunctionsTests(TestCase):
         self.moderator_group, _ = Group.objects.get_or_create(name=_MODS_GRP_NAME)
         self.usermod.groups.add(self.moderator_group)
         self.temp_media_dir = tempfile.mkdtemp()
-        settings.MEDIA_ROOT = self.temp_media_dir
+        self.media_override = override_settings(MEDIA_ROOT=self.temp_media_dir)
+        self.media_override.enable()
         
     def tearDown(self):
+        self.media_override.disable()
         shutil.rmtree(self.temp_media_dir)
     
     def test_send_notification(self):
@@ -1417,7 +1478,9 @@ class FunctionBasedViewTests(TestCase):
             stato_consegna='da spedire'
         )
         
-        with patch('sylvelius.views.annulla_ordine_free') as mock_annulla:
+        ordini_annullati = []
+        with patch('sylvelius.views.annulla_ordini_free',
+                   side_effect=lambda request, ordini: ordini_annullati.extend(o.id for o in ordini)) as mock_annulla:
             banned_user.is_active = True
             banned_user.save()
             response = self.client.post(
@@ -1431,19 +1494,15 @@ class FunctionBasedViewTests(TestCase):
             )
             self.assertEqual(response.status_code, 302)
             
-            args, _ = mock_annulla.call_args_list[0]
-            request_passed = args[0]
-            ordine_id_passed = args[1]
-            
-            self.assertEqual(request_passed.user, moderator)
-            self.assertEqual(ordine_id_passed, ordine_inserzionista.id)#type:ignore
-            
-            args, _ = mock_annulla.call_args_list[1]
+            mock_annulla.assert_called_once()
+            args, _ = mock_annulla.call_args
             request_passed = args[0]
-            ordine_id_passed = args[1]
             
             self.assertEqual(request_passed.user, moderator)
-            self.assertEqual(ordine_id_passed, ordine_utente.id)#type:ignore
+            self.assertCountEqual(
+                ordini_annullati,
+                [ordine_inserzionista.id, ordine_utente.id] #type:ignore
+            )
             
             self.assertFalse(Annuncio.objects.filter(inserzionista=banned_user).exists())
             self.assertFalse(CommentoAnnuncio.objects.filter(utente=banned_user).exists())
@@ -1479,7 +1538,8 @@ class AnnuncioCreationTests(TestCase):
         self.client = Client()
         
         self.temp_media_dir = tempfile.mkdtemp()
-        settings.MEDIA_ROOT = self.temp_media_dir
+        self.media_override = override_settings(MEDIA_ROOT=self.temp_media_dir)
+        self.media_override.enable()
         
         self.valid_image = SimpleUploadedFile(
             name='test_image.jpg',
@@ -1488,6 +1548,7 @@ class AnnuncioCreationTests(TestCase):
         )
     
     def tearDown(self):
+        self.media_override.disable()
         shutil.rmtree(self.temp_media_dir)
     
     def test_profilo_crea_annuncio_page_view_get(self):
@@ -2565,7 +2626,9 @@ class ProfiloDetailsPageViewTest(TestCase):
             )
 
         self.client.force_login(self.moderator_user)
-        response = self.client.get(self.normal_user_url + '?page=2')
+        response = self.client.get(self.normal_user_url)
+        self.assertTrue(response.context['has_next'])
+        response = self.client.get(self.normal_user_url, {'cursore': response.context['cursore_successivo']})
 
         self.assertFalse(response.context['has_next'])
         self.assertTrue(response.context['has_previous'])
@@ -2644,3 +2707,1161 @@ class ProfiloDetailsPageViewTest(TestCase):
         self.assertEqual(len(annunci_in_context), MAX_ANNUNCI_PER_DETTAGLI_VALUE)
         
         self.assertEqual(response.context['annunci_count'], MAX_ANNUNCI_PER_DETTAGLI_VALUE + 5 + 2)
+
+class RatingAggregatoTests(TestCase):
+    def setUp(self):
+        self.venditore = User.objects.create_user(username='venditore', password='testpass123')
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.user2 = User.objects.create_user(username='testuser2', password='testpass123')
+        prodotto = Prodotto.objects.create(
+            nome='Prodotto rating',
+            descrizione_breve='Descrizione breve',
+            prezzo=10.00,
+            condizione='nuovo'
+        )
+        self.annuncio = Annuncio.objects.create(
+            uuid=uuid.uuid4(),
+            inserzionista=self.venditore,
+            prodotto=prodotto,
+            qta_magazzino=5,
+            is_published=True
+        )
+
+    def test_aggiornamento_da_views(self):
+        self.client.login(username='testuser', password='testpass123')
+        self.client.post(
+            reverse('sylvelius:aggiungi_commento', args=[self.annuncio.id]), #type:ignore
+            {'testo': 'Buono', 'rating': '4'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.rating_somma, 4)
+        self.assertEqual(self.annuncio.rating_count, 1)
+        self.assertEqual(self.annuncio.rating_medio, 4)
+
+        CommentoAnnuncio.objects.create(annuncio=self.annuncio, utente=self.user2, testo='Così così', rating=1)
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.rating_medio, 2.5)
+
+        commento = CommentoAnnuncio.objects.get(utente=self.user)
+        self.client.post(
+            reverse('sylvelius:modifica_commento', args=[commento.id]), #type:ignore
+            {'testo': 'Ottimo', 'rating': '5'},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.rating_somma, 6)
+        self.assertEqual(self.annuncio.rating_medio, 3)
+
+        self.client.post(
+            reverse('sylvelius:elimina_commento', args=[commento.id]), #type:ignore
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.rating_count, 1)
+        self.assertEqual(self.annuncio.rating_medio, 1)
+
+    def test_aggiornamento_su_cancellazione_a_cascata(self):
+        CommentoAnnuncio.objects.create(annuncio=self.annuncio, utente=self.user, testo='Buono', rating=4)
+        CommentoAnnuncio.objects.create(annuncio=self.annuncio, utente=self.user2, testo='Pessimo', rating=0)
+        self.user2.delete()
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.rating_count, 1)
+        self.assertEqual(self.annuncio.rating_medio, 4)
+
+        self.user.delete()
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.rating_count, 0)
+        self.assertIsNone(self.annuncio.rating_media)
+        self.assertEqual(self.annuncio.rating_medio, INVALID_COMMNT_RATING_VALUE)
+
+    def test_comando_ricalcola_rating(self):
+        CommentoAnnuncio.objects.create(annuncio=self.annuncio, utente=self.user, testo='Buono', rating=4)
+        CommentoAnnuncio.objects.create(annuncio=self.annuncio, utente=self.user2, testo='Ottimo', rating=5)
+        Annuncio.objects.filter(pk=self.annuncio.pk).update(rating_somma=0, rating_numero=0, rating_media=None)
+
+        out = StringIO()
+        call_command('ricalcola_rating', stdout=out)
+        self.assertIn('1 annunci', out.getvalue())
+        self.annuncio.refresh_from_db()
+        self.assertEqual(self.annuncio.rating_somma, 9)
+        self.assertEqual(self.annuncio.rating_count, 2)
+        self.assertEqual(self.annuncio.rating_medio, 4.5)
+
+class QueryBudgetCardTests(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.tags = [Tag.objects.create(nome=f'tag{i}') for i in range(4)]
+        self.n_annunci = 0
+
+    def crea_annunci(self, n):
+        for _ in range(n):
+            self.n_annunci += 1
+            prodotto = Prodotto.objects.create(
+                nome=f'Prodotto {self.n_annunci}',
+                descrizione_breve='Descrizione breve',
+                prezzo=10.00 + self.n_annunci,
+                condizione='nuovo'
+            )
+            prodotto.tags.set(self.tags)
+            annuncio = Annuncio.objects.create(
+                uuid=uuid.uuid4(),
+                inserzionista=self.user,
+                prodotto=prodotto,
+                qta_magazzino=5,
+                is_published=True
+            )
+            CommentoAnnuncio.objects.create(annuncio=annuncio, utente=self.user, testo='Buono', rating=4)
+
+    def verifica_budget_costante(self, budget, url, data=None, per_pagina=MAX_PAGINATOR_HOME_VALUE):
+        self.client.force_login(self.user)
+        self.crea_annunci(2)
+        _, poche_card = self.assertQueryBudget(budget, url, data)
+        self.crea_annunci(per_pagina)
+        response, molte_card = self.assertQueryBudget(budget, url, data)
+        self.assertEqual(len(response.context['annunci']), per_pagina)
+        self.assertEqual(poche_card, molte_card)
+
+    def test_home_budget(self):
+        self.verifica_budget_costante(MAX_QUERIES_HOME_VALUE, reverse('sylvelius:home'))
+
+    def test_ricerca_budget(self):
+        self.verifica_budget_costante(
+            MAX_QUERIES_RICERCA_VALUE, reverse('sylvelius:ricerca_annunci'),
+            {'q': 'Prodotto', 'sort': 'best-star'}, per_pagina=MAX_PAGINATOR_RICERCA_VALUE
+        )
+
+    def test_budget_superato(self):
+        self.crea_annunci(1)
+        with self.assertRaises(AssertionError):
+            self.assertQueryBudget(0, reverse('sylvelius:home'))
+
+class DerivateImmaginiTests(TestCase):
+    def setUp(self):
+        self.temp_media_dir = tempfile.mkdtemp()
+        self.override = override_settings(MEDIA_ROOT=self.temp_media_dir)
+        self.override.enable()
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        self.prodotto = Prodotto.objects.create(
+            nome='Prodotto con foto',
+            descrizione_breve='Descrizione breve',
+            prezzo=10.00,
+            condizione='nuovo'
+        )
+        Annuncio.objects.create(
+            uuid=uuid.uuid4(),
+            inserzionista=user,
+            prodotto=self.prodotto,
+            qta_magazzino=5,
+            is_published=True
+        )
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.temp_media_dir)
+
+    def crea_immagine(self, nome='foto.png', dimensioni=(2400, 1600), modo='RGBA'):
+        buffer = BytesIO()
+        Image.new(modo, dimensioni, (120, 60, 200, 255) if modo == 'RGBA' else (120, 60, 200)).save(buffer, 'PNG')
+        return ImmagineProdotto.objects.create(
+            prodotto=self.prodotto,
+            immagine=SimpleUploadedFile(nome, buffer.getvalue(), content_type='image/png')
+        )
+
+    def test_derivate_generate_al_salvataggio(self):
+        immagine = self.crea_immagine()
+        for variante, lato in IMG_VARIANTI_DIMENSIONI:
+            for estensione, formato in (('webp', 'WEBP'), ('jpg', 'JPEG')):
+                percorso = f"{immagine.immagine.path}.{variante}.{estensione}"
+                self.assertTrue(os.path.exists(percorso))
+                with Image.open(percorso) as derivata:
+                    self.assertEqual(derivata.format, formato)
+                    self.assertEqual(max(derivata.size), min(lato, 2400))
+                    self.assertAlmostEqual(derivata.size[0] / derivata.size[1], 1.5, places=1)
+
+        self.assertEqual(set(immagine.varianti), {variante for variante, _ in IMG_VARIANTI_DIMENSIONI})
+        self.assertTrue(immagine.url_variante('card').endswith('.card.webp'))
+        self.assertTrue(immagine.url_variante('full', 'jpg').endswith('.full.jpg'))
+
+    def test_api_espongono_derivate(self):
+        immagine = self.crea_immagine()
+        data = self.client.get(f'/api/immagine/{self.prodotto.id}/').json() # type: ignore
+        self.assertEqual(data['url'], immagine.url_variante('card'))
+        self.assertEqual(data['varianti'], immagine.varianti)
+
+        data = self.client.get(f'/api/immagini/{self.prodotto.id}/').json() # type: ignore
+        self.assertEqual(data['urls'], [immagine.url_variante('carosello')])
+
+        response = self.client.get(reverse('sylvelius:home'))
+        self.assertContains(response, immagine.varianti['card']['webp'])
+
+    def test_card_controlla_solo_la_sua_variante(self):
+        immagine = self.crea_immagine()
+        storage = immagine.immagine.storage
+        with patch.object(storage, 'exists', wraps=storage.exists) as exists:
+            derivate = immagine.derivate_card
+        self.assertEqual(set(derivate), {'webp', 'jpg'})
+        self.assertEqual(exists.call_count, 2)
+        self.assertEqual(derivate, immagine.varianti['card'])
+
+    def test_fallback_senza_derivate(self):
+        immagine = ImmagineProdotto.objects.create(prodotto=self.prodotto, immagine='prodotti/immagini/inesistente.jpg')
+        self.assertEqual(immagine.varianti, {})
+        self.assertEqual(immagine.url_variante('card'), immagine.immagine.url)
+
+    def test_comando_genera_derivate(self):
+        immagine = self.crea_immagine(modo='RGB')
+        card = f"{immagine.immagine.path}.card.webp"
+        os.remove(card)
+
+        out = StringIO()
+        call_command('genera_derivate_immagini', workers=1, stdout=out)
+        self.assertTrue(os.path.exists(card))
+        self.assertIn('1 immagini elaborate, 1 derivate generate', out.getvalue())
+
+        out = StringIO()
+        call_command('genera_derivate_immagini', workers=2, forza=True, stdout=out)
+        self.assertIn(f'1 immagini elaborate, {len(IMG_VARIANTI_DIMENSIONI) * 2} derivate generate', out.getvalue())
+
+class RicercaFts5Tests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='venditore', password='testpass123')
+        self.tag = Tag.objects.create(nome='audio')
+        self.cuffie = Prodotto.objects.create(
+            nome='Cuffie wireless',
+            descrizione_breve='Cuffie con cancellazione del rumore',
+            prezzo=80.00,
+            condizione='nuovo'
+        )
+        self.cuffie.tags.add(self.tag)
+        self.cavo = Prodotto.objects.create(
+            nome='Cavo jack',
+            descrizione_breve='Cavo per cuffie e casse',
+            prezzo=5.00,
+            condizione='usato'
+        )
+        self.annuncio_cuffie = Annuncio.objects.create(
+            uuid=uuid.uuid4(), inserzionista=user, prodotto=self.cuffie, qta_magazzino=3, is_published=True
+        )
+        self.annuncio_cavo = Annuncio.objects.create(
+            uuid=uuid.uuid4(), inserzionista=user, prodotto=self.cavo, qta_magazzino=0, is_published=True
+        )
+
+    def cerca(self, **params):
+        response = self.client.get(reverse('sylvelius:ricerca_annunci'), params)
+        return list(response.context['annunci'])
+
+    def test_indice_sincronizzato(self):
+        self.assertEqual(self.cerca(q='AUDIO'), [self.annuncio_cuffie])
+
+        self.tag.nome = 'hifi'
+        self.tag.save()
+        self.assertEqual(self.cerca(q='audio'), [])
+        self.assertEqual(self.cerca(q='hifi'), [self.annuncio_cuffie])
+
+        self.cavo.tags.add(self.tag)
+        self.assertEqual(len(self.cerca(q='hifi')), 2)
+        self.tag.prodotti.clear() # type: ignore
+        self.assertEqual(self.cerca(q='hifi'), [])
+
+        self.cavo.tags.add(self.tag)
+        self.tag.delete()
+        self.assertEqual(self.cerca(q='hifi'), [])
+
+        self.cavo.nome = 'Adattatore jack'
+        self.cavo.save()
+        self.assertEqual(self.cerca(q='adattatore'), [self.annuncio_cavo])
+
+    def test_rilevanza_e_filtri(self):
+        self.assertEqual(self.cerca(q='cuffie', sort='rilevanza'), [self.annuncio_cuffie, self.annuncio_cavo])
+        self.assertEqual(self.cerca(q='cuffie', sort='rilevanza', qta_mag='qta-manc'), [self.annuncio_cavo])
+        self.assertEqual(self.cerca(q='cuffie', prezzo_max='10'), [self.annuncio_cavo])
+        self.assertEqual(self.cerca(q='cuffie', condition='nuovo'), [self.annuncio_cuffie])
+        self.assertEqual(self.cerca(sort='rilevanza')[0], self.annuncio_cavo)
+
+    def test_query_corta_usa_orm(self):
+        self.assertEqual(self.cerca(q='ja'), [self.annuncio_cavo])
+
+    @override_settings(RICERCA_BACKEND='sylvelius.ricerca.BackendOrm')
+    def test_backend_orm(self):
+        self.assertEqual(len(self.cerca(q='cuffie')), 2)
+        self.assertEqual(self.cerca(q='cuffie', sort='rilevanza'), [self.annuncio_cavo, self.annuncio_cuffie])
+
+    def test_comando_ricostruisci(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABELLA}")
+        self.assertEqual(self.cerca(q='cuffie'), [])
+        out = StringIO()
+        call_command('ricostruisci_indice_ricerca', stdout=out)
+        self.assertEqual(len(self.cerca(q='cuffie')), 2)
+
+class IndiceSuggerimentiTests(TestCase):
+    def setUp(self):
+        indice_suggerimenti.svuota()
+        self.user = User.objects.create_user(username='venditore', password='testpass123')
+        self.staff = User.objects.create_user(username='staff', password='testpass123', is_staff=True)
+        nomi = ['Cover per iPhone', 'iPhone 13', 'Lampada (vintage)', 'Bici da corsa', 'Coperta di lana']
+        self.annunci = [
+            Annuncio.objects.create(
+                uuid=uuid.uuid4(),
+                inserzionista=self.user,
+                prodotto=Prodotto.objects.create(nome=nome, descrizione_breve='x', prezzo=10.00),
+                qta_magazzino=1,
+                is_published=True
+            )
+            for nome in nomi
+        ]
+
+    def tearDown(self):
+        indice_suggerimenti.svuota()
+
+    def vecchia_query(self, query):
+        return [a.prodotto.nome for a in Annuncio.objects.filter(
+            prodotto__nome__iregex=r'\b' + re.escape(query), is_published=True
+        ).order_by('prodotto__nome').select_related('prodotto')[:MAX_WS_QUERIES]]
+
+    def test_stessi_risultati_della_regex(self):
+        indice_suggerimenti.costruisci()
+        for query in ['ip', 'IPHONE', 'co', 'per i', 'vint', '(vin', 'da c', 'one', 'z', '13']:
+            self.assertEqual(indice_suggerimenti.cerca(query), self.vecchia_query(query), query)
+
+    def test_aggiornamento_incrementale(self):
+        indice_suggerimenti.costruisci()
+        annuncio = self.annunci[0]
+        annuncio.is_published = False
+        annuncio.save()
+        self.assertEqual(indice_suggerimenti.cerca('cover'), [])
+
+        annuncio.is_published = True
+        annuncio.save()
+        annuncio.prodotto.nome = 'Custodia per iPhone'
+        annuncio.prodotto.save()
+        self.assertEqual(indice_suggerimenti.cerca('cover'), [])
+        self.assertEqual(indice_suggerimenti.cerca('cust'), ['Custodia per iPhone'])
+
+        self.annunci[1].delete()
+        self.assertEqual(indice_suggerimenti.cerca('iph'), ['Custodia per iPhone'])
+
+        statistiche = indice_suggerimenti.statistiche()
+        self.assertEqual(statistiche['richieste'], 4)
+        self.assertEqual(statistiche['miss'], 2)
+        self.assertEqual(statistiche['annunci'], Annuncio.objects.filter(is_published=True).count())
+
+    def test_consumer_e_statistiche(self):
+        indice_suggerimenti.costruisci()
+
+        async def interroga():
+            communicator = WebsocketCommunicator(SearchConsumer.as_asgi(), '/ws/search/')
+            await communicator.connect()
+            await communicator.send_json_to({'query': 'lampada (vin'})
+            risposta = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return risposta
+
+        with CaptureQueriesContext(connection) as queries:
+            risposta = async_to_sync(interroga)()
+        self.assertEqual(risposta['suggestions'], ['Lampada (vintage)'])
+        self.assertEqual(len(queries), 0)
+
+        url = reverse('sylvelius:statistiche_suggerimenti')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(url).json()['prodotti']['hit'], 1)
+
+class IndiceTagTests(TestCase):
+    def setUp(self):
+        indice_tag.svuota()
+        self.user = User.objects.create_user(username='venditore', password='testpass123')
+        self.tag_rari = Tag.objects.create(nome='qzfoto-rara')
+        self.tag_comune = Tag.objects.create(nome='qzfoto')
+        self.tag_sotto = Tag.objects.create(nome='lenti-qzfoto')
+        self.annunci = []
+        for i in range(3):
+            prodotto = Prodotto.objects.create(nome=f'Obiettivo {i}', descrizione_breve='x', prezzo=10.00)
+            self.annunci.append(Annuncio.objects.create(
+                uuid=uuid.uuid4(), inserzionista=self.user, prodotto=prodotto, qta_magazzino=1, is_published=True
+            ))
+            prodotto.tags.add(self.tag_comune)
+        self.annunci[0].prodotto.tags.add(self.tag_sotto)
+
+    def tearDown(self):
+        indice_tag.svuota()
+
+    def test_ordinamento_per_popolarita(self):
+        indice_tag.costruisci()
+        self.assertEqual(indice_tag.cerca('QZFOTO'), ['qzfoto', 'qzfoto-rara', 'lenti-qzfoto'])
+        self.assertEqual(indice_tag.cerca('qzfoto', 1), ['qzfoto'])
+        self.assertEqual(indice_tag.cerca('rara'), ['qzfoto-rara'])
+        self.assertEqual(indice_tag.cerca('xyzxyz'), [])
+
+    def test_aggiornamento_incrementale(self):
+        indice_tag.costruisci()
+        prodotto = self.annunci[1].prodotto
+        prodotto.tags.set([self.tag_rari, self.tag_sotto])
+        self.annunci[2].prodotto.tags.add(self.tag_rari)
+        self.tag_rari.prodotti.add(self.annunci[0].prodotto) # type: ignore
+        self.assertEqual(indice_tag.cerca('qzfoto'), ['qzfoto-rara', 'qzfoto', 'lenti-qzfoto'])
+
+        self.annunci[2].is_published = False
+        self.annunci[2].save()
+        self.annunci[1].delete()
+        self.assertEqual(indice_tag.cerca('qzfoto'), ['qzfoto', 'qzfoto-rara', 'lenti-qzfoto'])
+
+        Tag.objects.create(nome='qzfoto-nuovo')
+        self.assertIn('qzfoto-nuovo', indice_tag.cerca('qzf'))
+
+        self.tag_sotto.nome = 'lenti'
+        self.tag_sotto.save()
+        self.assertTrue(indice_tag.da_costruire())
+        indice_tag.costruisci()
+        self.assertNotIn('lenti-qzfoto', indice_tag.cerca('qzfoto'))
+
+    def test_consumer_senza_query(self):
+        indice_tag.costruisci()
+
+        async def interroga():
+            communicator = WebsocketCommunicator(SearchTags.as_asgi(), '/ws/tags/')
+            await communicator.connect()
+            await communicator.send_json_to({'query': 'qzfoto-r'})
+            risposta = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return risposta
+
+        with CaptureQueriesContext(connection) as queries:
+            risposta = async_to_sync(interroga)()
+        self.assertEqual(risposta['suggestions'], ['qzfoto-rara'])
+        self.assertEqual(len(queries), 0)
+
+class CaricoWebsocketTests(TestCase):
+    N_SOCKET = 200
+
+    def setUp(self):
+        indice_suggerimenti.svuota()
+        user = User.objects.create_user(username='venditore', password='testpass123')
+        for nome in ['Qzmacchina fotografica', 'Qzmacchina da caffè', 'Qzmappa antica']:
+            Annuncio.objects.create(
+                uuid=uuid.uuid4(),
+                inserzionista=user,
+                prodotto=Prodotto.objects.create(nome=nome, descrizione_breve='x', prezzo=10.00),
+                qta_magazzino=1,
+                is_published=True
+            )
+        indice_suggerimenti.costruisci()
+        for chiave in statistiche_ws:
+            statistiche_ws[chiave] = 0
+
+    def tearDown(self):
+        indice_suggerimenti.svuota()
+
+    def test_molti_socket_che_digitano(self):
+        parola = 'qzmacchina f'
+
+        async def digita(communicator):
+            await communicator.connect()
+            for i in range(1, len(parola) + 1):
+                await communicator.send_json_to({'query': parola[:i]})
+                await asyncio.sleep(0.001)
+            risposte = []
+            while not risposte or risposte[-1]['query'] != parola:
+                risposte.append(await communicator.receive_json_from(timeout=5))
+            await communicator.disconnect()
+            return risposte
+
+        async def carico():
+            communicators = [WebsocketCommunicator(SearchConsumer.as_asgi(), '/ws/search/')
+                             for _ in range(self.N_SOCKET)]
+            return await asyncio.gather(*(digita(c) for c in communicators))
+
+        for risposte in async_to_sync(carico)():
+            self.assertEqual(risposte[-1]['suggestions'], ['Qzmacchina fotografica'])
+            # Le risposte arrivano nell'ordine in cui le query sono state digitate
+            lunghezze = [len(r['query']) for r in risposte]
+            self.assertEqual(lunghezze, sorted(lunghezze))
+
+        frame = self.N_SOCKET * len(parola)
+        self.assertEqual(statistiche_ws['ricevute'], frame)
+        self.assertLess(statistiche_ws['eseguite'], frame * 0.75)
+        self.assertEqual(statistiche_ws['ricevute'] - statistiche_ws['eseguite'], statistiche_ws['scartate'])
+
+class CacheSuggerimentiTests(TestCase):
+    def setUp(self):
+        indice_suggerimenti.svuota()
+        indice_tag.svuota()
+        user = User.objects.create_user(username='venditore', password='testpass123')
+        self.tag = Tag.objects.create(nome='qzcucina')
+        self.annunci = []
+        for nome in ['Qzcover rigida', 'Qzlampada da tavolo']:
+            prodotto = Prodotto.objects.create(nome=nome, descrizione_breve='x', prezzo=10.00)
+            prodotto.tags.add(self.tag)
+            self.annunci.append(Annuncio.objects.create(
+                uuid=uuid.uuid4(), inserzionista=user, prodotto=prodotto, qta_magazzino=1, is_published=True
+            ))
+        indice_suggerimenti.costruisci()
+        indice_tag.costruisci()
+
+    def tearDown(self):
+        indice_suggerimenti.svuota()
+        indice_tag.svuota()
+
+    def test_lru_ttl_e_dimensione(self):
+        cache = CacheLRU(dimensione=2, ttl=60)
+        cache.set(('a', 10), ['x'])
+        cache.set(('b', 10), ['y'])
+        self.assertEqual(cache.get(('a', 10)), ['x'])
+        cache.set(('c', 10), ['z'])
+        self.assertIsNone(cache.get(('b', 10)))
+        self.assertEqual(cache.statistiche()['espulse'], 1)
+
+        with patch('sylvelius.suggerimenti.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get(('a', 10)))
+        statistiche = cache.statistiche()
+        self.assertEqual((statistiche['hit'], statistiche['miss'], statistiche['scadute']), (1, 2, 1))
+
+    def test_invalidazione_selettiva_prodotti(self):
+        indice_suggerimenti.cerca('qzcov')
+        indice_suggerimenti.cerca('qzlamp')
+        indice_suggerimenti.cerca('QZLAMP')
+        self.assertEqual(indice_suggerimenti.statistiche()['cache']['hit'], 1)
+
+        prodotto = self.annunci[0].prodotto
+        prodotto.nome = 'Qzcustodia rigida'
+        prodotto.save()
+        self.assertEqual(indice_suggerimenti.statistiche()['cache']['invalidate'], 1)
+        self.assertEqual(indice_suggerimenti.cerca('qzcov'), [])
+        self.assertEqual(indice_suggerimenti.cerca('qzlamp'), ['Qzlampada da tavolo'])
+        self.assertEqual(indice_suggerimenti.statistiche()['cache']['hit'], 2)
+
+        # Salvataggi che non cambiano nome né pubblicazione non toccano la cache
+        self.annunci[1].qta_magazzino = 5
+        self.annunci[1].save()
+        self.assertEqual(indice_suggerimenti.statistiche()['cache']['invalidate'], 1)
+
+    def test_invalidazione_selettiva_tag(self):
+        indice_tag.cerca('qzcuc')
+        indice_tag.cerca('zzz')
+        self.annunci[0].delete()
+        statistiche = indice_tag.statistiche()['cache']
+        self.assertEqual((statistiche['invalidate'], statistiche['voci']), (1, 1))
+
+try:
+    import channels_redis # noqa: F401
+    from fakeredis import TcpFakeServer
+except ImportError:
+    TcpFakeServer = None
+
+@skipUnless(TcpFakeServer, "servono channels_redis e fakeredis")
+class ChannelLayerMultiProcessoTests(TestCase):
+    # Un server Redis finto su TCP fa da broker: il WebSocket è aperto in questo
+    # processo, la notifica parte da un secondo processo Django.
+    def setUp(self):
+        self.server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"redis://127.0.0.1:{self.server.server_address[1]}/0"
+        self.override = override_settings(CHANNEL_LAYERS={'default': {
+            'BACKEND': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+            'CONFIG': {'hosts': [self.url], 'prefix': 'sylvelius'},
+        }})
+        self.override.enable()
+        self.user = User.objects.create_user(username='destinatario', password='testpass123')
+
+    def tearDown(self):
+        self.override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def invia_da_altro_processo(self, codice):
+        subprocess.run(
+            [sys.executable, 'manage.py', 'shell', '-c', codice],
+            cwd=settings.BASE_DIR, env={**os.environ, 'CHANNEL_LAYER_URL': self.url},
+            check=True, capture_output=True, timeout=60
+        )
+
+    def test_consegna_tra_processi(self):
+        async def ricevi():
+            communicator = WebsocketCommunicator(GetNotifications.as_asgi(), '/ws/notifications/')
+            communicator.scope['user'] = self.user
+            connesso, _ = await communicator.connect()
+            self.assertTrue(connesso)
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'cart_count', 'count': 0})
+            # Il secondo processo ha un suo database in memoria: accoda le notifiche
+            # nella outbox e la svuota come fa il dispatcher
+            await sync_to_async(self.invia_da_altro_processo)(
+                "from django.db import connection; connection.settings_dict['NAME'] = ':memory:';"
+                "from django.core.management import call_command; call_command('migrate', verbosity=0);"
+                "from django.contrib.auth.models import User; from sylvelius.models import Notification;"
+                "from sylvelius.notifiche import accoda_notifiche, svuota_coda_notifiche;"
+                "Notification.objects.update(inviata=True);"
+                f"utente = User.objects.create(id={self.user.id}, username='destinatario');" # type: ignore
+                "accoda_notifiche([Notification(recipient=utente, title='Personale', message='a')] +"
+                " [Notification(is_global=True, title=f'Globale {i}', message='b') for i in range(120)]);"
+                "svuota_coda_notifiche()"
+            )
+            messaggi = [await communicator.receive_json_from(timeout=10) for _ in range(4)]
+            await communicator.disconnect()
+            return messaggi
+
+        messaggi = async_to_sync(ricevi)()
+        self.assertEqual(messaggi[0], {'type': 'notification', 'title': 'Personale', 'message': 'a'})
+        # 120 notifiche globali in 3 messaggi sul channel layer
+        self.assertEqual([len(m['notifiche']) for m in messaggi[1:]], [50, 50, 20])
+        self.assertEqual(messaggi[3]['notifiche'][-1], {'title': 'Globale 119', 'message': 'b'})
+
+class NotificheOutboxTests(TestCase):
+    def setUp(self):
+        # Le notifiche dei dati iniziali non devono finire nei messaggi dei test
+        Notification.objects.update(inviata=True)
+        self.moderatore = User.objects.create_user(username='qzmoderatore', password='testpass123')
+        self.moderatore.groups.add(Group.objects.get_or_create(name=_MODS_GRP_NAME)[0])
+        self.user = User.objects.create_user(username='qzdestinatario', password='testpass123')
+
+    def crea_bannato(self, n_ordini):
+        bannato = User.objects.create_user(username=f'qzbannato{n_ordini}', password='testpass123', is_active=False)
+        annuncio = Annuncio.objects.create(
+            inserzionista=bannato,
+            prodotto=Prodotto.objects.create(nome=f'Qzprodotto {n_ordini}', descrizione_breve='x', prezzo=10.00),
+            qta_magazzino=n_ordini
+        )
+        for i in range(n_ordini):
+            compratore = User.objects.create_user(username=f'qzcompratore{n_ordini}_{i}', password='testpass123')
+            Ordine.objects.create(utente=compratore, prodotto=annuncio.prodotto, stato_consegna='da spedire')
+        return bannato
+
+    def formatta(self, bannato):
+        with CaptureQueriesContext(connection) as query:
+            response = self.client.post(reverse('sylvelius:formatta_utente', args=[bannato.id]))
+        self.assertEqual(response.status_code, 302)
+        return len(query)
+
+    def test_annullamento_massivo_query_costanti(self):
+        self.client.login(username='qzmoderatore', password='testpass123')
+        pochi = self.formatta(self.crea_bannato(2))
+        molti = self.formatta(self.crea_bannato(25))
+        self.assertEqual(pochi, molti)
+
+        notifiche = Notification.objects.filter(title='Ordine cancellato', recipient__username__startswith='qzcompratore25_')
+        self.assertEqual(notifiche.count(), 25)
+        self.assertFalse(notifiche.filter(inviata=True).exists())
+        self.assertEqual(Ordine.objects.filter(prodotto__nome='Qzprodotto 25', stato_consegna='annullato').count(), 25)
+
+    def test_svuota_coda(self):
+        accoda_notifiche(
+            [Notification(recipient=self.user, title=f'Personale {i}', message='a') for i in range(60)] +
+            [Notification(is_global=True, title='Globale', message='b')]
+        )
+
+        async def ricevi():
+            channel_layer = get_channel_layer()
+            canale = await channel_layer.new_channel() #type:ignore
+            await channel_layer.group_add(f'user_{self.user.id}', canale) #type:ignore
+            await channel_layer.group_add('global', canale) #type:ignore
+            inviate = await sync_to_async(svuota_coda_notifiche)()
+            messaggi = [await channel_layer.receive(canale) for _ in range(3)] #type:ignore
+            return inviate, messaggi
+
+        inviate, messaggi = async_to_sync(ricevi)()
+        self.assertEqual(inviate, 61)
+        # 60 notifiche personali in 2 messaggi, quella globale con il vecchio formato
+        self.assertEqual([len(m['notifiche']) for m in messaggi[:2]], [50, 10])
+        self.assertEqual(messaggi[2], {'type': 'send_notification', 'title': 'Globale', 'message': 'b'})
+        self.assertFalse(Notification.objects.filter(inviata=False).exists())
+        self.assertEqual(svuota_coda_notifiche(), 0)
+
+    def test_dispatcher_dopo_commit(self):
+        def notifica():
+            with self.captureOnCommitCallbacks(execute=True):
+                create_notification(recipient=self.user, title='Dopo il commit', message='c')
+
+        async def ricevi():
+            communicator = WebsocketCommunicator(GetNotifications.as_asgi(), '/ws/notifications/')
+            communicator.scope['user'] = self.user
+            connesso, _ = await communicator.connect()
+            self.assertTrue(connesso)
+            self.assertTrue(dispatcher.attivo())
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'cart_count', 'count': 0})
+            await sync_to_async(notifica)()
+            messaggio = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+            await dispatcher.ferma()
+            return messaggio
+
+        messaggio = async_to_sync(ricevi)()
+        self.assertEqual(messaggio, {'type': 'notification', 'title': 'Dopo il commit', 'message': 'c'})
+        self.assertTrue(Notification.objects.get(title='Dopo il commit').inviata)
+
+class NotificheGlobaliTests(TestCase):
+    def setUp(self):
+        Notification.objects.all().delete()
+        self.user = User.objects.create_user(username='qzlettore', password='testpass123')
+        self.altro = User.objects.create_user(username='qzaltro', password='testpass123')
+        self.client.login(username='qzlettore', password='testpass123')
+
+    def api(self):
+        return json.loads(self.client.get(reverse('sylvelius:notifications_api')).content.decode())
+
+    def test_globale_salvata_una_volta_e_letta_per_utente(self):
+        create_notification(title='Globale', message='g', is_global=True)
+        create_notification(recipient=self.user, title='Personale', message='p')
+        self.assertEqual(Notification.objects.filter(is_global=True).count(), 1)
+
+        self.assertEqual([(n['title'], n['read']) for n in self.api()], [('Personale', False), ('Globale', False)])
+        self.client.post(reverse('sylvelius:mark_notifications_read'))
+        self.assertEqual([(n['title'], n['read']) for n in self.api()], [('Personale', True), ('Globale', True)])
+        # La riga globale non cambia: per l'altro utente resta da leggere
+        self.assertFalse(Notification.objects.get(title='Globale').read)
+        self.assertEqual([(n['title'], n['letta']) for n in notifiche_utente(self.altro)[0]], [('Globale', False)])
+
+        create_notification(title='Nuova globale', message='g', is_global=True)
+        self.assertEqual([(n['title'], n['read']) for n in self.api()][0], ('Nuova globale', False))
+        self.assertEqual(LetturaNotifiche.objects.get(utente=self.user).ultima_globale_letta,
+                         Notification.objects.get(title='Globale').id) #type:ignore
+
+    def test_ultime_dei_due_flussi(self):
+        accoda_notifiche(
+            [Notification(is_global=True, title=f'Globale {i}', message='g') for i in range(30)] +
+            [Notification(recipient=self.user, title=f'Personale {i}', message='p') for i in range(30)] +
+            [Notification(recipient=self.altro, title='Di un altro', message='p')]
+        )
+        with CaptureQueriesContext(connection) as query:
+            notifiche, successivo = notifiche_utente(self.user, 20)
+        self.assertEqual(len(query), 2)
+        self.assertEqual(len(notifiche), 20)
+        self.assertNotIn('Di un altro', [n['title'] for n in notifiche])
+        self.assertEqual(notifiche[0]['title'], 'Personale 29')
+        chiavi = [(n['created_at'], n['id']) for n in notifiche]
+        self.assertEqual(chiavi, sorted(chiavi, reverse=True))
+        self.assertEqual(chiavi, list(Notification.objects.exclude(recipient=self.altro).order_by(
+            '-created_at', '-id').values_list('created_at', 'id')[:20]))
+
+        # Le pagine successive riprendono da dove finisce la precedente, senza OFFSET
+        titoli = [n['title'] for n in notifiche]
+        while successivo:
+            with CaptureQueriesContext(connection) as query:
+                notifiche, successivo = notifiche_utente(self.user, 20, successivo)
+            self.assertEqual(len(query), 2)
+            self.assertNotIn('OFFSET', query.captured_queries[0]['sql'])
+            titoli += [n['title'] for n in notifiche]
+        self.assertEqual(len(titoli), 60)
+        self.assertEqual(len(set(titoli)), 60)
+
+    def test_api_paginata(self):
+        accoda_notifiche([Notification(recipient=self.user, title=f'Personale {i}', message='p') for i in range(25)])
+        response = self.client.get(reverse('sylvelius:notifications_api'))
+        self.assertEqual(json.loads(response.content.decode())[0]['title'], 'Personale 24')
+        response = self.client.get(reverse('sylvelius:notifications_api'), {'cursore': response['X-Cursore-Successivo']})
+        self.assertEqual([n['title'] for n in json.loads(response.content.decode())],
+                         [f'Personale {i}' for i in range(4, -1, -1)])
+        self.assertNotIn('X-Cursore-Successivo', response)
+
+    def test_query_sugli_indici(self):
+        for flusso, indice in [(Q(recipient=self.user, is_global=False), 'notifica_personale_idx'),
+                               (Q(is_global=True), 'notifica_globale_idx')]:
+            piano = Notification.objects.filter(flusso).order_by('-created_at', '-id')[:20].explain()
+            self.assertIn(indice, piano)
+            self.assertNotIn('TEMP B-TREE', piano)
+
+class PaginazioneKeysetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='qzcompratore', password='testpass123')
+        venditore = User.objects.create_user(username='qzvenditore', password='testpass123')
+        self.prodotto = Prodotto.objects.create(nome='Qzprodotto', descrizione_breve='x', prezzo=10.00)
+        Annuncio.objects.create(inserzionista=venditore, prodotto=self.prodotto, qta_magazzino=100)
+        Ordine.objects.bulk_create([Ordine(utente=self.user, prodotto=self.prodotto) for _ in range(23)])
+        # Stessa data per metà degli ordini: l'id fa da spareggio
+        stessa_data = Ordine.objects.filter(utente=self.user).order_by('id')[0].data_ordine
+        Ordine.objects.filter(id__in=Ordine.objects.filter(utente=self.user).order_by('id').values('id')[:12]).update(
+            data_ordine=stessa_data)
+        self.ordinati = list(Ordine.objects.filter(utente=self.user).order_by('-data_ordine', '-id').values_list('id', flat=True))
+
+    def test_avanti_e_indietro(self):
+        paginator = PaginatorKeyset(Ordine.objects.filter(utente=self.user), 'data_ordine', 10)
+        pagine = [paginator.get_page()]
+        while pagine[-1].has_next():
+            pagine.append(paginator.get_page(pagine[-1].cursore_successivo))
+        self.assertEqual([p.number for p in pagine], [1, 2, 3])
+        self.assertEqual([o.id for p in pagine for o in p], self.ordinati)
+        self.assertFalse(pagine[0].has_previous())
+
+        indietro = paginator.get_page(pagine[2].cursore_precedente)
+        self.assertEqual(indietro.number, 2)
+        self.assertEqual([o.id for o in indietro], [o.id for o in pagine[1]])
+        prima = paginator.get_page(indietro.cursore_precedente)
+        self.assertEqual(prima.number, 1)
+        self.assertFalse(prima.has_previous())
+        self.assertEqual([o.id for o in prima], self.ordinati[:10])
+
+    def test_cursore_non_valido(self):
+        paginator = PaginatorKeyset(Ordine.objects.filter(utente=self.user), 'data_ordine', 10)
+        for cursore in ['xyz', 'e30', codifica_cursore(timezone.now(), 1)[:-2]]:
+            pagina = paginator.get_page(cursore)
+            self.assertEqual(pagina.number, 1)
+            self.assertEqual([o.id for o in pagina], self.ordinati[:10])
+
+    def test_profilo_ordini(self):
+        self.client.login(username='qzcompratore', password='testpass123')
+        url = reverse('sylvelius:profile_ordini')
+        visti = []
+        cursore = None
+        while True:
+            with CaptureQueriesContext(connection) as query:
+                response = self.client.get(url, {'cursore': cursore} if cursore else {})
+            self.assertFalse(any('OFFSET' in q['sql'] for q in query.captured_queries))
+            visti += [o.id for o in response.context['ordini']]
+            cursore = response.context['cursore_successivo']
+            if not cursore:
+                break
+            self.assertContains(response, f'value="{cursore}"')
+        self.assertEqual(visti, self.ordinati)
+
+class IndiciQueryTests(TestCase):
+    # EXPLAIN QUERY PLAN delle query più frequenti: nessuna tabella letta per intero
+    def setUp(self):
+        self.user = User.objects.create_user(username='qzindici', password='testpass123')
+        self.prodotto = Prodotto.objects.create(nome='Qzindici', descrizione_breve='x', prezzo=10.00)
+        self.annuncio = Annuncio.objects.create(inserzionista=self.user, prodotto=self.prodotto, qta_magazzino=1)
+        self.cart = Cart.objects.create(utente=self.user)
+
+    def assertNessunaScansione(self, queryset):
+        piano = queryset.explain()
+        scansioni = [riga for riga in piano.splitlines() if re.search(r'\bSCAN \w+$', riga)]
+        self.assertEqual(scansioni, [], f"{queryset.query}\n{piano}")
+
+    def test_query_frequenti(self):
+        querysets = [
+            # Home e ricerca senza filtri
+            Annuncio.objects.filter(is_published=True, qta_magazzino__gt=0, inserzionista__is_active=True
+                                    ).order_by('-data_pubblicazione')[:MAX_PAGINATOR_HOME_VALUE],
+            Annuncio.objects.filter(inserzionista__is_active=True, is_published=True
+                                    ).order_by('-data_pubblicazione')[:MAX_PAGINATOR_RICERCA_VALUE],
+            Annuncio.objects.filter(inserzionista=self.user).order_by('-data_pubblicazione'),
+            # Ordini del profilo e dei clienti, controlli sugli stati
+            Ordine.objects.filter(utente=self.user).order_by('-data_ordine', '-id')[:10],
+            Ordine.objects.filter(prodotto__annuncio__inserzionista=self.user).order_by('-data_ordine', '-id')[:10],
+            Ordine.objects.filter(prodotto__annuncio=self.annuncio, stato_consegna='da spedire'),
+            Ordine.objects.filter(utente=self.user, prodotto=self.prodotto, stato_consegna='consegnato'),
+            # Notifiche non lette e outbox
+            Notification.objects.filter(recipient=self.user, read=False),
+            Notification.objects.filter(inviata=False).order_by('id')[:100],
+            # Commenti di un annuncio e di un utente
+            CommentoAnnuncio.objects.filter(annuncio=self.annuncio, utente__is_active=True
+                                            ).order_by('-data_pubblicazione', '-id')[:10],
+            CommentoAnnuncio.objects.filter(utente=self.user).order_by('-data_pubblicazione', '-id')[:10],
+            # Carrello
+            Invoice.objects.filter(prodotto=self.prodotto, cart=self.cart),
+        ]
+        for queryset in querysets:
+            with self.subTest(query=str(queryset.query)):
+                self.assertNessunaScansione(queryset)
+
+class PermessiModeratoreTests(TestCase):
+    def setUp(self):
+        self.moderatore = User.objects.create_user(username='qzmod', password='testpass123')
+        self.gruppo = Group.objects.get_or_create(name=_MODS_GRP_NAME)[0]
+        self.moderatore.groups.add(self.gruppo)
+        self.client.login(username='qzmod', password='testpass123')
+
+    def query_gruppi(self, url):
+        with CaptureQueriesContext(connection) as query:
+            response = self.client.get(url)
+        return response, sum('auth_user_groups' in q['sql'] for q in query.captured_queries)
+
+    def test_una_query_per_richiesta(self):
+        # Home con molte card e la barra del moderatore: una sola query sui gruppi
+        response, query = self.query_gruppi(reverse('sylvelius:home'))
+        self.assertTrue(response.context['is_moderator'])
+        self.assertEqual(query, 1)
+        response, query = self.query_gruppi(reverse('sylvelius:ricerca_annunci') + '?q=qz')
+        self.assertTrue(response.context['is_moderator'])
+        self.assertEqual(query, 1)
+
+    def test_cambio_gruppo(self):
+        self.query_gruppi(reverse('sylvelius:home'))
+        self.moderatore.groups.remove(self.gruppo)
+        response, query = self.query_gruppi(reverse('sylvelius:home'))
+        self.assertFalse(response.context['is_moderator'])
+        self.assertEqual(query, 1)
+
+    def test_cambio_gruppo_da_altro_processo(self):
+        # Righe tolte senza segnali, come da un altro processo: vale dalla richiesta successiva
+        self.query_gruppi(reverse('sylvelius:home'))
+        User.groups.through.objects.filter(user=self.moderatore).delete()
+        response, query = self.query_gruppi(reverse('sylvelius:home'))
+        self.assertFalse(response.context['is_moderator'])
+        self.assertEqual(query, 1)
+
+    def test_anonimo(self):
+        self.client.logout()
+        response, query = self.query_gruppi(reverse('sylvelius:home'))
+        self.assertFalse(response.context['is_moderator'])
+        self.assertEqual(query, 0)
+
+def costanti_ricostruite(request):
+    # Il vecchio global_constants, per il confronto nel benchmark
+    return _costanti(constants)
+
+class CostantiGlobaliTests(TestCase):
+    RIPETIZIONI = 100
+    GIRI = 7
+    # Il guadagno è di qualche punto percentuale, sotto il rumore di una macchina
+    # condivisa: si controlla che il render con le costanti in cache non sia più
+    # lento di quello che le ricostruisce oltre questo margine
+    MARGINE = 1.15
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.user = AnonymousUser()
+
+    def test_calcolate_una_volta(self):
+        costanti = global_constants(self.request)
+        self.assertIs(costanti, global_constants(self.request))
+        self.assertEqual(dict(costanti), _costanti(constants))
+        self.assertNotIn('_MODS_GRP_NAME', costanti)
+        with self.assertRaises(TypeError):
+            costanti['MAX_WS_QUERIES'] = 0 #type:ignore
+
+    def rendi(self):
+        # Il primo render compila il template e non si conta
+        render_to_string('base.html', request=self.request)
+        gc.disable()
+        try:
+            inizio = time.perf_counter()
+            for _ in range(self.RIPETIZIONI):
+                render_to_string('base.html', request=self.request)
+            return time.perf_counter() - inizio
+        finally:
+            gc.enable()
+
+    def test_benchmark_base_html(self):
+        # Prima: il dizionario ricostruito da vars(constants) a ogni render
+        templates = [dict(settings.TEMPLATES[0], OPTIONS={'context_processors': [
+            p if not p.endswith('.global_constants') else 'sylvelius.tests.costanti_ricostruite'
+            for p in settings.TEMPLATES[0]['OPTIONS']['context_processors']
+        ]})]
+        # Giri alternati, si tiene il migliore di ciascuna variante
+        prima, dopo = [], []
+        for _ in range(self.GIRI):
+            with override_settings(TEMPLATES=templates):
+                prima.append(self.rendi())
+            dopo.append(self.rendi())
+        prima, dopo = min(prima), min(dopo)
+        self.assertLess(
+            dopo, prima * self.MARGINE,
+            f"base.html x{self.RIPETIZIONI}: prima {prima * 1000:.1f} ms, dopo {dopo * 1000:.1f} ms"
+        )
+
+
+class CaricaDatiTests(TestCase):
+    def setUp(self):
+        self.utente = User.objects.create_user(username='qzcarica', password='pass')
+        self.cartella = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cartella)
+
+    def scrivi_dati(self, n):
+        dati = {
+            'prodotti': [
+                {'id': 900000 + i, 'nome': f'qzprodotto {i}', 'descrizione_breve': 'qz', 'prezzo': '1.50',
+                 'condizione': 'nuovo', 'tag': ['QzTag', f'qztag{i % 3}'], 'immagini': [{'immagine': None}]}
+                for i in range(n)
+            ],
+            'annunci': [
+                {'id': 900000 + i, 'prodotto_id': 900000 + i, 'inserzionista': 'qzcarica', 'qta_magazzino': 3}
+                for i in range(n)
+            ],
+            'ordini': [
+                {'utente_username': 'qzcarica', 'prodotto_id': 900000 + i, 'quantita': 1,
+                 'stato_consegna': 'da spedire', 'luogo_consegna': {'postal_code': '00100'}}
+                for i in range(n)
+            ],
+            'commenti': [
+                {'annuncio_id': 900000 + i, 'utente_username': 'qzcarica', 'testo': 'qz', 'rating': 4,
+                 'data_commento': '2025-07-29T16:00:00Z'}
+                for i in range(n)
+            ],
+        }
+        percorso = os.path.join(self.cartella, f'dati_{n}.json')
+        with open(percorso, 'w', encoding='utf-8') as file:
+            json.dump(dati, file)
+        return percorso
+
+    def test_leggi_sezioni_a_blocchi(self):
+        dati = {'utenti': [{'id': 1, 'nome': 'a , ] } "x"'}, {'id': 2}], 'vuota': [], 'altro': {'k': [1]},
+                'annunci': [{'testo': 'è' * 50}]}
+        testo = json.dumps(dati, indent=2)
+        attesi = [(sezione, record) for sezione, righe in dati.items() if isinstance(righe, list) for record in righe]
+        for blocco in (1, 7, 4096):
+            self.assertEqual(list(leggi_sezioni(StringIO(testo), blocco)), attesi)
+        with self.assertRaises(ValueError):
+            list(leggi_sezioni(StringIO('{"utenti": [{"id": 1}')))
+
+    def test_caricamento_rieseguibile(self):
+        percorso = self.scrivi_dati(5)
+        carica_dati(percorso)
+        conteggi = carica_dati(percorso, batch=2)
+        self.assertEqual(conteggi['prodotti'], 5)
+        prodotti = Prodotto.objects.filter(id__gte=900000)
+        self.assertEqual(prodotti.count(), 5)
+        self.assertEqual(Annuncio.objects.filter(prodotto__in=prodotti).count(), 5)
+        self.assertEqual(Ordine.objects.filter(utente=self.utente).count(), 5)
+        self.assertEqual(ImmagineProdotto.objects.filter(prodotto__in=prodotti).count(), 5)
+        self.assertEqual(Tag.objects.filter(nome='qztag').count(), 1)
+        self.assertEqual(Prodotto.objects.get(id=900001).tags.count(), 2)
+
+        commento = CommentoAnnuncio.objects.get(annuncio_id=900000)
+        self.assertEqual(commento.data_pubblicazione.year, 2025)
+        annuncio = Annuncio.objects.get(id=900000)
+        self.assertEqual((annuncio.rating_numero, annuncio.rating_media), (1, 4))
+        # bulk_create non passa dai signals: l'indice di ricerca va ricostruito a parte
+        self.assertIn(900003, Prodotto.objects.filter(indice_ricerca__isnull=False).values_list('id', flat=True))
+
+    def test_query_indipendenti_dal_numero_di_righe(self):
+        conteggi = []
+        for n in (5, 200):
+            percorso = self.scrivi_dati(n)
+            with CaptureQueriesContext(connection) as queries:
+                carica_dati(percorso)
+            conteggi.append(len(queries.captured_queries))
+        # Con query per riga sarebbero centinaia in più; le poche in più vengono da
+        # SQLite, che divide gli INSERT grandi per il limite di parametri per query
+        self.assertLess(conteggi[1] - conteggi[0], 20)
+
+    def test_comando(self):
+        out = StringIO()
+        call_command('carica_dati', self.scrivi_dati(3), stdout=out)
+        self.assertIn('prodotti: 3', out.getvalue())
+
+class GeneraDatiTests(TestCase):
+    NUMERO = {'utenti': 20, 'prodotti': 200, 'tag': 30, 'ordini': 100, 'commenti': 100, 'notifiche': 50}
+    OPZIONI = ['--utenti', '20', '--prodotti', '200', '--tag', '30', '--ordini', '100',
+               '--commenti', '100', '--notifiche', '50']
+
+    def test_deterministico(self):
+        self.assertEqual(list(genera_record(self.NUMERO, seed=3)), list(genera_record(self.NUMERO, seed=3)))
+        self.assertNotEqual(list(genera_record(self.NUMERO, seed=3)), list(genera_record(self.NUMERO, seed=4)))
+
+    def test_tag_con_distribuzione_zipf(self):
+        usi = {}
+        for sezione, record in genera_record(self.NUMERO):
+            if sezione == 'prodotti':
+                for nome in record['tag']:
+                    usi[nome] = usi.get(nome, 0) + 1
+        # Il tag di rango 1 è il più usato, molto più di quelli in coda
+        self.assertEqual(max(usi, key=usi.get), 'calcio') # type: ignore
+        self.assertGreater(usi['calcio'], 5 * usi.get('pallavolo1', 1))
+
+    def test_comando_carica_e_riesegue(self):
+        call_command('genera_dati', *self.OPZIONI, stdout=StringIO())
+        base = constants.GENERATORE_ID_BASE
+        conteggi = lambda: (
+            User.objects.filter(id__gte=base).count(),
+            Annuncio.objects.filter(id__gte=base).count(),
+            Ordine.objects.filter(prodotto_id__gte=base).count(),
+            CommentoAnnuncio.objects.filter(annuncio_id__gte=base).count(),
+            Notification.objects.filter(id__gte=base).count(),
+        )
+        prima = conteggi()
+        self.assertEqual(prima, (20, 200, 100, 100, 50))
+        call_command('genera_dati', *self.OPZIONI, stdout=StringIO())
+        self.assertEqual(conteggi(), prima)
+        # Le notifiche caricate non finiscono nella outbox
+        self.assertFalse(Notification.objects.filter(id__gte=base, inviata=False).exists())
+        self.assertTrue(self.client.login(username='bench000000', password=constants.GENERATORE_PASSWORD))
+
+    def test_output_json(self):
+        cartella = tempfile.mkdtemp()
+        try:
+            percorso = os.path.join(cartella, 'sintetici.json')
+            call_command('genera_dati', *self.OPZIONI, '--output', percorso, stdout=StringIO())
+            with open(percorso, encoding='utf-8') as file:
+                self.assertEqual(list(leggi_sezioni(file)), list(genera_record(self.NUMERO)))
+            self.assertFalse(User.objects.filter(username='bench000000').exists())
+        finally:
+            shutil.rmtree(cartella)
+
+class BenchmarkPagineTests(TestCase):
+    def test_percentile(self):
+        valori = list(range(1, 101))
+        self.assertEqual(percentile(valori, 50), 50)
+        self.assertEqual(percentile(valori, 95), 95)
+        self.assertEqual(percentile([7], 95), 7)
+
+    def test_confronta(self):
+        prima = {'home': {'p95_ms': 10.0, 'query': 4}, 'carrello': {'p95_ms': 10.0, 'query': 4}}
+        dopo = {'home': {'p95_ms': 11.0, 'query': 4}, 'carrello': {'p95_ms': 30.0, 'query': 5}, 'nuovo': {'p95_ms': 1, 'query': 1}}
+        regressioni = confronta(prima, dopo, 20)
+        self.assertEqual(len(regressioni), 2)
+        self.assertTrue(all(r.startswith('carrello') for r in regressioni))
+
+    def test_parametri_non_validi(self):
+        for argomenti in (['--ripetizioni', '0'], ['--riscaldamento', '-1']):
+            with self.assertRaises(CommandError):
+                call_command('benchmark_pagine', *argomenti, stdout=StringIO())
+        self.assertFalse(User.objects.filter(id=constants.GENERATORE_ID_BASE).exists())
+
+    def test_comando(self):
+        call_command('genera_dati', '--utenti', '5', '--prodotti', '30', '--tag', '5', '--ordini', '40',
+                     '--commenti', '20', '--notifiche', '10', stdout=StringIO())
+        cartella = tempfile.mkdtemp()
+        try:
+            percorso = os.path.join(cartella, 'benchmark.json')
+            call_command('benchmark_pagine', '--ripetizioni', '2', '--output', percorso, stdout=StringIO())
+            with open(percorso, encoding='utf-8') as file:
+                esito = json.load(file)
+            risultati = esito['risultati']
+            for nome in ('home', 'ricerca_rilevanza', 'annuncio', 'profilo', 'clienti', 'carrello',
+                         'checkout', 'api_notifiche', 'api_carrello'):
+                self.assertEqual(risultati[nome]['status'], 200, nome)
+                self.assertLessEqual(risultati[nome]['p50_ms'], risultati[nome]['p95_ms'])
+                self.assertGreater(risultati[nome]['query'], 0)
+
+            # Stesso file come riferimento con soglia larga: nessuna regressione
+            out = StringIO()
+            call_command('benchmark_pagine', '--ripetizioni', '2', '--solo', 'api_', '--confronta', percorso,
+                         '--soglia', '100000', stdout=out)
+            self.assertIn('Nessuna regressione', out.getvalue())
+        finally:
+            shutil.rmtree(cartella)
+        # Il carrello preparato per il benchmark viene annullato
+        self.assertFalse(Cart.objects.filter(utente_id=constants.GENERATORE_ID_BASE).exists())
+
+class StrumentazioneMiddlewareTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='qzstrumenti', password='pass')
+
+    def test_disattivo_di_default(self):
+        response = self.client.get(reverse('sylvelius:home'))
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(STRUMENTAZIONE=True)
+    def test_server_timing_e_log(self):
+        client = Client()
+        client.force_login(self.user)
+        with self.assertLogs('sylvelius.strumentazione', level='INFO') as log:
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse('sylvelius:home'))
+        header = response['Server-Timing']
+        self.assertRegex(header, r'^sql;desc="\d+ query, \d+ duplicate";dur=[\d.]+, render;dur=[\d.]+, totale;dur=[\d.]+$')
+        dati = json.loads(log.records[-1].getMessage())
+        self.assertEqual(dati['view'], 'sylvelius:home')
+        self.assertEqual(dati['status'], 200)
+        self.assertEqual(dati['query'], len(queries.captured_queries))
+        self.assertGreater(dati['render_ms'], 0)
+        self.assertIn(f'"{dati["query"]} query', header)
+
+    @override_settings(STRUMENTAZIONE=True)
+    def test_query_duplicate(self):
+        # Una view con un N+1 evidente: la stessa query ripetuta per ogni annuncio
+        def view_n_piu_uno(request):
+            for annuncio in Annuncio.objects.all()[:10]:
+                annuncio.prodotto.nome
+            return HttpResponse('ok')
+
+        from sylvelius.middlewares import StrumentazioneMiddleware
+        middleware = StrumentazioneMiddleware(view_n_piu_uno)
+        request = RequestFactory().get('/qz/')
+        with self.assertLogs('sylvelius.strumentazione', level='WARNING') as log:
+            response = middleware(request)
+        dati = json.loads(log.records[-1].getMessage())
+        self.assertEqual(dati['duplicate'], 9)
+        self.assertEqual(dati['piu_ripetute'][0]['volte'], 10)
+        self.assertIn('9 duplicate', response['Server-Timing'])
@@ -1,6 +1,6 @@
 from django.urls import path, re_path
 from . import views
-from .api_views import get_immagine_prodotto, get_immagini_prodotto, notifications_api, cart_check
+from .api_views import get_immagine_prodotto, get_immagini_prodotto, get_immagini_prodotti, notifications_api, cart_check, statistiche_suggerimenti
 
 app_name = "sylvelius"
 
@@ -36,6 +36,8 @@ urlpatterns = [
     # api
     path('api/immagine/<int:prodotto_id>/', get_immagine_prodotto),
     path('api/immagini/<int:prodotto_id>/', get_immagini_prodotto),
+    path('api/immagini/', get_immagini_prodotti, name='immagini_prodotti'),
     path('api/notifications/', notifications_api, name='notifications_api'),
-    path('api/cart_check/', cart_check, name='cart_check')
+    path('api/cart_check/', cart_check, name='cart_check'),
+    path('api/statistiche/suggerimenti/', statistiche_suggerimenti, name='statistiche_suggerimenti')
 ]
\ No newline at end of file
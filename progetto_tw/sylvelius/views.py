@@ -12,8 +12,7 @@ from django.contrib.auth.forms import PasswordChangeForm
 from django.contrib.auth.models import User
 from django.contrib.auth.views import LoginView, LogoutView
 from django.core.paginator import Paginator
-from django.db.models import Avg, Q
-from django.db.models.functions import Floor
+from django.db.models import Prefetch, Q
 from django.http import (
     Http404,
     HttpResponseForbidden,
@@ -60,6 +59,8 @@ from progetto_tw.constants import (
     _MODS_GRP_NAME,
 )
 from progetto_tw.mixins import CustomLoginRequiredMixin, ModeratoreAccessForbiddenMixin
+from progetto_tw.paginazione import PaginatorKeyset
+from progetto_tw.permessi import is_moderatore
 
 from purchase.models import Cart, Iban
 
@@ -73,11 +74,13 @@ from .models import (
     Prodotto,
     Tag,
 )
+from .notifiche import accoda_notifiche, segna_notifiche_lette
+from .ricerca import get_backend
 
 @require_POST
 @login_required
 def mark_notifications_read(request):
-    Notification.objects.filter(recipient=request.user, read=False).update(read=True)
+    segna_notifiche_lette(request.user)
     return JsonResponse({'status': 'ok'})
 #non callable
 def send_notification(user_id=None,title="", message="", global_notification=False):
@@ -93,26 +96,31 @@ def send_notification(user_id=None,title="", message="", global_notification=Fal
         )
 #non callable
 def create_notification(recipient=None, title="", message="", is_global=False, sender=None):
-    # Salva nel database
-    notifica = Notification.objects.create(
+    # Salva nel database, l'invio via WebSocket avviene dopo il commit (outbox)
+    notifica, = accoda_notifiche([Notification(
         recipient=recipient,
         sender=sender,
         title=title,
         message=message,
         is_global=is_global,
         read=False
-    )
-    
-    # Invia via WebSocket
-    send_notification(
-        user_id=recipient.id if recipient else None,
-        title=title,
-        message=message,
-        global_notification=is_global
-    )
+    )])
     
     return notifica
 #non callable
+def esito_annullamento(user, is_mod, ordine):
+    # Notifica (destinatario, titolo, messaggio) se l'utente può annullare l'ordine, altrimenti None
+    if user == ordine.utente and ordine.stato_consegna=='da spedire':
+        return (ordine.prodotto.annuncio.inserzionista, "Ordine annullato",
+                f"Il tuo ordine di {ordine.prodotto.nome} è stato annullato dal compratore")
+    if is_mod and (ordine.stato_consegna=='da spedire' or ordine.stato_consegna=='spedito'):
+        return (ordine.utente, "Ordine cancellato",
+                f"Il tuo ordine di {ordine.prodotto.nome} è stato cancellato da un moderatore, riceverai un rimborso a breve")
+    if ordine.stato_consegna=='da spedire' and user == ordine.prodotto.annuncio.inserzionista:
+        return (ordine.utente, "Ordine rifiutato",
+                f"Il tuo ordine di {ordine.prodotto.nome} è stato rifiutato dal venditore, riceverai un rimborso a breve")
+    return None
+#non callable
 def annulla_ordine_free(request, order_id):
     try:
         ordine = Ordine.objects.get(id=order_id)
@@ -121,25 +129,44 @@ def annulla_ordine_free(request, order_id):
             "status": "error",
             "message": "Ordine non trovato o già spedito"
         }, status=400)
-    if(request.user == ordine.utente or request.user.groups.filter(name=_MODS_GRP_NAME).exists() or request.user == ordine.prodotto.annuncio.inserzionista): #type:ignore
-        if request.user == ordine.utente and ordine.stato_consegna=='da spedire':
-            ordine.stato_consegna = 'annullato'
-            ordine.save()
-            create_notification(recipient=ordine.prodotto.annuncio.inserzionista,title="Ordine annullato", sender=request.user, #type:ignore
-                                message=f"Il tuo ordine di {ordine.prodotto.nome} è stato annullato dal compratore")
-        if request.user.groups.filter(name=_MODS_GRP_NAME).exists() and (ordine.stato_consegna=='da spedire' or ordine.stato_consegna=='spedito'):
-            ordine.stato_consegna = 'annullato'
-            ordine.save()
-            create_notification(recipient=ordine.utente,title="Ordine cancellato", sender=request.user, #type:ignore
-                                message=f"Il tuo ordine di {ordine.prodotto.nome} è stato cancellato da un moderatore, riceverai un rimborso a breve")
-        if ordine.stato_consegna=='da spedire' and request.user == ordine.prodotto.annuncio.inserzionista:#type:ignore
+    is_mod = is_moderatore(request)
+    if(request.user == ordine.utente or is_mod or request.user == ordine.prodotto.annuncio.inserzionista): #type:ignore
+        esito = esito_annullamento(request.user, is_mod, ordine)
+        if esito:
+            destinatario, titolo, messaggio = esito
             ordine.stato_consegna = 'annullato'
             ordine.save()
-            create_notification(recipient=ordine.utente,title="Ordine rifiutato", sender=request.user, #type:ignore
-                                message=f"Il tuo ordine di {ordine.prodotto.nome} è stato rifiutato dal venditore, riceverai un rimborso a breve")
+            create_notification(recipient=destinatario, title=titolo, message=messaggio, sender=request.user)
         return JsonResponse({"status": "success"})
     else: return JsonResponse({"status": "error", "message": "Ordine non trovato o già spedito"}, status=400)
 #non callable
+def annulla_ordini_free(request, ordini, notifiche=()):
+    # Come annulla_ordine_free su un queryset: un solo UPDATE e tutte le notifiche
+    # (più quelle passate dal chiamante) in un solo bulk_create, a prescindere dal numero di ordini
+    is_mod = is_moderatore(request)
+    annullati = []
+    notifiche = list(notifiche)
+    for ordine in ordini.select_related('utente', 'prodotto__annuncio__inserzionista'):
+        esito = esito_annullamento(request.user, is_mod, ordine)
+        if esito:
+            destinatario, titolo, messaggio = esito
+            annullati.append(ordine.id)
+            notifiche.append(Notification(recipient=destinatario, sender=request.user, title=titolo, message=messaggio))
+    Ordine.objects.filter(id__in=annullati).update(stato_consegna='annullato')
+    accoda_notifiche(notifiche)
+#non callable
+def contesto_keyset(request, page_obj):
+    # Variabili per _btn_paginazione.html con PaginatorKeyset; "cursore" riapre la pagina corrente
+    return {
+        'keyset': True,
+        'page': page_obj.number,
+        'has_next': page_obj.has_next(),
+        'has_previous': page_obj.has_previous(),
+        'cursore': request.GET.get('cursore', ''),
+        'cursore_successivo': page_obj.cursore_successivo,
+        'cursore_precedente': page_obj.cursore_precedente,
+    }
+#non callable
 def check_if_annuncio_is_valid(request):
     nome = request.POST.get('nome').strip()
     descrizione = request.POST.get('descrizione', '')
@@ -210,6 +237,13 @@ def check_if_annuncio_is_valid(request):
             return {'evento': 'imgproportion'}
     
     return None
+#non callable
+def annunci_per_card(annunci):
+    # Carica in anticipo tutto ciò che _card_annuncio.html legge per ogni card
+    return annunci.select_related('prodotto', 'inserzionista').prefetch_related(
+        'prodotto__tags',
+        Prefetch('prodotto__immagini', queryset=ImmagineProdotto.prime_per_prodotto(), to_attr='immagini_card')
+    )
 
 class HomePageView(TemplateView):
     template_name = "sylvelius/home.html"
@@ -217,7 +251,9 @@ class HomePageView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        annunci = Annuncio.objects.filter(is_published=True,qta_magazzino__gt=0,inserzionista__is_active=True).order_by('-data_pubblicazione')
+        annunci = annunci_per_card(
+            Annuncio.objects.filter(is_published=True,qta_magazzino__gt=0,inserzionista__is_active=True).order_by('-data_pubblicazione')
+        )
 
         paginator = Paginator(annunci, MAX_PAGINATOR_HOME_VALUE)
         page_number = self.request.GET.get('page', 1)
@@ -258,7 +294,7 @@ class ProfiloPageView(CustomLoginRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        if self.request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+        if is_moderatore(self.request):
             user_without_is_active_list = User.objects.filter(is_active=False).order_by('username')
             
             paginator = Paginator(user_without_is_active_list, MAX_PAGINATOR_BANNED_USERS_VALUE)
@@ -313,7 +349,7 @@ class ProfiloDetailsPageView(DetailView):
     context_object_name = 'user_profile'
 
     def get_object(self, queryset=None):
-        if self.request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+        if is_moderatore(self.request):
             user = get_object_or_404(User, username=self.kwargs.get(self.slug_url_kwarg))
         else:
             user = get_object_or_404(User, username=self.kwargs.get(self.slug_url_kwarg), is_active=True)
@@ -324,28 +360,25 @@ class ProfiloDetailsPageView(DetailView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         user = self.object # type: ignore
-        if self.request.user.groups.filter(name=_MODS_GRP_NAME).exists():
-            annunci = Annuncio.objects.filter(inserzionista=user).annotate(avg_rating=Avg('commenti__rating')).order_by('-avg_rating')
+        if is_moderatore(self.request):
+            annunci = Annuncio.objects.filter(inserzionista=user).order_by('-rating_media')
             commenti = CommentoAnnuncio.objects.filter(utente=user).order_by('-data_pubblicazione')
         else:
-            annunci = Annuncio.objects.filter(inserzionista=user, is_published=True).annotate(avg_rating=Avg('commenti__rating')).order_by('-avg_rating')
+            annunci = Annuncio.objects.filter(inserzionista=user, is_published=True).order_by('-rating_media')
             commenti = CommentoAnnuncio.objects.filter(
                 utente=user,
                 annuncio__inserzionista__is_active=True,
                 annuncio__is_published=True
             ).order_by('-data_pubblicazione')
 
-        paginator = Paginator(commenti, MAX_PAGINATOR_COMMENTI_DETTAGLI_VALUE)
-        page_number = self.request.GET.get('page', 1)
-        page_obj = paginator.get_page(page_number)
+        paginator = PaginatorKeyset(commenti, 'data_pubblicazione', MAX_PAGINATOR_COMMENTI_DETTAGLI_VALUE)
+        page_obj = paginator.get_page(self.request.GET.get('cursore'))
 
-        context['annunci'] = annunci[:MAX_ANNUNCI_PER_DETTAGLI_VALUE]
+        context['annunci'] = annunci_per_card(annunci)[:MAX_ANNUNCI_PER_DETTAGLI_VALUE]
         context['annunci_count'] = annunci.count()
         context['commenti_count'] = commenti.count()
         context['commenti'] = page_obj.object_list
-        context['page'] = page_obj.number
-        context['has_next'] = page_obj.has_next()
-        context['has_previous'] = page_obj.has_previous()
+        context.update(contesto_keyset(self.request, page_obj))
         return context
     
 class ProfiloEditPageView(CustomLoginRequiredMixin, UpdateView):
@@ -423,14 +456,9 @@ class ProfiloDeletePageView(CustomLoginRequiredMixin, DeleteView):
         ).exists():
             return render(request, self.template_name, {"evento": "shipd"})
 
-        ordine_ex = Ordine.objects.filter(utente=user)
-        ordine_in = Ordine.objects.filter(prodotto__annuncio__inserzionista=user)
-
-        for ordine in ordine_ex:
-            annulla_ordine_free(request, ordine.id)  # type: ignore
-
-        for ordine in ordine_in:
-            annulla_ordine_free(request, ordine.id)  # type: ignore
+        annulla_ordini_free(request, Ordine.objects.filter(
+            Q(utente=user) | Q(prodotto__annuncio__inserzionista=user)
+        ))
 
         Annuncio.objects.filter(inserzionista=user).delete()
         Iban.objects.filter(utente=user).delete()
@@ -448,7 +476,7 @@ class AnnuncioDetailView(TemplateView):
         context = super().get_context_data(**kwargs)
         user = self.request.user
         annuncio_uuid = self.kwargs['uuid']
-        if self.request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+        if is_moderatore(self.request):
             annuncio = get_object_or_404(Annuncio, uuid=annuncio_uuid)
         else:
             annuncio = get_object_or_404(Annuncio, uuid=annuncio_uuid, is_published=True,inserzionista__is_active=True)
@@ -458,7 +486,7 @@ class AnnuncioDetailView(TemplateView):
             utente=user
         ).first() if user.is_authenticated else None
 
-        if self.request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+        if is_moderatore(self.request):
             if annUt:
                 commenti = CommentoAnnuncio.objects.filter(
                     annuncio=annuncio
@@ -497,14 +525,11 @@ class AnnuncioDetailView(TemplateView):
         context['ha_acquistato'] = ha_acquistato
         context['annuncio'] = annuncio
 
-        paginator = Paginator(commenti, MAX_PAGINATOR_COMMENTI_ANNUNCIO_VALUE) 
-        page_number = self.request.GET.get('page',1)
-        page_obj = paginator.get_page(page_number)
+        paginator = PaginatorKeyset(commenti, 'data_pubblicazione', MAX_PAGINATOR_COMMENTI_ANNUNCIO_VALUE) 
+        page_obj = paginator.get_page(self.request.GET.get('cursore'))
 
         context['commenti'] = page_obj.object_list
-        context['page'] = page_obj.number
-        context['has_next'] = page_obj.has_next()
-        context['has_previous'] = page_obj.has_previous()
+        context.update(contesto_keyset(self.request, page_obj))
         return context
     
 class ProfiloOrdiniPageView(CustomLoginRequiredMixin, ModeratoreAccessForbiddenMixin, TemplateView):
@@ -518,14 +543,11 @@ class ProfiloOrdiniPageView(CustomLoginRequiredMixin, ModeratoreAccessForbiddenM
         
         ordini_list = Ordine.objects.filter(utente=utente).order_by('-data_ordine')
         
-        paginator = Paginator(ordini_list, MAX_PAGINATOR_ORDINI_VALUE)  
-        page_number = self.request.GET.get('page',1)
-        page_obj = paginator.get_page(page_number)
+        paginator = PaginatorKeyset(ordini_list, 'data_ordine', MAX_PAGINATOR_ORDINI_VALUE)  
+        page_obj = paginator.get_page(self.request.GET.get('cursore'))
         
         context['ordini'] = page_obj.object_list
-        context['page'] = page_obj.number
-        context['has_next'] = page_obj.has_next()
-        context['has_previous'] = page_obj.has_previous()
+        context.update(contesto_keyset(self.request, page_obj))
 
         return context
     
@@ -685,14 +707,11 @@ class ProfiloClientiPageView(CustomLoginRequiredMixin, ModeratoreAccessForbidden
         
         ordini_list = Ordine.objects.filter(prodotto__annuncio__inserzionista=utente).select_related('prodotto', 'utente').order_by('-data_ordine')
         
-        paginator = Paginator(ordini_list, MAX_PAGINATOR_ORDINI_VALUE)  
-        page_number = self.request.GET.get('page')
-        page_obj = paginator.get_page(page_number)
+        paginator = PaginatorKeyset(ordini_list, 'data_ordine', MAX_PAGINATOR_ORDINI_VALUE)  
+        page_obj = paginator.get_page(self.request.GET.get('cursore'))
         
         context['ordini'] = page_obj.object_list
-        context['page'] = page_obj.number
-        context['has_next'] = page_obj.has_next()
-        context['has_previous'] = page_obj.has_previous()
+        context.update(contesto_keyset(self.request, page_obj))
 
         return context
 
@@ -712,13 +731,10 @@ class RicercaAnnunciView(TemplateView):
         qta_mag = self.request.GET.get('qta_mag')
 
         annunci = Annuncio.objects.all()
+        backend = get_backend()
 
         if query:
-            annunci = annunci.filter(
-                Q(prodotto__nome__icontains=query) |
-                Q(prodotto__descrizione_breve__icontains=query) |
-                Q(prodotto__tags__nome__icontains=query)
-            )
+            annunci = backend.filtra(annunci, query)
 
         if categoria_str:
             tag_list = [tag.strip() for tag in categoria_str.split(',') if tag.strip()]
@@ -726,11 +742,11 @@ class RicercaAnnunciView(TemplateView):
                 annunci = annunci.filter(prodotto__tags__nome=tag)
         
         if inserzionista != '':
-            if self.request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+            if is_moderatore(self.request):
                 annunci = annunci.filter(inserzionista__username=inserzionista)
             else:
                 annunci = annunci.filter(inserzionista__username=inserzionista,inserzionista__is_active=True,is_published=True)
-        elif not self.request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+        elif not is_moderatore(self.request):
             annunci = annunci.filter(inserzionista__is_active=True,is_published=True)
         
         if condizione in PROD_CONDIZIONE_CHOICES_ID:
@@ -750,22 +766,17 @@ class RicercaAnnunciView(TemplateView):
             try:
                 rating_value = int(rating)
                 if MIN_COMMNT_RATING_VALUE <= rating_value <= MAX_COMMNT_RATING_VALUE:
-                    annunci = Annuncio.objects.annotate(
-                        rating_medio_calc=Avg('commenti__rating'),
-                        rating_range=Floor(Avg('commenti__rating'))
-                    ).filter(
-                        rating_range=rating_value
-                    ).exclude(
-                        rating_medio_calc__isnull=True
+                    annunci = annunci.filter(
+                        rating_media__gte=rating_value,
+                        rating_media__lt=rating_value + 1
                     )
-
                 else:
                     raise ValueError("Rating fuori range")
             except (ValueError, TypeError):
                 if rating == 'none':
-                    annunci = annunci.exclude(commenti__isnull=False)
+                    annunci = annunci.filter(rating_numero=0)
                 elif rating == 'starred':
-                    annunci = annunci.exclude(commenti__isnull=True)
+                    annunci = annunci.filter(rating_numero__gt=0)
                 else:
                     pass
 
@@ -790,14 +801,17 @@ class RicercaAnnunciView(TemplateView):
         elif sort_order == "prezzo-desc":
             annunci = annunci.order_by('-prodotto__prezzo')
         elif sort_order == "best-star":
-            annunci = annunci.annotate(avg_rating=Avg('commenti__rating')).order_by('-avg_rating')
+            annunci = annunci.order_by('-rating_media')
         elif sort_order == "worst-star":
-            annunci = annunci.annotate(avg_rating=Avg('commenti__rating')).order_by('avg_rating')
-
-        annunci = annunci.distinct()
+            annunci = annunci.order_by('rating_media')
+        elif sort_order == "rilevanza":
+            if query:
+                annunci = backend.ordina_per_rilevanza(annunci, query)
+            else:
+                annunci = annunci.order_by('-data_pubblicazione')
 
-        context['n_ris'] = annunci.count()
-        paginator = Paginator(annunci, MAX_PAGINATOR_RICERCA_VALUE)
+        paginator = Paginator(annunci_per_card(annunci), MAX_PAGINATOR_RICERCA_VALUE)
+        context['n_ris'] = paginator.count
         page_number = self.request.GET.get('page', 1)
 
         page_obj = paginator.get_page(page_number)
@@ -822,20 +836,19 @@ def toggle_pubblicazione(request, id):
 @require_POST
 @login_required
 def delete_pubblicazione(request, id):
-    if request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+    if is_moderatore(request):
         annuncio = get_object_or_404(Annuncio, id=id)
-        ordini = Ordine.objects.filter(prodotto__annuncio=annuncio, stato_consegna='da spedire')
-        for ordine in ordini:
-            annulla_ordine_free(request,ordine.id) # type: ignore
+        annulla_ordini_free(request, Ordine.objects.filter(prodotto__annuncio=annuncio, stato_consegna='da spedire'))
         annuncio.delete()  
         return redirect(f'{reverse("sylvelius:home")}?evento=elimina_pub')
     else:
         annuncio = get_object_or_404(Annuncio, id=id, inserzionista=request.user)
         ordini = Ordine.objects.filter(prodotto__annuncio=annuncio, stato_consegna='da spedire')
-        for ordine in ordini:
-            create_notification(recipient=request.user,title="Ordine annullato", #type:ignore
-                                message=f"L'ordine di {ordine.utente.username} contenente {ordine.prodotto.nome} è stato rifiutato dopo l'eliminazione dell'annuncio")
-            annulla_ordine_free(request,ordine.id) # type: ignore
+        annulla_ordini_free(request, ordini, notifiche=[
+            Notification(recipient=request.user, title="Ordine annullato",
+                         message=f"L'ordine di {username} contenente {annuncio.prodotto.nome} è stato rifiutato dopo l'eliminazione dell'annuncio")
+            for username in ordini.values_list('utente__username', flat=True)
+        ])
         annuncio.delete()
         page = request.POST.get('page', 1)
         return redirect(f'{reverse("sylvelius:profile_annunci")}?page={page}&evento=elimina')
@@ -939,7 +952,7 @@ def modifica_commento(request, commento_id):
 @require_POST
 @login_required
 def elimina_commento(request, commento_id):
-    if request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+    if is_moderatore(request):
         commento = get_object_or_404(CommentoAnnuncio, id=commento_id)
         commento.delete()
     else:
@@ -950,7 +963,7 @@ def elimina_commento(request, commento_id):
 @require_POST
 @login_required
 def espelli_utente(request, is_active, user_id):
-    if request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+    if is_moderatore(request):
         user = get_object_or_404(User, id=user_id)
         user.is_active = False if is_active=='ban' else True
         user.save()
@@ -961,15 +974,13 @@ def espelli_utente(request, is_active, user_id):
 @require_POST
 @login_required
 def formatta_utente(request, user_id):
-    if request.user.groups.filter(name=_MODS_GRP_NAME).exists():
+    if is_moderatore(request):
         user = get_object_or_404(User, id=user_id)
         if(not user.is_active):
-            ordini_ex = Ordine.objects.filter(prodotto__annuncio__inserzionista=user)
-            for ordine in ordini_ex:
-                annulla_ordine_free(request,ordine.id)# type: ignore
             ordine_in = Ordine.objects.filter(utente=user)
-            for ordine in ordine_in:
-                annulla_ordine_free(request,ordine.id)# type: ignore
+            annulla_ordini_free(request, Ordine.objects.filter(
+                Q(utente=user) | Q(prodotto__annuncio__inserzionista=user)
+            ))
             ordine_in.delete()
             Annuncio.objects.filter(inserzionista=user.id).delete() # type: ignore
             CommentoAnnuncio.objects.filter(utente=user.id).delete()# type: ignore